@@ -9,5 +9,8 @@ raw_data_path: str = os.path.join(data_path, "raw")
 ascii_data_path: str = os.path.join(raw_data_path, "ascii")
 
 checkpoint_path: str = os.path.join(BASE_PATH, "checkpoint")
+quantized_checkpoint_path: str = os.path.join(BASE_PATH, "checkpoint_int8")
+factorized_checkpoint_path: str = os.path.join(BASE_PATH, "checkpoint_lowrank")
+student_checkpoint_path: str = os.path.join(BASE_PATH, "checkpoint_student")
 prediction_path: str = os.path.join(BASE_PATH, "prediction")
 style_path: str = os.path.join(BASE_PATH, "style")
@@ -1,4 +1,5 @@
 import copy
+import itertools
 
 import numpy as np
 import pandas as pd
@@ -15,6 +16,10 @@ class DataFrame(object):
             All matrices must have the same leading dimension.  Data can also be fed a list of
             instances of np.memmap, in which case RAM usage can be limited to the size of a
             single batch.
+
+    The batch generators accept num_buffers, in which case batches are gathered into a ring of
+    num_buffers preallocated buffers instead of freshly allocated arrays.  A yielded batch is then only
+    valid until num_buffers - 1 further batches have been drawn from the generator.
     """
 
     def __init__(self, columns, data):
@@ -49,7 +54,9 @@ class DataFrame(object):
         test_df = DataFrame(copy.copy(self.columns), [mat[test_idx] for mat in self.data])
         return train_df, test_df
 
-    def batch_generator(self, batch_size, shuffle=True, num_epochs=10000, allow_smaller_final_batch=False):
+    def batch_generator(self, batch_size, shuffle=True, num_epochs=10000, allow_smaller_final_batch=False,
+                        num_buffers=None):
+        ring = self._buffer_ring(batch_size, num_buffers)
         epoch_num = 0
         while epoch_num < num_epochs:
             if shuffle:
@@ -59,13 +66,57 @@ class DataFrame(object):
                 batch_idx = self.idx[i: i + batch_size]
                 if not allow_smaller_final_batch and len(batch_idx) != batch_size:
                     break
-                yield DataFrame(
-                    columns=copy.copy(self.columns),
-                    data=[mat[batch_idx].copy() for mat in self.data]
-                )
+                yield self._take(batch_idx, next(ring) if ring else None)
+
+            epoch_num += 1
+
+    def bucketed_batch_generator(self, batch_size, key, num_buckets=10, shuffle=True, num_epochs=10000,
+                                 allow_smaller_final_batch=False, num_buffers=None):
+        """Batch generator that groups rows with similar values of self[key] into the same batch.
+
+        Rows are sorted by key and split into num_buckets buckets of (nearly) equal size.  Each epoch,
+        rows are shuffled within their bucket, cut into batches, and the batch order is shuffled.  Every
+        row is still visited exactly once per epoch, as with batch_generator.
+        """
+        buckets = np.array_split(np.argsort(self.dict[key], kind='stable'), num_buckets)
+        ring = self._buffer_ring(batch_size, num_buffers)
+        epoch_num = 0
+        while epoch_num < num_epochs:
+            if shuffle:
+                for bucket in buckets:
+                    np.random.shuffle(bucket)
+            idx = np.concatenate(buckets)
+
+            starts = np.arange(0, self.length, batch_size)
+            num_full = self.length // batch_size
+            if shuffle:
+                np.random.shuffle(starts[:num_full])
+            if not allow_smaller_final_batch:
+                starts = starts[:num_full]
+
+            for i in starts:
+                yield self._take(idx[i: i + batch_size], next(ring) if ring else None)
 
             epoch_num += 1
 
+    def _buffer_ring(self, batch_size, num_buffers):
+        if not num_buffers:
+            return None
+        return itertools.cycle([
+            [np.empty((batch_size,) + mat.shape[1:], dtype=mat.dtype) for mat in self.data]
+            for _ in range(num_buffers)
+        ])
+
+    def _take(self, batch_idx, buffers=None):
+        if buffers is None:
+            data = [mat[batch_idx] for mat in self.data]
+        else:
+            data = [
+                np.take(mat, batch_idx, axis=0, out=buf[:len(batch_idx)], mode='clip')
+                for mat, buf in zip(self.data, buffers)
+            ]
+        return DataFrame(columns=copy.copy(self.columns), data=data)
+
     def iterrows(self):
         for i in self.idx:
             yield self[i]
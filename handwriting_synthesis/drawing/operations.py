@@ -154,6 +154,30 @@ def offsets_to_coords(offsets):
     return np.concatenate([np.cumsum(offsets[:, :2], axis=0), offsets[:, 2:3]], axis=1)
 
 
+def stitch(segments, texts):
+    """
+    joins the offsets of line segments sampled separately into the offsets of one line, aligning the
+    baselines of the segments and separating them by the width of one character
+    """
+    coords = []
+    for offsets in segments:
+        if len(offsets) > 1:
+            segment_coords = offsets_to_coords(offsets)
+            segment_coords[:, :2] = align(segment_coords[:, :2])
+            coords.append(segment_coords)
+    if not coords:
+        return np.zeros([0, 3], dtype=np.float32)
+
+    num_chars = sum(len(text) for text, offsets in zip(texts, segments) if len(offsets) > 1)
+    char_width = sum(np.ptp(segment_coords[:, 0]) for segment_coords in coords) / max(num_chars, 1)
+    x = 0.0
+    for segment_coords in coords:
+        segment_coords[:, 0] += x - segment_coords[:, 0].min()
+        segment_coords[-1, 2] = 1.0
+        x = segment_coords[:, 0].max() + char_width
+    return coords_to_offsets(np.concatenate(coords, axis=0)).astype(np.float32)
+
+
 def draw(
         offsets,
         ascii_seq=None,
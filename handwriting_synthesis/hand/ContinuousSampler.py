@@ -0,0 +1,202 @@
+import logging
+from collections import deque, namedtuple
+
+import numpy as np
+
+from handwriting_synthesis.rnn.LSTMAttentionCell import LSTMAttentionCellState
+
+_Slot = namedtuple('_Slot', ['request_id', 'line', 'style', 'bias', 'seed', 'strokes', 'max_tsteps', 'cache_key'])
+
+_PHI = LSTMAttentionCellState._fields.index('phi')
+
+
+class ContinuousSampler(object):
+    """Samples lines with continuous (step-level) batching over a fixed pool of slots.
+
+    Instead of one session.run per batch, which runs until the slowest line of the batch finishes, the
+    free-run loop is driven from Python one timestep at a time (RNN.build_slot_sampler).  Every step first
+    admits pending lines into free slots, priming them with their style, then advances all occupied slots
+    together.  A line leaves its slot as soon as it terminates or reaches its step budget of 40 timesteps
+    per character (as in Hand._sample), and its slot is reused at the next step, so lines submitted while
+    others are being sampled start without waiting for them.  Seeded lines found in the Hand's cache are
+    returned by the next step without taking a slot, and seeded lines that finish are added to it.
+
+    With the Hand's stall_tsteps, a line also leaves its slot once its attention position (the argmax of
+    phi, as in rnn_free_run) has not advanced for that many timesteps.  Its strokes so far are returned,
+    and it is logged, recorded in the Hand's stalled and left out of the cache, as by Hand._sample.
+
+    Usage:
+
+        sampler = ContinuousSampler(hand)
+        request_id = sampler.admit('hello world', style=9, bias=0.75)
+        while sampler.busy:
+            for request_id, strokes in sampler.step():
+                ...
+
+    Args:
+        hand: Hand whose model is sampled from.
+        num_slots: Maximum number of lines sampled together.
+        max_chars: Width of the character arrays, which bounds the length of the encoded line (including
+            the style's characters when primed).
+    """
+
+    def __init__(self, hand, num_slots=32, max_chars=120):
+        self.hand = hand
+        self.nn = hand.nn
+        self.num_slots = num_slots
+        self.max_chars = max_chars
+
+        state_sizes = [placeholder.shape.as_list()[1] for placeholder in self.nn.slot_state]
+        self.state = [np.zeros([num_slots, size or max_chars], dtype=np.float32) for size in state_sizes]
+        self.inputs = np.zeros([num_slots, 3], dtype=np.float32)
+        self.chars = np.zeros([num_slots, max_chars], dtype=np.int32)
+        self.chars_len = np.zeros([num_slots], dtype=np.int32)
+        self.biases = np.zeros([num_slots], dtype=np.float32)
+        self.seeds = np.zeros([num_slots], dtype=np.int32)
+        # The attention position of every slot and the timestep at which it last advanced.
+        self.anchors = np.zeros([num_slots], dtype=np.int32)
+        self.anchor_times = np.zeros([num_slots], dtype=np.int32)
+
+        self.slots = [None] * num_slots
+        self.pending = deque()
+        self.cached = []
+        self.next_request_id = 0
+
+    @property
+    def busy(self):
+        """Whether any line is waiting or being sampled."""
+        return bool(self.pending) or bool(self.cached) or any(slot is not None for slot in self.slots)
+
+    def admit(self, line, style=None, bias=0.5, seed=None):
+        """Queues line to be sampled at the next step, and returns its request id.
+
+        With a seed, the line is sampled as by Hand._sample with the same seed.
+        """
+        self.hand._validate([line])
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        cache_key = None
+        if seed is not None and self.hand.cache is not None:
+            cache_key = self.hand.cache.key(line, style, bias, seed, self.hand.fingerprint)
+            strokes = self.hand.cache.get(cache_key)
+            if strokes is not None:
+                self.cached.append((request_id, strokes))
+                return request_id
+        seed = seed if seed is not None else np.random.randint(np.iinfo(np.int32).max)
+        self.pending.append((request_id, line, style, bias, seed, cache_key))
+        return request_id
+
+    def step(self):
+        """Admits pending lines into free slots and advances every occupied slot by one timestep.
+
+        Returns a list of (request_id, strokes) for the lines that finished, with strokes as returned by
+        Hand._sample.
+        """
+        finished, self.cached = self.cached, []
+        finished.extend(self._fill_slots())
+        active = [i for i, slot in enumerate(self.slots) if slot is not None]
+        if not active:
+            return finished
+
+        feed_dict = {placeholder: values[active] for placeholder, values in zip(self.nn.slot_state, self.state)}
+        feed_dict.update({
+            self.nn.slot_input: self.inputs[active],
+            self.nn.slot_c: self.chars[active],
+            self.nn.slot_c_len: self.chars_len[active],
+            self.nn.slot_bias: self.biases[active],
+            self.nn.slot_seeds: self.seeds[active],
+            self.nn.slot_time: [len(self.slots[i].strokes) + 1 for i in active],
+        })
+        next_state, outputs, terminated = self.nn.session.run(
+            [self.nn.slot_next_state, self.nn.slot_output, self.nn.slot_finished], feed_dict=feed_dict)
+
+        for values, next_values in zip(self.state, next_state):
+            values[active] = next_values
+        self.inputs[active] = outputs
+        positions = np.argmax(self.state[_PHI][active], axis=1)
+        for row, i in enumerate(active):
+            slot = self.slots[i]
+            slot.strokes.append(outputs[row])
+            time = len(slot.strokes)
+            if positions[row] > self.anchors[i]:
+                self.anchors[i] = positions[row]
+                self.anchor_times[i] = time
+            if terminated[row] or time >= slot.max_tsteps:
+                finished.append(self._release(i))
+            elif self.hand.stall_tsteps and time - self.anchor_times[i] >= self.hand.stall_tsteps:
+                finished.append(self._release(i, stalled=True))
+        return finished
+
+    def sample(self, lines, biases=None, styles=None, seeds=None):
+        """Samples lines and returns their strokes in order, like Hand._sample."""
+        biases = biases if biases is not None else [0.5] * len(lines)
+        request_ids = [
+            self.admit(
+                line,
+                style=styles[i] if styles is not None else None,
+                bias=biases[i],
+                seed=seeds[i] if seeds is not None else None
+            )
+            for i, line in enumerate(lines)
+        ]
+        results = {}
+        while not all(request_id in results for request_id in request_ids):
+            results.update(self.step())
+        return [results.pop(request_id) for request_id in request_ids]
+
+    def _fill_slots(self):
+        """Primes pending lines into free slots.  Returns the lines that finished before their first step."""
+        free = [i for i, slot in enumerate(self.slots) if slot is None]
+        admitted = [self.pending.popleft() for _ in range(min(len(free), len(self.pending)))]
+        if not admitted:
+            return []
+        slots = free[:len(admitted)]
+
+        encoded = [self.hand._encode(line, style) for _, line, style, _, _, _ in admitted]
+        x_prime = np.zeros([len(admitted), max([len(x_p) for x_p, _ in encoded if x_p is not None] or [1]), 3])
+        x_prime_len = np.zeros([len(admitted)], dtype=np.int32)
+        for row, (i, (x_p, c_p), (request_id, line, style, bias, seed, cache_key)) in enumerate(
+                zip(slots, encoded, admitted)):
+            assert len(c_p) <= self.max_chars, 'line {} is longer than max_chars when encoded'.format(request_id)
+            if x_p is not None:
+                x_prime[row, :len(x_p)] = x_p
+                x_prime_len[row] = len(x_p)
+            self.chars[i] = 0
+            self.chars[i, :len(c_p)] = c_p
+            self.chars_len[i] = len(c_p)
+            self.biases[i] = bias
+            self.seeds[i] = seed
+            self.slots[i] = _Slot(request_id, line, style, bias, seed, [], 40 * len(line), cache_key)
+
+        state, outputs, terminated = self.nn.session.run(
+            [self.nn.slot_primed_state, self.nn.slot_primed_output, self.nn.slot_primed_finished],
+            feed_dict={
+                self.nn.x_prime: x_prime,
+                self.nn.x_prime_len: x_prime_len,
+                self.nn.slot_c: self.chars[slots],
+                self.nn.slot_c_len: self.chars_len[slots],
+                self.nn.slot_bias: self.biases[slots],
+                self.nn.slot_seeds: self.seeds[slots],
+            }
+        )
+        for values, primed_values in zip(self.state, state):
+            values[slots] = primed_values
+        # Unprimed lines start from a pen-up point at the origin, as in RNN.sample.
+        self.inputs[slots] = np.where(x_prime_len[:, np.newaxis] > 0, outputs, [0.0, 0.0, 1.0])
+        self.anchors[slots] = np.argmax(self.state[_PHI][slots], axis=1)
+        self.anchor_times[slots] = 0
+
+        return [self._release(i) for row, i in enumerate(slots) if terminated[row]]
+
+    def _release(self, i, stalled=False):
+        slot = self.slots[i]
+        self.slots[i] = None
+        strokes = np.array(slot.strokes, dtype=np.float32).reshape([-1, 3])
+        strokes = strokes[~np.all(strokes == 0.0, axis=1)]
+        if stalled:
+            logging.warning('sampling stalled on line {!r} (style {}, bias {}, seed {})'.format(
+                slot.line, slot.style, slot.bias, slot.seed))
+            self.hand.stalled.append((slot.line, slot.style, slot.bias, slot.seed))
+        elif slot.cache_key is not None:
+            self.hand.cache.put(slot.cache_key, strokes)
+        return slot.request_id, strokes
@@ -1,20 +1,49 @@
+import hashlib
 import logging
 import os
+import textwrap
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
+import tensorflow as tf
 
 from handwriting_synthesis import drawing
-from handwriting_synthesis.config import prediction_path, checkpoint_path, style_path
+from handwriting_synthesis.config import prediction_path, checkpoint_path, quantized_checkpoint_path, style_path
 from handwriting_synthesis.hand._draw import _draw
 from handwriting_synthesis.rnn import RNN
+from handwriting_synthesis.tf.factorization import factorized_ranks
 
 
 class Hand(object):
-    def __init__(self):
+    def __init__(self, precision='float32', quantized=False, checkpoint_dir=None, lstm_size=400,
+                 output_mixture_components=20, attention_mixture_components=10, ranks=None, weights=None,
+                 style_bank=None, cache=None, stall_tsteps=None):
+        """Loads the latest checkpoint for sampling.  precision is passed to RNN; 'bfloat16' runs the
+        matmuls in bfloat16, which is only faster on CPUs with native bfloat16 support and large matmuls.
+        With quantized, the int8 checkpoint written by training.quantize_checkpoint is loaded instead, to
+        measure the accuracy of int8 weights (they are dequantized for float32 matmuls).  checkpoint_dir and
+        the model sizes select another model, such as a student trained with training.distill.  ranks loads a
+        checkpoint written by training.factorize_checkpoint, and defaults to the ranks of the factorized
+        matrices found in the latest checkpoint in checkpoint_dir (tf.factorized_ranks).  weights (a dict mapping checkpoint variable
+        names to values, holding at least every trainable variable and every variable read by the sampler,
+        or ValueError is raised) are loaded instead of the checkpoint if given, and style_bank (a dict mapping
+        styles to their strokes and characters) replaces reading the styles from style_path, as in
+        SamplingPool.
+        cache (a StrokeCache) returns the strokes of seeded lines sampled before instead of sampling them
+        again.  With stall_tsteps, sampling of a line stops when its attention has not moved to the next
+        character for that many timesteps (a scribbling or runaway sample); such lines are logged, left out
+        of the cache and recorded in stalled as (line, style, bias, seed) tuples, so they can be retried
+        with another seed."""
+        if checkpoint_dir is None:
+            checkpoint_dir = quantized_checkpoint_path if quantized else checkpoint_path
         os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+        if ranks is None:
+            model_path = tf.train.latest_checkpoint(checkpoint_dir)
+            ranks = factorized_ranks(model_path) if model_path is not None else None
         self.nn = RNN(
             log_dir='logs',
-            checkpoint_dir=checkpoint_path,
+            checkpoint_dir=checkpoint_dir,
             prediction_dir=prediction_path,
             learning_rates=[.0001, .00005, .00002],
             batch_sizes=[32, 64, 64],
@@ -31,13 +60,111 @@ class Hand(object):
             log_interval=20,
             logging_level=logging.CRITICAL,
             grad_clip=10,
-            lstm_size=400,
-            output_mixture_components=20,
-            attention_mixture_components=10
+            lstm_size=lstm_size,
+            output_mixture_components=output_mixture_components,
+            attention_mixture_components=attention_mixture_components,
+            precision=precision,
+            quantized=quantized,
+            ranks=ranks
         )
-        self.nn.restore()
+        self.style_bank = style_bank if style_bank is not None else {}
+        self.cache = cache
+        self.stall_tsteps = stall_tsteps
+        self.stalled = []
+        self._fingerprint = None
+        if weights is None:
+            self.nn.restore()
+        else:
+            self.nn.session.run(self.nn.init)
+            required = self._sampler_variables() + self.nn.graph.get_collection('trainable_variables')
+            missing = sorted({var.op.name for var in required} - set(weights))
+            if missing:
+                raise ValueError('weights is missing model variables {}; check that quantized, ranks and the '
+                                 'model sizes match the checkpoint the weights were read from'.format(missing))
+            for var in self.nn.graph.get_collection('variables'):
+                if var.op.name in weights:
+                    var.load(weights[var.op.name], self.nn.session)
+
+    def write(self, filename, lines, biases=None, styles=None, stroke_colors=None, stroke_widths=None,
+              seeds=None, segment_length=None):
+        """Samples lines and draws them to filename.  With segment_length (at most 75), lines may be longer
+        than 75 characters: see _sample_segmented."""
+        if segment_length is None:
+            self._validate(lines)
+            strokes = self._sample(lines, biases=biases, styles=styles, seeds=seeds)
+        else:
+            strokes = self._sample_segmented(lines, biases=biases, styles=styles, seeds=seeds,
+                                             segment_length=segment_length)
+        _draw(strokes, lines, filename, stroke_colors=stroke_colors, stroke_widths=stroke_widths)
+
+    def write_many(self, jobs, max_batch_size=32, render_workers=0, render_processes=False, seed=None):
+        """Writes many documents, sampling the lines of all of them together.
+
+        jobs is an iterable of (filename, lines, biases, styles, stroke_colors, stroke_widths, seeds) tuples,
+        with the arguments of write; trailing entries may be omitted and default to None.  All lines are
+        sampled in document order, in shared batches of at most max_batch_size lines (see _sample_batches),
+        and each document is drawn from its own lines' strokes as soon as they have all been sampled.  Lines
+        of jobs without seeds are sampled with seed + n for the n-th line of all jobs if seed is given, so
+        the output is reproducible, and with random seeds otherwise.
+
+        With render_workers, documents are drawn and saved by a pool of that many threads (or processes,
+        with render_processes) while the next batches are sampled.  At most 2 * render_workers documents are
+        outstanding at a time, and write_many returns once all of them are saved, raising the first
+        rendering error.  Batches are the same either way, so render_workers does not change the output.
+        """
+        jobs = [tuple(job) + (None,) * (7 - len(job)) for job in jobs]
+        lines, biases, styles, seeds, line_jobs = [], [], [], [], []
+        for job_idx, (_, job_lines, job_biases, job_styles, _, _, job_seeds) in enumerate(jobs):
+            self._validate(job_lines)
+            if job_seeds is None and seed is not None:
+                job_seeds = [(seed + len(lines) + i) % np.iinfo(np.int32).max for i in range(len(job_lines))]
+            lines.extend(job_lines)
+            biases.extend(job_biases if job_biases is not None else [0.5] * len(job_lines))
+            styles.extend(job_styles if job_styles is not None else [None] * len(job_lines))
+            seeds.extend(job_seeds if job_seeds is not None else [None] * len(job_lines))
+            line_jobs.extend([job_idx] * len(job_lines))
+        seeds = seeds if any(line_seed is not None for line_seed in seeds) else None
+
+        starts = np.cumsum([0] + [len(job[1]) for job in jobs])
+        remaining = [len(job[1]) for job in jobs]
+        strokes = [None] * len(lines)
+
+        executor = None
+        if render_workers:
+            executor_class = ProcessPoolExecutor if render_processes else ThreadPoolExecutor
+            executor = executor_class(max_workers=render_workers)
+        pending = deque()
 
-    def write(self, filename, lines, biases=None, styles=None, stroke_colors=None, stroke_widths=None):
+        def render(job_idx):
+            filename, job_lines, _, _, stroke_colors, stroke_widths, _ = jobs[job_idx]
+            job_strokes = [strokes[i] for i in range(starts[job_idx], starts[job_idx] + len(job_lines))]
+            kwargs = dict(stroke_colors=stroke_colors, stroke_widths=stroke_widths)
+            if executor is None:
+                _draw(job_strokes, job_lines, filename, **kwargs)
+                return
+            pending.append(executor.submit(_draw, job_strokes, job_lines, filename, **kwargs))
+            while len(pending) > 2 * render_workers:
+                pending.popleft().result()
+
+        try:
+            for job_idx in [job_idx for job_idx, count in enumerate(remaining) if count == 0]:
+                render(job_idx)
+            batches = self._iter_sample_batches(
+                lines, biases, styles, max_batch_size=max_batch_size, seeds=seeds, sort_by_length=False)
+            for batch, samples in batches:
+                for i, sample in zip(batch, samples):
+                    strokes[i] = sample
+                    remaining[line_jobs[i]] -= 1
+                    if remaining[line_jobs[i]] == 0:
+                        render(line_jobs[i])
+            while pending:
+                pending.popleft().result()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    @staticmethod
+    def _validate(lines):
         valid_char_set = set(drawing.alphabet)
         for line_num, line in enumerate(lines):
             if len(line) > 75:
@@ -57,12 +184,67 @@ class Hand(object):
                         ).format(char, line_num, valid_char_set)
                     )
 
-        strokes = self._sample(lines, biases=biases, styles=styles)
-        _draw(strokes, lines, filename, stroke_colors=stroke_colors, stroke_widths=stroke_widths)
+    @property
+    def fingerprint(self):
+        """Hash of the precision and of the values of every variable read by the sampler, which identifies
+        the model in StrokeCache keys.  Computed on first use."""
+        if self._fingerprint is None:
+            sampler_variables = self._sampler_variables()
+            fingerprint = hashlib.sha1(self.nn.precision.encode('utf-8'))
+            for var, value in zip(sampler_variables, self.nn.session.run(sampler_variables)):
+                fingerprint.update(var.op.name.encode('utf-8'))
+                fingerprint.update(np.ascontiguousarray(value).tobytes())
+            self._fingerprint = fingerprint.hexdigest()
+        return self._fingerprint
+
+    def _sampler_variables(self):
+        """Returns the variables read by sampled_sequence, sorted by name."""
+        variables = {var.op: var for var in self.nn.graph.get_collection('variables')}
+        sampler_variables, visited, ops = [], set(), [self.nn.sampled_sequence.op]
+        while ops:
+            op = ops.pop()
+            if op in visited:
+                continue
+            visited.add(op)
+            if op in variables:
+                sampler_variables.append(variables[op])
+            ops.extend(tensor.op for tensor in op.inputs)
+            ops.extend(op.control_inputs)
+        return sorted(sampler_variables, key=lambda var: var.op.name)
+
+    def _sample(self, lines, biases=None, styles=None, seeds=None):
+        """Samples lines in one batch and returns their strokes.  With seeds (one int or None per line), each
+        line is sampled with its own seed, random for None, and seeded lines found in the cache are not
+        sampled again."""
+        if self.cache is None or seeds is None:
+            return self._sample_uncached(lines, biases=biases, styles=styles, seeds=seeds)[0]
 
-    def _sample(self, lines, biases=None, styles=None):
+        biases = biases if biases is not None else [0.5] * len(lines)
+        keys = [
+            self.cache.key(line, styles[i] if styles is not None else None, biases[i], seeds[i], self.fingerprint)
+            if seeds[i] is not None else None
+            for i, line in enumerate(lines)
+        ]
+        samples = [self.cache.get(key) if key is not None else None for key in keys]
+        misses = [i for i, sample in enumerate(samples) if sample is None]
+        if misses:
+            new_samples, stalled = self._sample_uncached(
+                [lines[i] for i in misses],
+                biases=[biases[i] for i in misses],
+                styles=[styles[i] for i in misses] if styles is not None else None,
+                seeds=[seeds[i] for i in misses]
+            )
+            for i, sample, sample_stalled in zip(misses, new_samples, stalled):
+                if keys[i] is not None and not sample_stalled:
+                    self.cache.put(keys[i], sample)
+                samples[i] = sample
+        return samples
+
+    def _sample_uncached(self, lines, biases=None, styles=None, seeds=None):
+        """Samples lines in one batch, and returns their strokes and whether each line stalled.  Every line
+        gets a budget of 40 timesteps per character of its own."""
         num_samples = len(lines)
-        max_tsteps = 40 * max([len(i) for i in lines])
+        row_tsteps = [40 * len(line) for line in lines]
         biases = biases if biases is not None else [0.5] * num_samples
 
         x_prime = np.zeros([num_samples, 1200, 3])
@@ -70,38 +252,136 @@ class Hand(object):
         chars = np.zeros([num_samples, 120])
         chars_len = np.zeros([num_samples])
 
-        if styles is not None:
-            for i, (cs, style) in enumerate(zip(lines, styles)):
-                x_p = np.load(f"{style_path}/style-{style}-strokes.npy")
-                c_p = np.load(f"{style_path}/style-{style}-chars.npy").tostring().decode('utf-8')
-
-                c_p = str(c_p) + " " + cs
-                c_p = drawing.encode_ascii(c_p)
-                c_p = np.array(c_p)
-
+        for i, line in enumerate(lines):
+            x_p, c_p = self._encode(line, styles[i] if styles is not None else None)
+            if x_p is not None:
                 x_prime[i, :len(x_p), :] = x_p
                 x_prime_len[i] = len(x_p)
-                chars[i, :len(c_p)] = c_p
-                chars_len[i] = len(c_p)
+            chars[i, :len(c_p)] = c_p
+            chars_len[i] = len(c_p)
 
-        else:
-            for i in range(num_samples):
-                encoded = drawing.encode_ascii(lines[i])
-                chars[i, :len(encoded)] = encoded
-                chars_len[i] = len(encoded)
-
-        [samples] = self.nn.session.run(
-            [self.nn.sampled_sequence],
-            feed_dict={
-                self.nn.prime: styles is not None,
-                self.nn.x_prime: x_prime,
-                self.nn.x_prime_len: x_prime_len,
-                self.nn.num_samples: num_samples,
-                self.nn.sample_tsteps: max_tsteps,
-                self.nn.c: chars,
-                self.nn.c_len: chars_len,
-                self.nn.bias: biases
-            }
-        )
+        feed_dict = {
+            self.nn.prime: styles is not None,
+            self.nn.x_prime: x_prime,
+            self.nn.x_prime_len: x_prime_len,
+            self.nn.num_samples: num_samples,
+            self.nn.sample_tsteps: max(row_tsteps),
+            self.nn.sample_row_tsteps: row_tsteps,
+            self.nn.stall_tsteps: self.stall_tsteps or 0,
+            self.nn.c: chars,
+            self.nn.c_len: chars_len,
+            self.nn.bias: biases
+        }
+        if seeds is not None:
+            seeds = [seed if seed is not None else np.random.randint(np.iinfo(np.int32).max) for seed in seeds]
+            feed_dict[self.nn.seeds] = seeds
+        samples, stalled = self.nn.session.run([self.nn.sampled_sequence, self.nn.stalled], feed_dict=feed_dict)
         samples = [sample[~np.all(sample == 0.0, axis=1)] for sample in samples]
-        return samples
+
+        for i in np.flatnonzero(stalled):
+            style = styles[i] if styles is not None else None
+            seed = seeds[i] if seeds is not None else None
+            logging.warning('sampling stalled on line {!r} (style {}, bias {}, seed {})'.format(
+                lines[i], style, biases[i], seed))
+            self.stalled.append((lines[i], style, biases[i], seed))
+        return samples, stalled
+
+    def _sample_segmented(self, lines, biases=None, styles=None, seeds=None, segment_length=40):
+        """Samples lines of any length by splitting lines longer than segment_length characters at word
+        boundaries, and returns their strokes.
+
+        The segments of all lines are sampled together as the rows of one batch, each with the style and
+        bias of its line, so that no row runs the long sampling chain (and attention over many characters)
+        of a whole long line.  The first segment of a line gets the line's seed and later segments get seeds
+        drawn from it.  The strokes of each line are then stitched from those of its segments, with their
+        baselines aligned (drawing.stitch).
+        """
+        assert 0 < segment_length <= 75, 'segment_length must be between 1 and 75'
+        biases = biases if biases is not None else [0.5] * len(lines)
+        segments, segment_lines, segment_seeds = [], [], []
+        for i, line in enumerate(lines):
+            parts = [line]
+            if len(line) > segment_length:
+                parts = textwrap.wrap(line, segment_length, break_long_words=False) or ['']
+            line_seeds = [seeds[i] if seeds is not None else None] * len(parts)
+            if len(parts) > 1 and line_seeds[0] is not None:
+                random_state = np.random.RandomState(line_seeds[0])
+                line_seeds[1:] = random_state.randint(np.iinfo(np.int32).max, size=len(parts) - 1).tolist()
+            segments.extend(parts)
+            segment_lines.extend([i] * len(parts))
+            segment_seeds.extend(line_seeds)
+        self._validate(segments)
+
+        samples = self._sample(
+            segments,
+            biases=[biases[i] for i in segment_lines],
+            styles=[styles[i] for i in segment_lines] if styles is not None else None,
+            seeds=segment_seeds if seeds is not None else None
+        )
+
+        strokes = []
+        for i in range(len(lines)):
+            rows = [k for k, line_idx in enumerate(segment_lines) if line_idx == i]
+            if len(rows) == 1:
+                strokes.append(samples[rows[0]])
+            else:
+                strokes.append(drawing.stitch([samples[k] for k in rows], [segments[k] for k in rows]))
+        return strokes
+
+    def _sample_batches(self, lines, biases=None, styles=None, max_batch_size=32, seeds=None):
+        """Samples lines with _sample in batches of at most max_batch_size and returns their strokes in order.
+
+        styles may mix styled lines and None; since _sample primes either every line of a batch or none,
+        styled and unstyled lines are sampled in separate batches.  Lines are batched in order of length, so
+        that short lines do not wait for the 40 timesteps per character budget of much longer ones.  With
+        seeds (one int or None per line), each line is sampled with its own seed, as in _sample.
+        """
+        strokes = [None] * len(lines)
+        for batch, samples in self._iter_sample_batches(lines, biases, styles, max_batch_size, seeds):
+            for i, sample in zip(batch, samples):
+                strokes[i] = sample
+        return strokes
+
+    def _iter_sample_batches(self, lines, biases=None, styles=None, max_batch_size=32, seeds=None,
+                             sort_by_length=True):
+        """Samples lines as _sample_batches does, yielding the indices of the lines of each batch and their
+        strokes as each batch finishes.  Without sort_by_length, lines are batched in their given order."""
+        biases = biases if biases is not None else [0.5] * len(lines)
+        styles = styles if styles is not None else [None] * len(lines)
+        for primed in (False, True):
+            indices = [i for i, style in enumerate(styles) if (style is not None) == primed]
+            if sort_by_length:
+                indices.sort(key=lambda i: len(lines[i]))
+            for start in range(0, len(indices), max_batch_size):
+                batch = indices[start:start + max_batch_size]
+                yield batch, self._sample(
+                    [lines[i] for i in batch],
+                    biases=[biases[i] for i in batch],
+                    styles=[styles[i] for i in batch] if primed else None,
+                    seeds=[seeds[i] for i in batch] if seeds is not None else None
+                )
+
+    def _encode(self, line, style=None):
+        """Returns the priming strokes of style (None without a style) and the encoded characters to sample,
+        which are the style's characters followed by line when priming."""
+        if style is None:
+            return None, np.array(drawing.encode_ascii(line))
+        x_p, c_p = self._style(style)
+        return x_p, np.array(drawing.encode_ascii(str(c_p) + " " + line))
+
+    def _has_style(self, style):
+        """Whether style is in the style bank or in style_path."""
+        return style in self.style_bank or os.path.exists(f"{style_path}/style-{style}-strokes.npy")
+
+    def _style(self, style):
+        """Returns the priming strokes and characters of style, read from style_path once."""
+        if style not in self.style_bank:
+            self.style_bank[style] = load_style(style)
+        return self.style_bank[style]
+
+
+def load_style(style):
+    """Reads the priming strokes and characters of style from style_path."""
+    x_p = np.load(f"{style_path}/style-{style}-strokes.npy")
+    c_p = np.load(f"{style_path}/style-{style}-chars.npy").tostring().decode('utf-8')
+    return x_p, c_p
@@ -0,0 +1,118 @@
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+
+_Submission = namedtuple('_Submission', ['lines', 'biases', 'styles', 'seeds', 'future'])
+
+
+class HandExecutor(object):
+    """Thread-safe front end of a Hand: any thread can submit lines and gets a Future of their strokes.
+
+    A single dispatcher thread owns the Hand.  It takes the oldest pending submission, then every
+    submission waiting or arriving within batch_window seconds, up to max_batch_size lines, and samples
+    all their lines together with Hand._sample_batches.  Each future then receives the strokes of its own
+    lines, in order, as returned by Hand._sample.  Submissions whose future was cancelled before
+    dispatch are skipped.
+
+    Usage:
+
+        with HandExecutor(hand) as executor:
+            future = executor.submit(lines, styles=styles, biases=biases)
+            strokes = future.result()
+
+    Args:
+        hand: Hand to sample with.  It must not be used by other threads while the executor runs.
+        max_batch_size: Maximum number of lines per sampler call.
+        batch_window: Seconds to wait for more submissions after the first one before sampling.
+    """
+
+    def __init__(self, hand, max_batch_size=32, batch_window=0.0):
+        self.hand = hand
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.queue = queue.Queue()
+        self.shutdown_lock = threading.Lock()
+        self.is_shutdown = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, lines, styles=None, biases=None, seeds=None):
+        """Queues lines for sampling and returns a concurrent.futures.Future of their list of strokes.
+
+        With seeds (one int or None per line), lines are sampled reproducibly, and served from the Hand's
+        cache if it has one.  Invalid lines raise ValueError here, in the calling thread.
+        """
+        self.hand._validate(lines)
+        biases = biases if biases is not None else [0.5] * len(lines)
+        assert len(biases) == len(lines), 'biases must have one entry per line'
+        assert styles is None or len(styles) == len(lines), 'styles must have one entry per line'
+        assert seeds is None or len(seeds) == len(lines), 'seeds must have one entry per line'
+
+        future = Future()
+        with self.shutdown_lock:
+            if self.is_shutdown:
+                raise RuntimeError('cannot submit after shutdown')
+            self.queue.put(_Submission(list(lines), list(biases), styles, seeds, future))
+        return future
+
+    def shutdown(self, wait=True):
+        """Stops accepting submissions.  Pending submissions are still sampled."""
+        with self.shutdown_lock:
+            if not self.is_shutdown:
+                self.is_shutdown = True
+                self.queue.put(None)
+        if wait:
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown(wait=True)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            submission = self.queue.get()
+            if submission is None:
+                break
+            submissions = [submission]
+            num_lines = len(submission.lines)
+            window_end = time.time() + self.batch_window
+            while num_lines < self.max_batch_size:
+                timeout = window_end - time.time()
+                try:
+                    submission = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if submission is None:
+                    stopping = True
+                    break
+                submissions.append(submission)
+                num_lines += len(submission.lines)
+
+            self._dispatch([s for s in submissions if s.future.set_running_or_notify_cancel()])
+
+    def _dispatch(self, submissions):
+        if not submissions:
+            return
+        lines = [line for s in submissions for line in s.lines]
+        biases = [bias for s in submissions for bias in s.biases]
+        styles = [style for s in submissions for style in (s.styles or [None] * len(s.lines))]
+        seeds = [seed for s in submissions for seed in (s.seeds or [None] * len(s.lines))]
+        try:
+            strokes = self.hand._sample_batches(
+                lines, biases, styles, max_batch_size=self.max_batch_size, seeds=seeds)
+        except Exception as error:
+            logging.exception('sampling failed')
+            for s in submissions:
+                s.future.set_exception(error)
+            return
+
+        start = 0
+        for s in submissions:
+            s.future.set_result(strokes[start:start + len(s.lines)])
+            start += len(s.lines)
@@ -0,0 +1,127 @@
+import textwrap
+
+import numpy as np
+
+from handwriting_synthesis.hand.Hand import Hand
+from handwriting_synthesis.hand._draw import _drawing
+
+_PAGE_GAP = 40
+
+
+class Handwrite(object):
+    """Writes documents of any length with a Hand, page by page.
+
+    Text is split into paragraphs at blank lines, and every paragraph is wrapped with textwrap.wrap into
+    lines of at most line_width characters, with a blank line between paragraphs.  The lines are split
+    into pages of lines_per_page lines, and each page is sampled (in batches of at most max_batch_size
+    lines), drawn and written before the next one is sampled, so only one page of strokes is held at a time
+    and peak memory does not depend on the length of the document.
+
+    Pages are written to separate SVG files when filename contains a {} placeholder, which is formatted
+    with the page number (from 1), and otherwise to a single SVG holding all pages one below the other.
+
+    Usage:
+
+        writer = Handwrite(hand, line_width=60, lines_per_page=25)
+        writer.write('img/letter-{:03d}.svg', text, style=9, bias=0.75, seed=1234)
+
+    Args:
+        hand: Hand to sample with.  Defaults to Hand().
+        line_width: Maximum number of characters per line, at most 75.
+        lines_per_page: Number of lines per page.
+        max_batch_size: Maximum number of lines per sampler call.
+    """
+
+    def __init__(self, hand=None, line_width=60, lines_per_page=25, max_batch_size=32):
+        assert 0 < line_width <= 75, 'line_width must be between 1 and 75'
+        self.hand = hand if hand is not None else Hand()
+        self.line_width = line_width
+        self.lines_per_page = lines_per_page
+        self.max_batch_size = max_batch_size
+
+    def wrap(self, text):
+        """Returns the lines of text, wrapped to line_width characters, with '' between paragraphs."""
+        lines = []
+        for paragraph in text.split('\n\n'):
+            paragraph_lines = textwrap.wrap(' '.join(paragraph.split()), self.line_width)
+            if paragraph_lines:
+                if lines:
+                    lines.append('')
+                lines.extend(paragraph_lines)
+        return lines
+
+    def pages(self, text):
+        """Returns the lines of every page of text."""
+        lines = self.wrap(text)
+        return [lines[start:start + self.lines_per_page] for start in range(0, len(lines), self.lines_per_page)]
+
+    def write(self, filename, text, style=None, bias=0.5, seed=None, stroke_color='black', stroke_width=2):
+        """Writes text and returns the names of the files written.
+
+        Every line is sampled with style and bias.  With seed, the n-th line of the document is sampled
+        with seed + n, so a document is reproducible and its lines can be served from the Hand's cache.
+        """
+        pages = self.pages(text)
+        self.hand._validate([line for page in pages for line in page])
+
+        if '{' in filename:
+            filenames = []
+            for page_num, (page, page_strokes) in enumerate(self._sample_pages(pages, style, bias, seed)):
+                page_filename = filename.format(page_num + 1)
+                self._page_drawing(page, page_strokes, stroke_color, stroke_width, page_filename).save()
+                filenames.append(page_filename)
+            return filenames
+
+        heights = [self._page_height(page) for page in pages]
+        view_height = sum(heights) + _PAGE_GAP * max(len(pages) - 1, 0)
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(
+                '<?xml version="1.0" encoding="utf-8" ?>\n'
+                '<svg baseProfile="full" height="100%" version="1.1" viewBox="0,0,1000,{}" width="100%" '
+                'xmlns="http://www.w3.org/2000/svg" xmlns:ev="http://www.w3.org/2001/xml-events" '
+                'xmlns:xlink="http://www.w3.org/1999/xlink">'.format(view_height)
+            )
+            y = 0
+            for page, page_strokes in self._sample_pages(pages, style, bias, seed):
+                dwg = self._page_drawing(page, page_strokes, stroke_color, stroke_width)
+                dwg.update({'x': 0, 'y': y, 'width': 1000, 'height': self._page_height(page)})
+                f.write(dwg.tostring())
+                f.flush()
+                y += self._page_height(page) + _PAGE_GAP
+            f.write('</svg>\n')
+        return [filename]
+
+    def _sample_pages(self, pages, style, bias, seed):
+        """Yields every page with the strokes of its lines, sampling one page at a time."""
+        start = 0
+        for page in pages:
+            indices = [i for i, line in enumerate(page) if line]
+            strokes = [np.zeros([0, 3], dtype=np.float32)] * len(page)
+            if indices:
+                seeds = [(seed + start + i) % np.iinfo(np.int32).max for i in indices] if seed is not None else None
+                samples = self.hand._sample_batches(
+                    [page[i] for i in indices],
+                    biases=[bias] * len(indices),
+                    styles=[style] * len(indices),
+                    max_batch_size=self.max_batch_size,
+                    seeds=seeds
+                )
+                for i, sample in zip(indices, samples):
+                    strokes[i] = sample
+            start += len(page)
+            yield page, strokes
+
+    @staticmethod
+    def _page_height(page):
+        # As in _drawing.
+        return 60 * (len(page) + 1)
+
+    @staticmethod
+    def _page_drawing(page, strokes, stroke_color, stroke_width, filename='noname.svg'):
+        return _drawing(
+            strokes,
+            page,
+            filename=filename,
+            stroke_colors=[stroke_color] * len(page),
+            stroke_widths=[stroke_width] * len(page)
+        )
@@ -0,0 +1,139 @@
+import glob
+import multiprocessing
+import os
+import re
+from multiprocessing import shared_memory
+
+import numpy as np
+import tensorflow as tf
+import tensorflow.compat.v1 as tfcompat
+
+from handwriting_synthesis.config import checkpoint_path, quantized_checkpoint_path, style_path
+from handwriting_synthesis.hand.Hand import Hand, load_style
+
+tfcompat.disable_v2_behavior()
+
+# State of a pool worker process, set by _init_worker.
+_worker_hand = None
+
+
+class SamplingPool(object):
+    """Samples lines in several processes, each with its own Hand, for bulk generation on all cores.
+
+    This is a process pool with a single checkpoint read, not a pool sharing its weights.  The checkpoint is
+    read once, in the parent, into a shared memory block, and the style bank is read once and pickled to
+    every worker.  Each worker still builds its own graph and copies the weights from the shared block
+    into its own variables, after which the block is no longer read, so every process holds a full graph
+    and a private copy of the weights and the style bank.  Workers are started with the spawn method, since
+    a TensorFlow runtime does not survive fork.
+
+    Lines are split into chunks of chunk_size lines, in order, which are sampled by whichever worker is
+    free, and results are returned in the order of the lines.  Every line is sampled with its own seed
+    (see LSTMAttentionCell), and the chunks depend only on chunk_size, so the same lines and seeds give the
+    same strokes for any number of processes.
+
+    Usage:
+
+        with SamplingPool(processes=8) as pool:
+            strokes = pool.sample(lines, biases=biases, styles=styles, seeds=range(len(lines)))
+
+    Args:
+        processes: Number of worker processes.  Defaults to the number of cores.
+        chunk_size: Number of lines sampled per worker call, which is also the maximum sampler batch size.
+        hand_kwargs: Passed to Hand in every worker, e.g. precision or checkpoint_dir.  A cache is copied
+            into every worker with an empty memory tier, so workers share only its cache_dir.
+    """
+
+    def __init__(self, processes=None, chunk_size=32, **hand_kwargs):
+        self.processes = processes or os.cpu_count()
+        self.chunk_size = chunk_size
+
+        checkpoint_dir = hand_kwargs.get('checkpoint_dir') or (
+            quantized_checkpoint_path if hand_kwargs.get('quantized') else checkpoint_path)
+        model_path = tf.train.latest_checkpoint(checkpoint_dir)
+        assert model_path is not None, 'no checkpoint found in {}'.format(checkpoint_dir)
+        reader = tfcompat.train.load_checkpoint(model_path)
+        weights = {name: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()}
+
+        layout, offset = [], 0
+        for name, value in sorted(weights.items()):
+            value = np.asarray(value)
+            layout.append((name, value.dtype.str, value.shape, offset))
+            offset += value.nbytes
+        self.shared_weights = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for name, dtype, shape, offset in layout:
+            np.ndarray(shape, dtype=dtype, buffer=self.shared_weights.buf, offset=offset)[...] = weights[name]
+
+        self.pool = multiprocessing.get_context('spawn').Pool(
+            self.processes,
+            initializer=_init_worker,
+            initargs=(self.shared_weights.name, layout, load_style_bank(), hand_kwargs)
+        )
+
+    def imap(self, lines, biases=None, styles=None, seeds=None):
+        """Yields the strokes of every line, in order, as their chunks finish.
+
+        seeds defaults to random seeds; pass seeds (one int per line) for reproducible results.
+        """
+        biases = list(biases) if biases is not None else [0.5] * len(lines)
+        styles = list(styles) if styles is not None else [None] * len(lines)
+        seeds = list(seeds) if seeds is not None else list(
+            np.random.randint(np.iinfo(np.int32).max, size=len(lines)))
+        Hand._validate(lines)
+
+        chunks = [
+            (lines[start:start + self.chunk_size], biases[start:start + self.chunk_size],
+             styles[start:start + self.chunk_size], seeds[start:start + self.chunk_size])
+            for start in range(0, len(lines), self.chunk_size)
+        ]
+        for strokes in self.pool.imap(_sample_chunk, chunks):
+            for line_strokes in strokes:
+                yield line_strokes
+
+    def sample(self, lines, biases=None, styles=None, seeds=None):
+        """Returns the strokes of every line, in order.  Arguments are as in imap."""
+        return list(self.imap(lines, biases=biases, styles=styles, seeds=seeds))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.shared_weights.close()
+            self.shared_weights.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_style_bank():
+    """Reads every style in style_path, as a dict mapping style to (strokes, characters)."""
+    styles = set()
+    for filename in glob.glob(os.path.join(style_path, 'style-*-strokes.npy')):
+        match = re.match(r'style-(\d+)-strokes\.npy', os.path.basename(filename))
+        if match:
+            styles.add(int(match.group(1)))
+    return {style: load_style(style) for style in sorted(styles)}
+
+
+def _init_worker(shared_weights_name, layout, style_bank, hand_kwargs):
+    global _worker_hand
+    shared_weights = shared_memory.SharedMemory(name=shared_weights_name)
+    weights = {
+        name: np.ndarray(shape, dtype=dtype, buffer=shared_weights.buf, offset=offset)
+        for name, dtype, shape, offset in layout
+    }
+    _worker_hand = Hand(weights=weights, style_bank=style_bank, **hand_kwargs)
+    # The values were copied into the worker's variables; the shared block is only read at startup.
+    del weights
+    shared_weights.close()
+
+
+def _sample_chunk(chunk):
+    lines, biases, styles, seeds = chunk
+    # The style bank is keyed by int.
+    styles = [int(style) if style is not None else None for style in styles]
+    return _worker_hand._sample_batches(lines, biases, styles, max_batch_size=len(lines), seeds=seeds)
@@ -0,0 +1,163 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class StrokeCache(object):
+    """Cache of sampled strokes, for lines requested again with the same text, style, bias and seed.
+
+    A line is only reproducible with a seed, so Hand only caches seeded lines.  Entries are keyed by
+    (line, style, bias, seed, fingerprint), where fingerprint identifies the model (see Hand.fingerprint),
+    and hold the strokes as returned by Hand._sample.
+
+    The memory tier keeps the max_entries most recently used entries.  With cache_dir, entries are also
+    written there as .npy files, which are read back on a memory miss and survive restarts.  When the files
+    exceed max_disk_bytes, the least recently used files (by modification time, which is updated on every
+    read) are deleted until they fit in 90% of it.  Several processes can share a cache_dir (as the workers
+    of a SamplingPool do); each one then evicts by its own estimate of the disk usage.
+
+    Args:
+        max_entries: Maximum number of entries in memory.
+        cache_dir: Directory of the disk tier, created if needed.  None keeps the cache in memory only.
+        max_disk_bytes: Maximum total size of the files in cache_dir.
+    """
+
+    def __init__(self, max_entries=4096, cache_dir=None, max_disk_bytes=256 << 20):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_bytes = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.disk_bytes = sum(size for _, size, _ in self._disk_entries())
+
+    @staticmethod
+    def key(line, style, bias, seed, fingerprint):
+        """Returns the key of a line sampled with style, bias and seed by the model with fingerprint."""
+        style = int(style) if style is not None else None
+        description = repr((line, style, float(bias), int(seed), fingerprint))
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns a copy of the strokes cached under key, or None."""
+        with self.lock:
+            strokes = self.entries.get(key)
+            if strokes is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return strokes.copy()
+        strokes = self._read(key)
+        with self.lock:
+            if strokes is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, strokes)
+        return strokes.copy()
+
+    def put(self, key, strokes):
+        """Caches strokes under key."""
+        strokes = np.array(strokes, dtype=np.float32)
+        with self.lock:
+            self._remember(key, strokes)
+        if self.cache_dir is not None:
+            self._write(key, strokes)
+
+    def clear(self):
+        """Removes every entry, from memory and from cache_dir."""
+        with self.lock:
+            self.entries.clear()
+            if self.cache_dir is not None:
+                for path, _, _ in self._disk_entries():
+                    self._remove(path)
+                self.disk_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getstate__(self):
+        # Copies (e.g. in SamplingPool workers) share the disk tier but start with an empty memory tier.
+        state = self.__dict__.copy()
+        state.update(entries=OrderedDict(), lock=None, hits=0, misses=0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _remember(self, key, strokes):
+        self.entries[key] = strokes
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def _read(self, key):
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            strokes = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return strokes
+
+    def _write(self, key, strokes):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        # Written to a temporary file and renamed, so readers never see a partial file.
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, strokes)
+            os.replace(tmp_path, path)
+        except OSError:
+            logging.exception('could not write {}'.format(path))
+            self._remove(tmp_path)
+            return
+        with self.lock:
+            self.disk_bytes += os.path.getsize(path)
+            if self.disk_bytes > self.max_disk_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        self.disk_bytes = sum(size for _, size, _ in entries)
+        target = 0.9 * self.max_disk_bytes
+        for path, size, _ in entries:
+            if self.disk_bytes <= target:
+                break
+            self._remove(path)
+            self.disk_bytes -= size
+
+    def _disk_entries(self):
+        """Returns (path, size, modification time) of every cached file."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
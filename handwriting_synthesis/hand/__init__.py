@@ -1 +1,7 @@
 from .Hand import Hand
+from .ContinuousSampler import ContinuousSampler
+from .HandExecutor import HandExecutor
+from .SamplingPool import SamplingPool
+from .server import HandServer, serve
+from .StrokeCache import StrokeCache
+from .Handwrite import Handwrite
@@ -5,36 +5,51 @@ from handwriting_synthesis import drawing
 
 
 def _draw(strokes, lines, filename, stroke_colors=None, stroke_widths=None):
+    _drawing(strokes, lines, filename, stroke_colors=stroke_colors, stroke_widths=stroke_widths).save()
+
+
+def _drawing(strokes, lines, filename='noname.svg', stroke_colors=None, stroke_widths=None):
+    """Builds the svgwrite.Drawing of _draw without saving it, e.g. to serialize it with tostring()."""
     stroke_colors = stroke_colors or ['black'] * len(lines)
     stroke_widths = stroke_widths or [2] * len(lines)
 
     line_height = 60
-    view_width = 1000
     view_height = line_height * (len(strokes) + 1)
 
+    line_coords = []
+    for offsets, line in zip(strokes, lines):
+        if not line:
+            line_coords.append(None)
+            continue
+
+        offsets = np.concatenate([offsets[:, :2] * 1.5, offsets[:, 2:]], axis=1)
+        coords = drawing.offsets_to_coords(offsets)
+        coords = drawing.denoise(coords)
+        coords[:, :2] = drawing.align(coords[:, :2])
+        coords[:, 1] *= -1
+        line_coords.append(coords)
+
+    # Lines stitched from several segments (see Hand.write) can be wider than the default view.
+    widths = [np.ptp(coords[:, 0]) for coords in line_coords if coords is not None]
+    view_width = max([1000] + [width + 100 for width in widths])
+
     dwg = svgwrite.Drawing(filename=filename)
     dwg.viewbox(width=view_width, height=view_height)
     dwg.add(dwg.rect(insert=(0, 0), size=(view_width, view_height), fill='white'))
 
     initial_coord = np.array([0, -(3 * line_height / 4)])
-    for offsets, line, color, width in zip(strokes, lines, stroke_colors, stroke_widths):
+    for coords, color, width in zip(line_coords, stroke_colors, stroke_widths):
 
-        if not line:
+        if coords is None:
             initial_coord[1] -= line_height
             continue
 
-        offsets[:, :2] *= 1.5
-        strokes = drawing.offsets_to_coords(offsets)
-        strokes = drawing.denoise(strokes)
-        strokes[:, :2] = drawing.align(strokes[:, :2])
-
-        strokes[:, 1] *= -1
-        strokes[:, :2] -= strokes[:, :2].min() + initial_coord
-        strokes[:, 0] += (view_width - strokes[:, 0].max()) / 2
+        coords[:, :2] -= coords[:, :2].min() + initial_coord
+        coords[:, 0] += (view_width - coords[:, 0].max()) / 2
 
         prev_eos = 1.0
         p = "M{},{} ".format(0, 0)
-        for x, y, eos in zip(*strokes.T):
+        for x, y, eos in zip(*coords.T):
             p += '{}{},{} '.format('M' if prev_eos == 1.0 else 'L', x, y)
             prev_eos = eos
         path = svgwrite.path.Path(p)
@@ -43,4 +58,4 @@ def _draw(strokes, lines, filename, stroke_colors=None, stroke_widths=None):
 
         initial_coord[1] -= line_height
 
-    dwg.save()
+    return dwg
@@ -0,0 +1,274 @@
+import asyncio
+import functools
+import json
+import logging
+import math
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from handwriting_synthesis.hand._draw import _drawing
+
+_Job = namedtuple('_Job', ['lines', 'biases', 'styles', 'seeds', 'deadline', 'future'])
+
+
+class HandServer(object):
+    """Asyncio HTTP server sampling handwriting with a Hand, batching lines across requests.
+
+    Requests wait in a bounded queue, and a single batching task takes the first waiting request and
+    then every request arriving within batch_window seconds, up to max_batch_size lines, and samples
+    all their lines with Hand._sample_batches.  Sampling runs on a dedicated thread, so the event loop
+    keeps accepting requests meanwhile.
+
+    When the queue is full, requests are rejected with 429 Too Many Requests.  Every request has a
+    deadline (its "deadline" field in seconds, or deadline), after which it gets 504 Gateway Timeout and
+    its lines are dropped if they have not been sampled yet.
+
+    Endpoints:
+
+        POST /generate  JSON body {"lines": [...], "biases": [...], "styles": [...], "seeds": [...],
+                        "format": "svg" or "strokes", "stroke_colors": [...], "stroke_widths": [...],
+                        "deadline": seconds}.  Only lines is required; lines with a seed are sampled
+                        reproducibly, and served from the Hand's cache if it has one.  Responds with
+                        the SVG drawn as by Hand.write, or with JSON {"strokes": [...]} holding the
+                        [x offset, y offset, end of stroke] points of every line.  Invalid requests
+                        get 400 Bad Request before they are queued, so they never fail a shared batch.
+        GET /health     JSON {"queued": number of waiting requests}.
+
+    The server speaks a minimal subset of HTTP/1.1 (one request per connection) and binds to localhost by
+    default; it is meant to sit behind a reverse proxy or to be called from the same machine.
+
+    Args:
+        hand: Hand to sample with.
+        host: Interface to listen on.
+        port: Port to listen on.
+        max_batch_size: Maximum number of lines per sampler call.
+        batch_window: Seconds to wait for more requests after the first one before sampling.
+        max_queue_size: Maximum number of waiting requests.
+        deadline: Default request deadline in seconds.
+        max_body_size: Maximum request body size in bytes.
+    """
+
+    def __init__(self, hand, host='127.0.0.1', port=8000, max_batch_size=32, batch_window=0.02,
+                 max_queue_size=64, deadline=30.0, max_body_size=1 << 20):
+        self.hand = hand
+        self.host = host
+        self.port = port
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.max_queue_size = max_queue_size
+        self.deadline = deadline
+        self.max_body_size = max_body_size
+        self.queue = None
+        self.server = None
+        self.batcher = None
+        # TensorFlow sampling is kept on one thread; session.run releases the GIL.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.batcher = asyncio.get_running_loop().create_task(self._batch_loop())
+        logging.info('serving on {}:{}'.format(self.host, self.port))
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if self.batcher is not None:
+            self.batcher.cancel()
+            self.batcher = None
+        # Waits for the batch being sampled without blocking the event loop.
+        await asyncio.get_running_loop().run_in_executor(None, functools.partial(self.executor.shutdown, wait=True))
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                method, path, body = await self._read_request(reader)
+            except (ValueError, asyncio.IncompleteReadError) as error:
+                status, content_type, content = self._error(HTTPStatus.BAD_REQUEST, str(error))
+            else:
+                try:
+                    if path == '/generate' and method == 'POST':
+                        status, content_type, content = await self._generate(body)
+                    elif path == '/health' and method == 'GET':
+                        status, content_type, content = HTTPStatus.OK, 'application/json', json.dumps(
+                            {'queued': self.queue.qsize()}).encode()
+                    else:
+                        status, content_type, content = self._error(HTTPStatus.NOT_FOUND, 'not found')
+                except Exception as error:
+                    # E.g. drawing the SVG failed; the client still gets a response.
+                    logging.exception('request failed')
+                    status, content_type, content = self._error(
+                        HTTPStatus.INTERNAL_SERVER_ERROR, '{}: {}'.format(type(error).__name__, error))
+            writer.write(self._response(status, content_type, content))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise ValueError('malformed request line')
+        method, path, _ = request_line
+
+        content_length = 0
+        while True:
+            header = (await reader.readline()).decode('latin-1').strip()
+            if not header:
+                break
+            name, _, value = header.partition(':')
+            if name.strip().lower() == 'content-length':
+                content_length = int(value)
+        if content_length > self.max_body_size:
+            raise ValueError('request body larger than {} bytes'.format(self.max_body_size))
+        body = await reader.readexactly(content_length) if content_length else b''
+        return method, path.split('?')[0], body
+
+    async def _generate(self, body):
+        loop = asyncio.get_running_loop()
+        try:
+            request = json.loads(body)
+            lines = request['lines']
+            assert isinstance(lines, list) and lines, 'lines must be a non-empty list'
+            biases = request.get('biases') or [0.5] * len(lines)
+            styles = request.get('styles')
+            seeds = request.get('seeds')
+            assert isinstance(biases, list) and len(biases) == len(lines), 'biases must have one entry per line'
+            assert all(_is_number(bias) and math.isfinite(bias) for bias in biases), 'biases must be numbers'
+            assert styles is None or isinstance(styles, list) and len(styles) == len(lines), \
+                'styles must have one entry per line'
+            for style in styles or []:
+                assert style is None or _is_int(style) and self.hand._has_style(style), \
+                    'unknown style {!r}'.format(style)
+            assert seeds is None or len(seeds) == len(lines), 'seeds must have one entry per line'
+            assert all(seed is None or _is_int(seed) and 0 <= seed < 2 ** 31 for seed in seeds or []), \
+                'seeds must be integers in [0, 2**31)'
+            for name in ('stroke_colors', 'stroke_widths'):
+                values = request.get(name)
+                assert values is None or isinstance(values, list) and len(values) == len(lines), \
+                    '{} must have one entry per line'.format(name)
+            output_format = request.get('format', 'svg')
+            assert output_format in ('svg', 'strokes'), 'format must be svg or strokes'
+            timeout = float(request.get('deadline', self.deadline))
+            assert timeout > 0, 'deadline must be positive'
+            self.hand._validate(lines)
+        except (ValueError, KeyError, TypeError, AssertionError) as error:
+            return self._error(HTTPStatus.BAD_REQUEST, str(error))
+
+        deadline = loop.time() + timeout
+        job = _Job(lines, biases, styles, seeds, deadline, loop.create_future())
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            return self._error(HTTPStatus.TOO_MANY_REQUESTS, 'queue is full')
+
+        try:
+            strokes = await asyncio.wait_for(asyncio.shield(job.future), timeout=deadline - loop.time())
+        except asyncio.TimeoutError:
+            job.future.cancel()
+            return self._error(HTTPStatus.GATEWAY_TIMEOUT, 'deadline exceeded')
+        except Exception as error:
+            logging.exception('sampling failed')
+            return self._error(HTTPStatus.INTERNAL_SERVER_ERROR, '{}: {}'.format(type(error).__name__, error))
+
+        if output_format == 'strokes':
+            content = json.dumps({'strokes': [line_strokes.tolist() for line_strokes in strokes]})
+            return HTTPStatus.OK, 'application/json', content.encode()
+        svg = await loop.run_in_executor(
+            None,
+            lambda: _drawing(
+                strokes,
+                lines,
+                stroke_colors=request.get('stroke_colors'),
+                stroke_widths=request.get('stroke_widths')
+            ).tostring()
+        )
+        return HTTPStatus.OK, 'image/svg+xml', svg.encode()
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [await self.queue.get()]
+            num_lines = len(jobs[0].lines)
+            window_end = loop.time() + self.batch_window
+            while num_lines < self.max_batch_size and loop.time() < window_end:
+                try:
+                    job = await asyncio.wait_for(self.queue.get(), timeout=window_end - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                jobs.append(job)
+                num_lines += len(job.lines)
+
+            # Requests past their deadline have already been answered.
+            jobs = [job for job in jobs if not job.future.done() and job.deadline > loop.time()]
+            if jobs:
+                await self._run_batch(jobs)
+
+    async def _run_batch(self, jobs):
+        lines = [line for job in jobs for line in job.lines]
+        biases = [bias for job in jobs for bias in job.biases]
+        styles = [style for job in jobs for style in (job.styles or [None] * len(job.lines))]
+        seeds = [seed for job in jobs for seed in (job.seeds or [None] * len(job.lines))]
+        try:
+            strokes = await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                lambda: self.hand._sample_batches(
+                    lines, biases, styles, max_batch_size=self.max_batch_size, seeds=seeds)
+            )
+        except Exception as error:
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_exception(error)
+            return
+
+        start = 0
+        for job in jobs:
+            if not job.future.done():
+                job.future.set_result(strokes[start:start + len(job.lines)])
+            start += len(job.lines)
+
+    @staticmethod
+    def _error(status, message):
+        return status, 'application/json', json.dumps({'error': message}).encode()
+
+    @staticmethod
+    def _response(status, content_type, content):
+        headers = [
+            'HTTP/1.1 {} {}'.format(status.value, status.phrase),
+            'Content-Type: {}'.format(content_type),
+            'Content-Length: {}'.format(len(content)),
+            'Connection: close',
+        ]
+        if status == HTTPStatus.TOO_MANY_REQUESTS:
+            headers.append('Retry-After: 1')
+        return ('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + content
+
+
+def _is_int(value):
+    # json decodes true and false to bool, which is an int subclass.
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_number(value):
+    return _is_int(value) or isinstance(value, float)
+
+
+def serve(hand=None, **kwargs):
+    """Runs a HandServer until interrupted.  kwargs are passed to HandServer; hand defaults to Hand()."""
+    if hand is None:
+        from handwriting_synthesis.hand.Hand import Hand
+        hand = Hand()
+    asyncio.run(HandServer(hand, **kwargs).serve_forever())
@@ -0,0 +1,151 @@
+import numpy as np
+import tensorflow as tf
+import tensorflow.compat.v1 as tfcompat
+
+from handwriting_synthesis import drawing
+from handwriting_synthesis.rnn.LSTMAttentionCell import LSTMAttentionCell
+from handwriting_synthesis.rnn.RNN import RNN
+from handwriting_synthesis.tf.utils import local_variable_getter, time_distributed_dense_layer
+
+tfcompat.disable_v2_behavior()
+
+
+class DistilledRNN(RNN):
+    """Student RNN trained to match a restored teacher RNN (knowledge distillation).
+
+    The teacher is built in the same graph under the 'teacher' scope, with its own architecture, and runs
+    teacher-forced on the same batches as the student.  Its variables are local and non-trainable and are
+    initialized from teacher_checkpoint, so the student's checkpoints contain only the student and load
+    into an RNN (or Hand) with the student's configuration.
+
+    The loss is data_weight * (NLL of the data) + (1 - data_weight) * (distillation term) +
+    attention_weight * (mean squared difference of the attention windows).  The distillation term is
+    estimated with num_distillation_samples points drawn from the teacher's mixture at every timestep:
+
+        'kl': KL(teacher || student), the student's NLL of the samples minus the teacher's.
+        'nll': the student's NLL of the samples, i.e. the cross entropy to the teacher.
+
+    Both have the same gradient; 'kl' is zero when the student matches the teacher.  The NLL of the data,
+    the distillation term and the attention term are logged as metrics, and early stopping uses the NLL.
+
+    Args:
+        teacher_checkpoint: Path of the teacher checkpoint (e.g. tf.train.latest_checkpoint(checkpoint_path)).
+        teacher_lstm_size: lstm_size of the teacher.
+        teacher_output_mixture_components: output_mixture_components of the teacher.
+        teacher_attention_mixture_components: attention_mixture_components of the teacher.
+        objective: 'kl' or 'nll'.
+        data_weight: Weight of the NLL of the data in the loss.
+        attention_weight: Weight of the attention matching term.
+        num_distillation_samples: Number of teacher samples per timestep.
+        kwargs: Passed to RNN, and define the student.
+    """
+
+    def __init__(
+            self,
+            teacher_checkpoint,
+            teacher_lstm_size=400,
+            teacher_output_mixture_components=20,
+            teacher_attention_mixture_components=10,
+            objective='kl',
+            data_weight=0.5,
+            attention_weight=1.0,
+            num_distillation_samples=4,
+            **kwargs
+    ):
+        assert objective in ('kl', 'nll'), 'objective must be kl or nll'
+        # The teacher's state would have to be carried across chunks as well.
+        assert not kwargs.get('tbptt_steps'), 'tbptt_steps is not supported with distillation'
+        self.teacher_checkpoint = teacher_checkpoint
+        self.teacher_lstm_size = teacher_lstm_size
+        self.teacher_output_mixture_components = teacher_output_mixture_components
+        self.teacher_attention_mixture_components = teacher_attention_mixture_components
+        self.objective = objective
+        self.data_weight = data_weight
+        self.attention_weight = attention_weight
+        self.num_distillation_samples = num_distillation_samples
+        self.teacher_params = None
+        self.teacher_window = None
+        kwargs['emit_window'] = True
+        super(DistilledRNN, self).__init__(**kwargs)
+
+    def calculate_loss(self):
+        data_nll = super(DistilledRNN, self).calculate_loss()
+        self.build_teacher()
+
+        sequence_mask = tf.sequence_mask(self.x_len, maxlen=tf.shape(self.x)[1], dtype=tf.float32)
+        num_valid = tf.maximum(tf.reduce_sum(sequence_mask), 1.0)
+
+        samples = tf.stop_gradient(self.sample_mixture(self.teacher_params, self.num_distillation_samples))
+        distillation = self.step_nll(samples, self.output_params)
+        if self.objective == 'kl':
+            distillation -= self.step_nll(samples, self.teacher_params)
+        distillation = tf.reduce_sum(tf.reduce_mean(distillation, axis=0) * sequence_mask) / num_valid
+
+        window_error = tf.reduce_sum(tf.square(self.attention_window - self.teacher_window), axis=2)
+        attention = tf.reduce_sum(window_error * sequence_mask) / num_valid
+
+        self.metrics['nll'] = data_nll
+        self.metrics['distillation'] = distillation
+        self.metrics['attention'] = attention
+        self.early_stopping_metric = 'nll'
+
+        self.loss = (
+            self.data_weight * data_nll
+            + (1 - self.data_weight) * distillation
+            + self.attention_weight * attention
+        )
+        return self.loss
+
+    def build_teacher(self):
+        """Builds the teacher on self.x and initializes its variables from teacher_checkpoint."""
+        with tfcompat.variable_scope('teacher', custom_getter=local_variable_getter):
+            cell = LSTMAttentionCell(
+                lstm_size=self.teacher_lstm_size,
+                num_attn_mixture_components=self.teacher_attention_mixture_components,
+                attention_values=tf.one_hot(self.c, len(drawing.alphabet)),
+                attention_values_lengths=self.c_len,
+                num_output_mixture_components=self.teacher_output_mixture_components,
+                bias=self.bias,
+                emit_window=True
+            )
+            outputs, _ = tfcompat.nn.dynamic_rnn(
+                inputs=self.x,
+                cell=cell,
+                sequence_length=self.x_len,
+                dtype=tf.float32,
+                initial_state=cell.zero_state(tf.shape(self.x)[0], dtype=tf.float32),
+                scope='rnn'
+            )
+            outputs, self.teacher_window = tf.split(outputs, [self.teacher_lstm_size, len(drawing.alphabet)], axis=2)
+            self.teacher_params = time_distributed_dense_layer(
+                outputs, 6 * self.teacher_output_mixture_components + 1, scope='rnn/gmm')
+        self.teacher_params = tf.stop_gradient(self.teacher_params)
+        self.teacher_window = tf.stop_gradient(self.teacher_window)
+        tfcompat.train.init_from_checkpoint(self.teacher_checkpoint, {'rnn/': 'teacher/rnn/'})
+
+    def sample_mixture(self, z, num_samples, eps=1e-8, sigma_eps=1e-4):
+        """Draws num_samples points from the mixture of every timestep of the raw output layer z.
+
+        Returns a tensor of shape [num_samples] + shape(z)[:-1] + [3].
+        """
+        pis, log_sigmas, rhos, mus, es = self.split_parameters(z)
+        num_components = (z.shape.as_list()[-1] - 1) // 6
+        sample_shape = tf.concat([[num_samples], tf.shape(z)[:-1]], axis=0)
+
+        logits = tf.reshape(tf.tile(tf.expand_dims(pis, 0), [num_samples, 1, 1, 1]), [-1, num_components])
+        idx = tf.reshape(tfcompat.random.categorical(logits, 1), sample_shape)
+        component = tf.one_hot(idx, num_components)
+
+        def select(params):
+            return tf.reduce_sum(component * tf.expand_dims(params, 0), axis=-1)
+
+        log_sigma_1, log_sigma_2 = tf.split(tf.maximum(log_sigmas, np.log(sigma_eps)), 2, axis=-1)
+        mu_1, mu_2 = tf.split(mus, 2, axis=-1)
+        rho = tf.clip_by_value(tf.tanh(select(rhos)), eps - 1.0, 1.0 - eps)
+        noise_1 = tf.random.normal(sample_shape)
+        noise_2 = tf.random.normal(sample_shape)
+
+        y_1 = select(mu_1) + tf.exp(select(log_sigma_1)) * noise_1
+        y_2 = select(mu_2) + tf.exp(select(log_sigma_2)) * (rho * noise_1 + tf.sqrt(1 - tf.square(rho)) * noise_2)
+        y_3 = tf.cast(tf.random.uniform(sample_shape) < tf.nn.sigmoid(tf.squeeze(es, axis=-1)), tf.float32)
+        return tf.stack([y_1, y_2, y_3], axis=-1)
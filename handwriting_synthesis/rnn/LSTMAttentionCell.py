@@ -6,7 +6,7 @@ import tensorflow.compat.v1 as tfcompat
 import tensorflow.compat.v1.distributions as tfd
 import tensorflow_probability as tfp
 
-from handwriting_synthesis.tf.utils import dense_layer, shape
+from handwriting_synthesis.tf.utils import dense_layer, hashed_uniform, shape, weight_matmul
 
 tfcompat.disable_v2_behavior()
 
@@ -20,6 +20,25 @@ LSTMAttentionCellState = namedtuple(
 
 
 class LSTMAttentionCell(tfcompat.nn.rnn_cell.RNNCell):
+    """Three stacked LSTMs with a gaussian attention window over the one-hot characters in attention_values.
+
+    With a reduced precision low_precision_dtype (tf.bfloat16 or tf.float16), the LSTM, attention and gmm
+    matmuls are computed in that dtype, reading float32 master weights, and their results are cast back to
+    float32.  The LSTM gates, the cell states, the attention window (alpha, beta, kappa, phi, w) and the
+    mixture parameters stay in float32, so the state and outputs are float32 either way.
+
+    ranks optionally maps the names of the weight scopes ('lstm_cell', 'lstm_cell_1', 'lstm_cell_2',
+    'attention' and 'gmm') to a rank, and those weight matrices are factorized to that rank (tf.weight_matmul),
+    replacing one matmul by two smaller ones.
+
+    With seeds (an int32 tensor of shape [batch_size]), output_function samples from counter-based random
+    numbers (tf.hashed_uniform) keyed by each row's seed and the timestep, so a row's samples depend only on
+    its own seed and inputs, and not on the rest of the batch.  Without seeds it uses stateful random ops.
+
+    With emit_window, the output at each timestep is the top LSTM's output concatenated with the attention
+    window w, so the per-timestep attention is available from tf.nn.dynamic_rnn.
+    """
+
     def __init__(
             self,
             lstm_size,
@@ -29,8 +48,16 @@ class LSTMAttentionCell(tfcompat.nn.rnn_cell.RNNCell):
             num_output_mixture_components,
             bias,
             reuse=None,
+            low_precision_dtype=None,
+            emit_window=False,
+            ranks=None,
+            seeds=None,
     ):
         self.reuse = reuse
+        self.low_precision_dtype = low_precision_dtype
+        self.emit_window = emit_window
+        self.ranks = ranks or {}
+        self.seeds = seeds
         self.lstm_size = lstm_size
         self.num_attn_mixture_components = num_attn_mixture_components
         self.attention_values = attention_values
@@ -60,7 +87,7 @@ class LSTMAttentionCell(tfcompat.nn.rnn_cell.RNNCell):
 
     @property
     def output_size(self):
-        return self.lstm_size
+        return self.lstm_size + self.window_size if self.emit_window else self.lstm_size
 
     def zero_state(self, batch_size, dtype):
         return LSTMAttentionCellState(
@@ -81,12 +108,17 @@ class LSTMAttentionCell(tfcompat.nn.rnn_cell.RNNCell):
         with tfcompat.variable_scope(scope or type(self).__name__, reuse=tfcompat.AUTO_REUSE):
             # lstm 1
             s1_in = tf.concat([state.w, inputs], axis=1)
-            cell1 = tfcompat.nn.rnn_cell.LSTMCell(self.lstm_size)
-            s1_out, s1_state = cell1(s1_in, state=(state.c1, state.h1))
+            s1_out, s1_c = self._lstm(s1_in, state.c1, state.h1, scope='lstm_cell')
 
             # attention
             attention_inputs = tf.concat([state.w, inputs, s1_out], axis=1)
-            attention_params = dense_layer(attention_inputs, 3 * self.num_attn_mixture_components, scope='attention')
+            attention_params = dense_layer(
+                attention_inputs,
+                3 * self.num_attn_mixture_components,
+                scope='attention',
+                compute_dtype=self.low_precision_dtype,
+                rank=self.ranks.get('attention')
+            )
             alpha, beta, kappa = tf.split(tf.nn.softplus(attention_params), 3, axis=1)
             kappa = state.kappa + kappa / 25.0
             beta = tf.clip_by_value(beta, .01, np.inf)
@@ -105,21 +137,19 @@ class LSTMAttentionCell(tfcompat.nn.rnn_cell.RNNCell):
 
             # lstm 2
             s2_in = tf.concat([inputs, s1_out, w], axis=1)
-            cell2 = tfcompat.nn.rnn_cell.LSTMCell(self.lstm_size)
-            s2_out, s2_state = cell2(s2_in, state=(state.c2, state.h2))
+            s2_out, s2_c = self._lstm(s2_in, state.c2, state.h2, scope='lstm_cell_1')
 
             # lstm 3
             s3_in = tf.concat([inputs, s2_out, w], axis=1)
-            cell3 = tfcompat.nn.rnn_cell.LSTMCell(self.lstm_size)
-            s3_out, s3_state = cell3(s3_in, state=(state.c3, state.h3))
+            s3_out, s3_c = self._lstm(s3_in, state.c3, state.h3, scope='lstm_cell_2')
 
             new_state = LSTMAttentionCellState(
-                s1_state.h,
-                s1_state.c,
-                s2_state.h,
-                s2_state.c,
-                s3_state.h,
-                s3_state.c,
+                s1_out,
+                s1_c,
+                s2_out,
+                s2_c,
+                s3_out,
+                s3_c,
                 alpha_flat,
                 beta_flat,
                 kappa_flat,
@@ -127,11 +157,50 @@ class LSTMAttentionCell(tfcompat.nn.rnn_cell.RNNCell):
                 phi_flat,
             )
 
+            if self.emit_window:
+                return tf.concat([s3_out, w], axis=1), new_state
             return s3_out, new_state
 
-    def output_function(self, state):
-        params = dense_layer(state.h3, self.output_units, scope='gmm', reuse=tfcompat.AUTO_REUSE)
+    def _lstm(self, inputs, c, h, scope):
+        """One step of an LSTM layer.
+
+        Equivalent to tf.nn.rnn_cell.LSTMCell with forget_bias=1.0 and uses the same variable names, so
+        checkpoints written with either can be restored.  Returns the new output and cell state.
+        """
+        with tfcompat.variable_scope(scope):
+            # Only the matmul runs in low_precision_dtype; its result, the gates and the state are float32.
+            z = weight_matmul(
+                tf.concat([inputs, h], axis=1),
+                4 * self.lstm_size,
+                name='kernel',
+                rank=self.ranks.get(scope),
+                compute_dtype=self.low_precision_dtype
+            )
+            bias = tfcompat.get_variable('bias', shape=[4 * self.lstm_size], initializer=tfcompat.zeros_initializer())
+        z = tf.nn.bias_add(z, bias)
+        i, j, f, o = tf.split(z, 4, axis=1)
+
+        c = tf.sigmoid(f + 1.0) * c + tf.sigmoid(i) * tf.tanh(j)
+        h = tf.sigmoid(o) * tf.tanh(c)
+        return h, c
+
+    def output_function(self, state, time=None, stream=0):
+        """Samples the next [x offset, y offset, end of stroke] input from the output mixture of state.
+
+        With seeds, time (a scalar or [batch_size] int32 tensor) and stream select the random numbers,
+        and different streams give independent samples from the same state.
+        """
+        params = dense_layer(
+            state.h3,
+            self.output_units,
+            scope='gmm',
+            reuse=tfcompat.AUTO_REUSE,
+            compute_dtype=self.low_precision_dtype,
+            rank=self.ranks.get('gmm')
+        )
         pis, mus, sigmas, rhos, es = self._parse_parameters(params)
+        if self.seeds is not None:
+            return self._seeded_sample(pis, mus, sigmas, rhos, es, time, stream)
         mu1, mu2 = tf.split(mus, 2, axis=1)
         mus = tf.stack([mu1, mu2], axis=2)
         sigma1, sigma2 = tf.split(sigmas, 2, axis=1)
@@ -153,11 +222,40 @@ class LSTMAttentionCell(tfcompat.nn.rnn_cell.RNNCell):
         coords = tf.gather_nd(sampled_coords, idx)
         return tf.concat([coords, tf.cast(sampled_e, tf.float32)], axis=1)
 
-    def termination_condition(self, state):
+    def _seeded_sample(self, pis, mus, sigmas, rhos, es, time, stream):
+        u_component, u_radius, u_angle, u_eos = tf.unstack(hashed_uniform(self.seeds, time, 4, 4 * stream), axis=1)
+
+        # Inverse CDF of the mixture weights, which do not sum to one after thresholding.
+        cdf = tf.cumsum(pis, axis=1)
+        below = tf.cast(cdf < tf.expand_dims(u_component * cdf[:, -1], 1), tf.int32)
+        idx = tf.minimum(tf.reduce_sum(below, axis=1), self.num_output_mixture_components - 1)
+        component = tf.one_hot(idx, self.num_output_mixture_components)
+
+        def select(params):
+            return tf.reduce_sum(component * params, axis=1)
+
+        mu1, mu2 = tf.split(mus, 2, axis=1)
+        sigma1, sigma2 = tf.split(sigmas, 2, axis=1)
+        mu1, mu2, sigma1, sigma2, rho = select(mu1), select(mu2), select(sigma1), select(sigma2), select(rhos)
+
+        # Box-Muller transform.
+        radius = tf.sqrt(-2.0 * tf.math.log(u_radius))
+        z1 = radius * tf.cos(2 * np.pi * u_angle)
+        z2 = radius * tf.sin(2 * np.pi * u_angle)
+        x = mu1 + sigma1 * z1
+        y = mu2 + sigma2 * (rho * z1 + tf.sqrt(1 - tf.square(rho)) * z2)
+        e = tf.cast(u_eos < es[:, 0], tf.float32)
+        return tf.stack([x, y, e], axis=1)
+
+    def attention_position(self, state):
+        """Returns the index of the character the attention window is on, as in termination_condition."""
+        return tf.cast(tf.argmax(state.phi, axis=1), tf.int32)
+
+    def termination_condition(self, state, time=None):
         char_idx = tf.cast(tf.argmax(state.phi, axis=1), tf.int32)
         final_char = char_idx >= self.attention_values_lengths - 1
         past_final_char = char_idx >= self.attention_values_lengths
-        output = self.output_function(state)
+        output = self.output_function(state, time, stream=1)
         es = tf.cast(output[:, 2], tf.int32)
         is_eos = tf.equal(es, tf.experimental.numpy.ones_like(es))
         return tf.logical_or(tf.logical_and(final_char, is_eos), past_final_char)
@@ -5,20 +5,60 @@ import tensorflow as tf
 import tensorflow.compat.v1 as tfcompat
 
 from handwriting_synthesis import drawing
-from handwriting_synthesis.rnn import LSTMAttentionCell
+from handwriting_synthesis.rnn.LSTMAttentionCell import LSTMAttentionCell, LSTMAttentionCellState
 from handwriting_synthesis.rnn.operations import rnn_free_run
 from handwriting_synthesis.tf import BaseModel
-from handwriting_synthesis.tf.utils import time_distributed_dense_layer
+from handwriting_synthesis.tf.quantization import QuantizedWeightGetter
+from handwriting_synthesis.tf.utils import shape, time_distributed_dense_layer
 
 tfcompat.disable_v2_behavior()
 
 
 class RNN(BaseModel):
+    """Handwriting synthesis network (Graves, 2013): three stacked LSTMs with a gaussian attention window
+    over the characters, followed by a mixture density output layer.
+
+    Args:
+        lstm_size: Number of units in each of the three LSTM layers.
+        output_mixture_components: Number of bivariate gaussians in the output mixture.
+        attention_mixture_components: Number of gaussians in the attention window.
+        tbptt_steps: If set, training batches are split into chunks of tbptt_steps timesteps, with the final
+            cell state of a chunk fed as the initial state of the next (truncated backpropagation through
+            time).  This bounds activation memory by the chunk length instead of the longest sequence in the
+            batch.  The clipped gradients of the chunks are accumulated and their mean is applied in a single
+            update per training step, averaged over the chunks of all gradient_accumulation_steps batches,
+            so global_step and the optimizer state advance once per training step as without tbptt_steps.
+        loss_function: 'log_space' (default) computes the mixture density NLL with log_nll, 'legacy' with
+            parse_parameters and nll.
+        precision: 'float32' (default), 'bfloat16' or 'float16'.  With reduced precision, the LSTM and dense
+            layer matmuls run in that dtype on float32 master weights, while the LSTM gates, cell states,
+            attention window, mixture parameters and loss stay in float32.  Checkpoints are float32
+            regardless of precision.  float16 training uses dynamic loss scaling unless loss_scale is given.
+            This is not a general speedup: float16 is emulated on CPUs and runs about 10x slower than float32,
+            and bfloat16 only pays off when the matmuls are large enough to outweigh the casts around them
+            (see training.benchmark_precision).
+        quantized: If true, the LSTM kernels and the attention and gmm weights are stored as per-channel int8
+            (tf.QuantizedWeightGetter) and dequantized once per session.run, for sampling from a checkpoint
+            converted with training.quantize_checkpoint.  This emulates int8 accuracy; the matmuls still run
+            in float32.  Only the biases remain trainable.
+        emit_window: If true, the attention window at each timestep of the training unroll is kept in
+            self.attention_window ([batch_size, max_len, alphabet size]).
+        ranks: Optional dict mapping 'lstm_cell', 'lstm_cell_1', 'lstm_cell_2', 'attention' and 'gmm' to the
+            rank their weight matrix is factorized to (see LSTMAttentionCell), for sampling from a checkpoint
+            converted with training.factorize_checkpoint.
+    """
+
     def __init__(
             self,
             lstm_size,
             output_mixture_components,
             attention_mixture_components,
+            tbptt_steps=None,
+            loss_function='log_space',
+            precision='float32',
+            quantized=False,
+            emit_window=False,
+            ranks=None,
             **kwargs
     ):
         self.x = None
@@ -27,20 +67,84 @@ class RNN(BaseModel):
         self.c = None
         self.c_len = None
         self.sample_tsteps = None
+        self.sample_row_tsteps = None
+        self.stall_tsteps = None
         self.num_samples = None
         self.prime = None
         self.x_prime = None
         self.x_prime_len = None
         self.bias = None
+        self.seeds = None
         self.initial_state = None
         self.final_state = None
         self.sampled_sequence = None
+        self.stalled = None
+        self.output_params = None
+        self.attention_window = None
+        self.slot_c = None
+        self.slot_c_len = None
+        self.slot_bias = None
+        self.slot_input = None
+        self.slot_seeds = None
+        self.slot_time = None
+        self.slot_state = None
+        self.slot_primed_state = None
+        self.slot_primed_output = None
+        self.slot_primed_finished = None
+        self.slot_output = None
+        self.slot_finished = None
+        self.slot_next_state = None
         self.lstm_size = lstm_size
         self.output_mixture_components = output_mixture_components
         self.output_units = self.output_mixture_components * 6 + 1
         self.attention_mixture_components = attention_mixture_components
+        self.tbptt_steps = tbptt_steps
+        assert loss_function in ('log_space', 'legacy'), 'loss_function must be log_space or legacy'
+        self.loss_function = loss_function
+        assert precision in ('float32', 'bfloat16', 'float16'), 'precision must be float32, bfloat16 or float16'
+        self.precision = precision
+        self.low_precision_dtype = None if precision == 'float32' else tf.as_dtype(precision)
+        self.quantized = quantized
+        self.emit_window = emit_window
+        self.ranks = ranks or {}
+        if precision == 'float16' and kwargs.get('loss_scale') is None:
+            # float16 gradients underflow without scaling; bfloat16 has the exponent range of float32.
+            kwargs['loss_scale'] = 'dynamic'
+        # Workers would disagree on the number of chunks per batch and fall out of step.
+        assert not (tbptt_steps and kwargs.get('allreduce')), 'tbptt_steps is not supported with allreduce'
         super(RNN, self).__init__(**kwargs)
 
+    def train_step(self, feed_dict):
+        if not self.tbptt_steps:
+            return super(RNN, self).train_step(feed_dict)
+
+        x, y, x_len = feed_dict[self.x], feed_dict[self.y], feed_dict[self.x_len]
+        state = None
+        total_loss, total_steps = 0.0, 0
+        for start in range(0, x.shape[1], self.tbptt_steps):
+            end = start + self.tbptt_steps
+            chunk_len = np.clip(x_len - start, 0, self.tbptt_steps)
+            if not np.any(chunk_len):
+                # Only padding is left, which would add zero gradients to the mean.
+                break
+            chunk_feed_dict = dict(feed_dict)
+            chunk_feed_dict.update({self.x: x[:, start:end], self.y: y[:, start:end], self.x_len: chunk_len})
+            if state is not None:
+                chunk_feed_dict[self.initial_state] = state
+
+            # Only accumulates the chunk's gradients; fit applies them with apply_accumulated_gradients.
+            loss, state = self.run_update(chunk_feed_dict, [self.loss, self.final_state])
+            # Weight each chunk by its number of valid timesteps to recover the per-timestep NLL of the batch.
+            total_loss += loss * np.sum(chunk_len)
+            total_steps += np.sum(chunk_len)
+        return total_loss / max(total_steps, 1)
+
+    def accumulates_gradients(self):
+        return bool(self.tbptt_steps) or super(RNN, self).accumulates_gradients()
+
+    def batch_lengths(self, feed_dict):
+        return feed_dict[self.x_len], feed_dict[self.x].shape[1]
+
     def parse_parameters(self, z, eps=1e-8, sigma_eps=1e-4):
         pis, sigmas, rhos, mus, es = tf.split(
             z,
@@ -89,19 +193,75 @@ class RNN(BaseModel):
         element_loss = tf.reduce_sum(nll) / tf.maximum(tf.reduce_sum(num_valid), 1.0)
         return sequence_loss, element_loss
 
+    @staticmethod
+    def split_parameters(z):
+        """Splits the raw output layer z into mixture weight logits, log sigmas, rho logits, mus and the
+        end-of-stroke logit.  The number of mixture components is inferred from the size of z."""
+        num_components = (shape(z, -1) - 1) // 6
+        return tf.split(z, [num_components, 2 * num_components, num_components, 2 * num_components, 1], axis=-1)
+
+    def step_nll(self, y, z, sigma_eps=1e-4, max_rho_logit=10.0):
+        """Mixture density NLL of each timestep, computed from the raw output layer z entirely in log space.
+
+        Mixture weights go through log_softmax, the components are combined with logsumexp and the
+        end-of-stroke term uses softplus on the logit, so no density is exponentiated, clipped or NaN-masked.
+        log(1 - rho^2) is computed from the rho logit x as 2 * (log 2 - |x| - softplus(-2|x|)), since
+        1 - tanh(x)^2 rounds to 0 in float32 for |x| above about 9; the logit is clipped at max_rho_logit so
+        its inverse stays finite.  y may have extra leading dimensions, which are broadcast against z.
+        """
+        pis, log_sigmas, rho_logits, mus, es = self.split_parameters(z)
+        log_pis = tf.nn.log_softmax(pis, axis=-1)
+        log_sigma_1, log_sigma_2 = tf.split(tf.maximum(log_sigmas, np.log(sigma_eps)), 2, axis=-1)
+        rho_logits = tf.clip_by_value(rho_logits, -max_rho_logit, max_rho_logit)
+        rhos = tf.tanh(rho_logits)
+        abs_rho_logits = tf.abs(rho_logits)
+        log_one_minus_rho_sq = 2 * (np.log(2.0) - abs_rho_logits - tf.nn.softplus(-2 * abs_rho_logits))
+        mu_1, mu_2 = tf.split(mus, 2, axis=-1)
+        y_1, y_2, y_3 = tf.split(y, 3, axis=-1)
+
+        d_1 = (y_1 - mu_1) * tf.exp(-log_sigma_1)
+        d_2 = (y_2 - mu_2) * tf.exp(-log_sigma_2)
+        log_gaussians = (
+            -np.log(2 * np.pi) - log_sigma_1 - log_sigma_2 - 0.5 * log_one_minus_rho_sq
+            - 0.5 * (tf.square(d_1) + tf.square(d_2) - 2 * rhos * d_1 * d_2) * tf.exp(-log_one_minus_rho_sq)
+        )
+        gmm_nll = -tf.reduce_logsumexp(log_pis + log_gaussians, axis=-1)
+        # -log(sigmoid(e)) if the stroke ends, -log(1 - sigmoid(e)) otherwise.
+        bernoulli_nll = tf.nn.softplus(tf.squeeze(es * (1 - 2 * y_3), axis=-1))
+        return gmm_nll + bernoulli_nll
+
+    def log_nll(self, y, lengths, z):
+        """Mixture density NLL computed from the raw output layer z entirely in log space.
+
+        The unclipped, numerically stable equivalent of parse_parameters followed by nll, computed with
+        step_nll.  The two agree wherever the legacy loss is well behaved.  They differ where nll clips the
+        mixture likelihood at 1e-8, or drops timesteps whose NLL is NaN from the loss and from the count of
+        valid timesteps; log_nll keeps every unmasked timestep, and its NLL stays finite even with saturated
+        rho or sigma logits.
+        """
+        sequence_mask = tf.sequence_mask(lengths, maxlen=tf.shape(y)[1], dtype=tf.float32)
+        nll = self.step_nll(y, z) * sequence_mask
+        num_valid = tf.reduce_sum(sequence_mask, axis=1)
+
+        sequence_loss = tf.reduce_sum(nll, axis=1) / tf.maximum(num_valid, 1.0)
+        element_loss = tf.reduce_sum(nll) / tf.maximum(tf.reduce_sum(num_valid), 1.0)
+        return sequence_loss, element_loss
+
     def sample(self, cell):
         initial_state = cell.zero_state(self.num_samples, dtype=tf.float32)
         initial_input = tf.concat([
             tf.zeros([self.num_samples, 2]),
             tf.ones([self.num_samples, 1]),
         ], axis=1)
-        return rnn_free_run(
+        _, outputs, _, stalled = rnn_free_run(
             cell=cell,
-            sequence_length=self.sample_tsteps,
+            sequence_length=self.sample_row_tsteps,
             initial_state=initial_state,
             initial_input=initial_input,
+            stall_tsteps=self.stall_tsteps,
             scope='rnn'
-        )[1]
+        )
+        return outputs, stalled
 
     def primed_sample(self, cell):
         initial_state = cell.zero_state(self.num_samples, dtype=tf.float32)
@@ -113,12 +273,24 @@ class RNN(BaseModel):
             initial_state=initial_state,
             scope='rnn'
         )[1]
-        return rnn_free_run(
+        with tfcompat.variable_scope('rnn', reuse=True):
+            primed_input = cell.output_function(primed_state, 0)
+        # Rows without priming start from a pen-up point at the origin, as in sample, so their points do not
+        # depend on whether other rows of the batch are primed.
+        initial_input = tf.where(
+            tf.tile(self.x_prime_len[:, tf.newaxis] > 0, [1, 3]),
+            primed_input,
+            tf.tile([[0.0, 0.0, 1.0]], [self.num_samples, 1])
+        )
+        _, outputs, _, stalled = rnn_free_run(
             cell=cell,
-            sequence_length=self.sample_tsteps,
+            sequence_length=self.sample_row_tsteps,
             initial_state=primed_state,
+            initial_input=initial_input,
+            stall_tsteps=self.stall_tsteps,
             scope='rnn'
-        )[1]
+        )
+        return outputs, stalled
 
     def calculate_loss(self):
         self.x = tfcompat.placeholder(tf.float32, [None, None, 3])
@@ -129,36 +301,107 @@ class RNN(BaseModel):
 
         self.sample_tsteps = tfcompat.placeholder(tf.int32, [])
         self.num_samples = tfcompat.placeholder(tf.int32, [])
+        # Per-sample step budgets (sample_tsteps for every sample by default), and the number of steps
+        # without attention progress after which a sample is stopped and flagged in stalled (0 disables it).
+        self.sample_row_tsteps = tfcompat.placeholder_with_default(
+            tf.fill([self.num_samples], self.sample_tsteps), [None])
+        self.stall_tsteps = tfcompat.placeholder_with_default(0, [])
         self.prime = tfcompat.placeholder(tf.bool, [])
         self.x_prime = tfcompat.placeholder(tf.float32, [None, None, 3])
         self.x_prime_len = tfcompat.placeholder(tf.int32, [None])
         self.bias = tfcompat.placeholder_with_default(
             tf.zeros([self.num_samples], dtype=tf.float32), [None])
+        self.seeds = tfcompat.placeholder_with_default(
+            tf.random.uniform([self.num_samples], maxval=tf.int32.max, dtype=tf.int32), [None])
+
+        custom_getter = None
+        if self.quantized:
+            custom_getter = QuantizedWeightGetter(dtype=self.low_precision_dtype or tf.float32)
+        with tfcompat.variable_scope(tfcompat.get_variable_scope(), custom_getter=custom_getter):
+            cell = self.build_cell(self.c, self.c_len, self.bias, emit_window=self.emit_window, seeds=self.seeds)
+            self.initial_state = cell.zero_state(tf.shape(self.x)[0], dtype=tf.float32)
+            outputs, self.final_state = tfcompat.nn.dynamic_rnn(
+                inputs=self.x,
+                cell=cell,
+                sequence_length=self.x_len,
+                dtype=tf.float32,
+                initial_state=self.initial_state,
+                scope='rnn'
+            )
+            if self.emit_window:
+                outputs, self.attention_window = tf.split(outputs, [self.lstm_size, len(drawing.alphabet)], axis=2)
+            params = time_distributed_dense_layer(
+                outputs,
+                self.output_units,
+                scope='rnn/gmm',
+                compute_dtype=self.low_precision_dtype,
+                rank=self.ranks.get('gmm')
+            )
+            self.output_params = params
+            if self.loss_function == 'legacy':
+                pis, mus, sigmas, rhos, es = self.parse_parameters(params)
+                sequence_loss, self.loss = self.nll(self.y, self.x_len, pis, mus, sigmas, rhos, es)
+            else:
+                sequence_loss, self.loss = self.log_nll(self.y, self.x_len, params)
+
+            self.sampled_sequence, self.stalled = tf.cond(
+                self.prime,
+                lambda: self.primed_sample(cell),
+                lambda: self.sample(cell)
+            )
+            self.build_slot_sampler()
+        return self.loss
 
-        cell = LSTMAttentionCell(
+    def build_cell(self, chars, chars_len, bias, emit_window=False, seeds=None):
+        """Returns an LSTMAttentionCell of this model attending over the encoded characters chars."""
+        return LSTMAttentionCell(
             lstm_size=self.lstm_size,
             num_attn_mixture_components=self.attention_mixture_components,
-            attention_values=tf.one_hot(self.c, len(drawing.alphabet)),
-            attention_values_lengths=self.c_len,
+            attention_values=tf.one_hot(chars, len(drawing.alphabet)),
+            attention_values_lengths=chars_len,
             num_output_mixture_components=self.output_mixture_components,
-            bias=self.bias
+            bias=bias,
+            low_precision_dtype=self.low_precision_dtype,
+            emit_window=emit_window,
+            ranks=self.ranks,
+            seeds=seeds
         )
-        self.initial_state = cell.zero_state(tf.shape(self.x)[0], dtype=tf.float32)
-        outputs, self.final_state = tfcompat.nn.dynamic_rnn(
-            inputs=self.x,
+
+    def build_slot_sampler(self):
+        """Builds single-step sampling ops, for samplers that run the free-run loop themselves
+        (hand.ContinuousSampler).
+
+        Every row of the slot_* placeholders is an independent sample with its own characters, bias, seed
+        and cell state.  slot_primed_state is the state after reading x_prime (x_prime_len steps, from the
+        zero state), with slot_primed_output and slot_primed_finished the first point sampled from it and
+        its termination condition.  One run of slot_next_state, slot_output and slot_finished performs one
+        iteration of rnn_free_run: the state after reading slot_input from slot_state, the point sampled
+        from that state and its termination condition, where slot_time is the timestep of the new state
+        (the number of points sampled so far, plus one).  With the same seeds, rows sample the same points
+        as sampled_sequence, including the point sampled at the step a row finishes.
+        """
+        self.slot_c = tfcompat.placeholder(tf.int32, [None, None])
+        self.slot_c_len = tfcompat.placeholder(tf.int32, [None])
+        self.slot_bias = tfcompat.placeholder(tf.float32, [None])
+        self.slot_input = tfcompat.placeholder(tf.float32, [None, 3])
+        self.slot_seeds = tfcompat.placeholder(tf.int32, [None])
+        self.slot_time = tfcompat.placeholder(tf.int32, [None])
+
+        cell = self.build_cell(self.slot_c, self.slot_c_len, self.slot_bias, seeds=self.slot_seeds)
+        self.slot_state = LSTMAttentionCellState(*[
+            tfcompat.placeholder(tf.float32, [None, size]) for size in cell.state_size._replace(phi=None)
+        ])
+        self.slot_primed_state = tfcompat.nn.dynamic_rnn(
+            inputs=self.x_prime,
             cell=cell,
-            sequence_length=self.x_len,
+            sequence_length=self.x_prime_len,
             dtype=tf.float32,
-            initial_state=self.initial_state,
+            initial_state=cell.zero_state(tf.shape(self.x_prime)[0], dtype=tf.float32),
             scope='rnn'
-        )
-        params = time_distributed_dense_layer(outputs, self.output_units, scope='rnn/gmm')
-        pis, mus, sigmas, rhos, es = self.parse_parameters(params)
-        sequence_loss, self.loss = self.nll(self.y, self.x_len, pis, mus, sigmas, rhos, es)
-
-        self.sampled_sequence = tf.cond(
-            self.prime,
-            lambda: self.primed_sample(cell),
-            lambda: self.sample(cell)
-        )
-        return self.loss
+        )[1]
+        with tfcompat.variable_scope('rnn', reuse=True):
+            self.slot_primed_output = cell.output_function(self.slot_primed_state, 0)
+            self.slot_primed_finished = cell.termination_condition(self.slot_primed_state, 0)
+            self.slot_next_state = cell(self.slot_input, self.slot_state)[1]
+            self.slot_output = cell.output_function(self.slot_next_state, self.slot_time)
+            self.slot_finished = cell.termination_condition(self.slot_next_state, self.slot_time)
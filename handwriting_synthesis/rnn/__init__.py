@@ -1,3 +1,4 @@
 from .LSTMAttentionCell import LSTMAttentionCell
 from .RNN import RNN
+from .DistilledRNN import DistilledRNN
 from .operations import *
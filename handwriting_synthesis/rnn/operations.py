@@ -25,6 +25,7 @@ def raw_rnn(cell, loop_fn, parallel_iterations=None, swap_memory=False, scope=No
         states for all timesteps,
         outputs for all timesteps,
         final cell state,
+        final loop state,
     )
     """
     assert_like_rnncell("Raw rnn cell", cell)
@@ -181,7 +182,7 @@ def raw_rnn(cell, loop_fn, parallel_iterations=None, swap_memory=False, scope=No
         flat_outputs = [array_ops.transpose(ta.stack(), (1, 0, 2)) for ta in flat_outputs]
         outputs = nest.pack_sequence_as(structure=emit_ta, flat_sequence=flat_outputs)
 
-        return (states, outputs, final_state)
+        return (states, outputs, final_state, final_loop_state)
 
 
 def rnn_teacher_force(inputs, cell, sequence_length, initial_state, scope='dynamic-rnn-teacher-force'):
@@ -209,44 +210,84 @@ def rnn_teacher_force(inputs, cell, sequence_length, initial_state, scope='dynam
         next_loop_state = None
         return (elements_finished, next_input, next_cell_state, emit_output, next_loop_state)
 
-    states, outputs, final_state = raw_rnn(cell, loop_fn, scope=scope)
+    states, outputs, final_state, _ = raw_rnn(cell, loop_fn, scope=scope)
     return states, outputs, final_state
 
 
-def rnn_free_run(cell, initial_state, sequence_length, initial_input=None, scope='dynamic-rnn-free-run'):
+def rnn_free_run(cell, initial_state, sequence_length, initial_input=None, stall_tsteps=None,
+                 scope='dynamic-rnn-free-run'):
     """
     Implementation of an rnn which feeds its feeds its predictions back to itself at the next timestep.
 
+    sequence_length is the maximum number of timesteps, either a scalar or one per sequence.
+
     cell must implement two methods:
 
-        cell.output_function(state) which takes in the state at timestep t and returns
+        cell.output_function(state, time) which takes in the state at timestep t and returns
         the cell input at timestep t+1.
 
-        cell.termination_condition(state) which returns a boolean tensor of shape
+        cell.termination_condition(state, time) which returns a boolean tensor of shape
         [batch_size] denoting which sequences no longer need to be sampled.
+
+    With stall_tsteps (a scalar tensor, where 0 disables it), a sequence also stops once
+    cell.attention_position(state), an int tensor of shape [batch_size], has not advanced
+    for stall_tsteps timesteps.  Such sequences are reported in the returned stalled flags.
+
+    returns (
+        states for all timesteps,
+        outputs for all timesteps,
+        final cell state,
+        stalled, a boolean tensor of shape [batch_size],
+    )
     """
     with vs.variable_scope(scope, reuse=True):
         if initial_input is None:
-            initial_input = cell.output_function(initial_state)
+            initial_input = cell.output_function(initial_state, 0)
 
     def loop_fn(time, cell_output, cell_state, loop_state):
         next_cell_state = initial_state if cell_output is None else cell_state
 
         elements_finished = math_ops.logical_or(
             time >= sequence_length,
-            cell.termination_condition(next_cell_state)
+            cell.termination_condition(next_cell_state, time)
         )
+
+        # loop_state holds the attention position of every sequence, the timestep at which it last
+        # advanced, whether the sequence has finished and whether it stalled.
+        next_loop_state = None
+        if stall_tsteps is not None:
+            position = cell.attention_position(next_cell_state)
+            if cell_output is None:
+                next_loop_state = (
+                    position,
+                    array_ops.zeros_like(position),
+                    elements_finished,
+                    array_ops.zeros_like(elements_finished)
+                )
+            else:
+                anchor, anchor_time, done, stalled = loop_state
+                advanced = position > anchor
+                anchor = tf.where(advanced, position, anchor)
+                anchor_time = tf.where(advanced, array_ops.fill(array_ops.shape(anchor_time), time), anchor_time)
+                stalled = math_ops.logical_or(stalled, math_ops.logical_and(
+                    math_ops.logical_not(math_ops.logical_or(done, elements_finished)),
+                    math_ops.logical_and(stall_tsteps > 0, time - anchor_time >= stall_tsteps)
+                ))
+                elements_finished = math_ops.logical_or(elements_finished, stalled)
+                next_loop_state = (anchor, anchor_time, math_ops.logical_or(done, elements_finished), stalled)
         finished = math_ops.reduce_all(elements_finished)
 
-        next_input = tf.cond(
-            finished,
-            lambda: array_ops.zeros_like(initial_input),
-            lambda: initial_input if cell_output is None else cell.output_function(next_cell_state)
-        )
-        emit_output = next_input[0] if cell_output is None else next_input
+        if cell_output is None:
+            next_input = tf.cond(finished, lambda: array_ops.zeros_like(initial_input), lambda: initial_input)
+            emit_output = next_input[0]
+        else:
+            # The point sampled at the step a sequence finishes is emitted even when it is the last sequence
+            # to finish, so a sequence's points do not depend on the other sequences of the batch.
+            emit_output = cell.output_function(next_cell_state, time)
+            next_input = tf.cond(finished, lambda: array_ops.zeros_like(emit_output), lambda: emit_output)
 
-        next_loop_state = None
         return (elements_finished, next_input, next_cell_state, emit_output, next_loop_state)
 
-    states, outputs, final_state = raw_rnn(cell, loop_fn, scope=scope)
-    return states, outputs, final_state
+    states, outputs, final_state, final_loop_state = raw_rnn(cell, loop_fn, scope=scope)
+    stalled = final_loop_state[3] if stall_tsteps is not None else None
+    return states, outputs, final_state, stalled
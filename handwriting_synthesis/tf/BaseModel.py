@@ -1,5 +1,7 @@
 from __future__ import print_function
 
+import functools
+import itertools
 import logging
 import os
 import pprint as pp
@@ -12,6 +14,9 @@ import tensorflow as tf
 import tensorflow.compat.v1 as tfcompat
 
 from handwriting_synthesis.config import checkpoint_path, prediction_path
+from handwriting_synthesis.tf.checkpoint import AsyncCheckpointer
+from handwriting_synthesis.tf.prefetch import Prefetcher
+from handwriting_synthesis.tf.profiling import StepProfiler
 from handwriting_synthesis.tf.utils import shape
 
 tfcompat.disable_v2_behavior()
@@ -33,22 +38,57 @@ class BaseModel(object):
         learning_rates: Learning rate.
         optimizer: 'rms' for RMSProp, 'adam' for Adam, 'sgd' for SGD
         grad_clip: Clip gradients elementwise to have norm at most equal to grad_clip.
+        gradient_accumulation_steps:  If greater than 1, each training step sums the clipped gradients of
+            this many minibatches in non-trainable accumulators and applies their mean in a single update,
+            for an effective batch size of gradient_accumulation_steps * batch_size.
+        loss_scale:  Loss scaling for reduced precision training.  Gradients are computed for the loss
+            multiplied by loss_scale and divided by it again before clipping, so small float16 gradients
+            do not underflow.  Either a constant or 'dynamic', which starts at 2**15, halves the scale and
+            zeroes the gradients of any step with non-finite gradients, and doubles it after 2000 finite steps.
         regularization_constant:  Regularization constant applied to all trainable parameters.
         keep_prob: 1 - p, where p is the dropout probability
         early_stopping_steps:  Number of steps to continue training after validation loss has
             stopped decreasing.
         warm_start_init_step:  If nonzero, model will resume training a restored model beginning
             at warm_start_init_step.
+        warm_start:  If true, fit() restores the checkpoint at warm_start_init_step (the latest one in
+            checkpoint_dir when warm_start_init_step is 0) instead of initializing the parameters, even when
+            training starts at step 0.
         num_restarts:  After validation loss plateaus, the best checkpoint will be restored and the
             learning rate will be halved.  This process will repeat num_restarts times.
         enable_parameter_averaging:  If true, model saves exponential weighted averages of parameters
             to separate checkpoint file.
         min_steps_to_checkpoint:  Model only saves after min_steps_to_checkpoint training steps
             have passed.
+        async_checkpointing:  If true, save() only snapshots the parameters into host memory and the
+            checkpoint is written by a background thread (tf.AsyncCheckpointer).
+        keep_best_checkpoints:  Number of checkpoints with the best validation metric to keep, in addition
+            to the most recent one.
+        keep_checkpoint_every_n_steps:  If set, checkpoints at least this many steps apart are never deleted.
         log_interval:  Train and validation accuracies are logged every log_interval training steps.
         loss_averaging_window:  Train/validation losses are averaged over the last loss_averaging_window
             training steps.
-        num_validation_batches:  Number of batches to be used in validation evaluation at each step.
+        num_validation_batches:  Number of batches in the fixed validation subset used by periodic validation.
+        validation_interval:  If set, validation runs every validation_interval training steps over a fixed
+            subset of num_validation_batches batches, and early stopping, checkpointing and restarts are
+            driven by these measurements.  Otherwise a single validation batch is evaluated before every
+            training step and the losses are averaged over loss_averaging_window steps.
+        validation_interval_secs:  Like validation_interval, but validates whenever this many seconds have
+            passed since the last validation.  May be combined with validation_interval.
+        prefetch_batches:  If nonzero, feed dicts for train/validation batches are built on background
+            threads and up to prefetch_batches of them are kept ready, so the training loop does not wait
+            on batch construction.
+        prefetch_threads:  Number of background threads per batch generator when prefetching.
+        allreduce:  Optional tf.SharedMemoryAllReduce for data-parallel training.  Each worker process trains
+            on its own batches, gradients and validation losses are averaged across workers every step, and
+            only the worker with rank 0 writes checkpoints.  Parameters are synced from rank 0 whenever they
+            are initialized or restored.
+        num_threads:  If set, limits the intra-op and inter-op thread pools of the session.
+        profile_log:  If set, fit() appends a JSON line per training step to this file with the time spent
+            waiting for batches, in validation, in the training session runs and in checkpointing, along
+            with samples/sec and the padded-to-real timestep ratio (tf.StepProfiler).
+        trace_steps:  Optional (first, last) range of training steps for which a full TensorFlow trace is
+            collected and written to log_dir as timeline-{step}.json, viewable in chrome://tracing.
         log_dir: Directory where logs are written.
         checkpoint_dir: Directory where checkpoints are saved.
         prediction_dir: Directory where predictions/outputs are saved.
@@ -63,16 +103,31 @@ class BaseModel(object):
             beta1_decays=None,
             optimizer='adam',
             grad_clip=5,
+            gradient_accumulation_steps=1,
+            loss_scale=None,
             regularization_constant=0.0,
             keep_prob=1.0,
             patiences=None,
             warm_start_init_step=0,
+            warm_start=False,
             enable_parameter_averaging=False,
             min_steps_to_checkpoint=100,
+            async_checkpointing=True,
+            keep_best_checkpoints=1,
+            keep_checkpoint_every_n_steps=None,
             log_interval=20,
             logging_level=logging.INFO,
             loss_averaging_window=100,
             validation_batch_size=64,
+            num_validation_batches=10,
+            validation_interval=None,
+            validation_interval_secs=None,
+            prefetch_batches=0,
+            prefetch_threads=1,
+            allreduce=None,
+            num_threads=None,
+            profile_log=None,
+            trace_steps=None,
             log_dir='logs',
             checkpoint_dir=checkpoint_path,
             prediction_dir=prediction_path
@@ -94,6 +149,10 @@ class BaseModel(object):
         self.early_stopping_steps = None
         self.metrics = {}
         self.step = None
+        self.apply_accumulated_gradients = None
+        self.gradients = None
+        self.gradient_placeholders = None
+        self.loss_scale_var = None
         self.ema = None
         self.global_step = None
         self.learning_rate_var = None
@@ -101,7 +160,12 @@ class BaseModel(object):
         self.loss = None
         self.saver = None
         self.saver_averaged = None
+        self.checkpointer = None
+        self.checkpointer_averaged = None
         self.init = None
+        self.local_init = None
+        self.profiler = None
+        self.run_kwargs = {}
 
         assert len(batch_sizes) == len(learning_rates) == len(patiences)
         self.batch_sizes = batch_sizes
@@ -116,14 +180,35 @@ class BaseModel(object):
         self.num_training_steps = num_training_steps
         self.optimizer = optimizer
         self.grad_clip = grad_clip
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        self.loss_scale = loss_scale
         self.regularization_constant = regularization_constant
         self.warm_start_init_step = warm_start_init_step
+        self.warm_start = warm_start
         self.keep_prob_scalar = keep_prob
         self.enable_parameter_averaging = enable_parameter_averaging
         self.min_steps_to_checkpoint = min_steps_to_checkpoint
+        self.async_checkpointing = async_checkpointing
+        self.keep_best_checkpoints = keep_best_checkpoints
+        self.keep_checkpoint_every_n_steps = keep_checkpoint_every_n_steps
         self.log_interval = log_interval
         self.loss_averaging_window = loss_averaging_window
         self.validation_batch_size = validation_batch_size
+        self.num_validation_batches = num_validation_batches
+        self.validation_interval = validation_interval
+        self.validation_interval_secs = validation_interval_secs
+        self.prefetch_batches = prefetch_batches
+        self.prefetch_threads = prefetch_threads
+        self.allreduce = allreduce
+        self.is_chief = allreduce is None or allreduce.rank == 0
+        self.num_threads = num_threads
+        self.profile_log = profile_log
+        self.trace_steps = trace_steps
+        if allreduce is not None:
+            assert gradient_accumulation_steps == 1, 'gradient accumulation is not supported with allreduce'
+            assert not validation_interval_secs, 'workers must validate on the same steps; use validation_interval'
+            # Workers would see different non-finite steps and their loss scales would diverge.
+            assert loss_scale != 'dynamic', 'dynamic loss scaling is not supported with allreduce; use a constant'
 
         self.log_dir = log_dir
         self.logging_level = logging_level
@@ -136,7 +221,16 @@ class BaseModel(object):
         logging.info('\nNew run with parameters:\n{}'.format(pp.pformat(self.__dict__)))
 
         self.graph = self.build_graph()
-        self.session = tfcompat.Session(graph=self.graph)
+        config = None
+        if self.num_threads:
+            config = tfcompat.ConfigProto(
+                intra_op_parallelism_threads=self.num_threads,
+                inter_op_parallelism_threads=self.num_threads
+            )
+        self.session = tfcompat.Session(graph=self.graph, config=config)
+        if self.allreduce is not None:
+            variables = self.graph.get_collection(tfcompat.GraphKeys.GLOBAL_VARIABLES)
+            self.allreduce.setup(sum(int(np.prod(shape(var))) for var in variables))
         logging.info('Built Graph')
 
     def update_train_params(self):
@@ -148,61 +242,113 @@ class BaseModel(object):
     def calculate_loss(self):
         raise NotImplementedError('Subclass must implement this.')
 
+    def batch_feed_dict(self, batch_df, is_training):
+        feed_dict = {
+            getattr(self, placeholder_name, None): data
+            for placeholder_name, data in batch_df.items() if hasattr(self, placeholder_name)
+        }
+        if hasattr(self, 'keep_prob'):
+            feed_dict.update({self.keep_prob: self.keep_prob_scalar if is_training else 1.0})
+        if hasattr(self, 'is_training'):
+            feed_dict.update({self.is_training: is_training})
+        return feed_dict
+
+    def feed_dict_generator(self, batch_generator, is_training):
+        transform = functools.partial(self.batch_feed_dict, is_training=is_training)
+        if self.prefetch_batches:
+            return Prefetcher(
+                batch_generator,
+                buffer_size=self.prefetch_batches,
+                transform=transform,
+                num_threads=self.prefetch_threads
+            )
+        return map(transform, batch_generator)
+
+    @staticmethod
+    def close_generator(generator):
+        if hasattr(generator, 'close'):
+            generator.close()
+
     def fit(self):
         with self.session.as_default():
 
-            if self.warm_start_init_step:
+            if (self.warm_start or self.warm_start_init_step) and self.is_chief:
                 self.restore(self.warm_start_init_step)
-                step = self.warm_start_init_step
             else:
                 self.session.run(self.init)
-                step = 0
-
-            train_generator = self.reader.train_batch_generator(self.batch_size)
-            val_generator = self.reader.val_batch_generator(self.validation_batch_size)
-
+            step = self.warm_start_init_step
+            if self.allreduce is not None:
+                self.broadcast_parameters()
+            self.profiler = StepProfiler(self.profile_log, self.trace_steps, trace_dir=self.log_dir)
+
+            train_generator = self.feed_dict_generator(
+                self.reader.train_batch_generator(self.batch_size), is_training=True)
+            val_generator = self.feed_dict_generator(
+                self.reader.val_batch_generator(self.validation_batch_size), is_training=False)
+
+            periodic_validation = bool(self.validation_interval or self.validation_interval_secs)
+            if periodic_validation:
+                val_feed_dicts = self.validation_subset(val_generator, self.num_validation_batches)
+                self.close_generator(val_generator)
+            last_val_step, last_val_time = None, None
+
+            # Periodic validation measures a fixed subset, so only the latest measurement is kept.
+            val_window = 1 if periodic_validation else self.loss_averaging_window
             train_loss_history = deque(maxlen=self.loss_averaging_window)
-            val_loss_history = deque(maxlen=self.loss_averaging_window)
+            val_loss_history = deque(maxlen=val_window)
             train_time_history = deque(maxlen=self.loss_averaging_window)
-            val_time_history = deque(maxlen=self.loss_averaging_window)
+            val_time_history = deque(maxlen=val_window)
 
             metric_histories = {
-                metric_name: deque(maxlen=self.loss_averaging_window) for metric_name in self.metrics
+                metric_name: deque(maxlen=val_window) for metric_name in self.metrics
             }
             best_validation_loss, best_validation_tstep = float('inf'), 0
             checkpoint_created=False
             
 
             while step < self.num_training_steps:
+                self.run_kwargs = self.profiler.run_kwargs(step)
 
                 # validation evaluation
-                val_start = time.time()
-                val_batch_df = next(val_generator)
-                val_feed_dict = {
-                    getattr(self, placeholder_name, None): data
-                    for placeholder_name, data in val_batch_df.items() if hasattr(self, placeholder_name)
-                }
-
-                val_feed_dict.update(
-                    {self.learning_rate_var: self.learning_rate, self.beta1_decay_var: self.beta1_decay})
-                if hasattr(self, 'keep_prob'):
-                    val_feed_dict.update({self.keep_prob: 1.0})
-                if hasattr(self, 'is_training'):
-                    val_feed_dict.update({self.is_training: False})
-
-                results = self.session.run(
-                    fetches=[self.loss] + list(self.metrics.values()),
-                    feed_dict=val_feed_dict
-                )
-                val_loss = results[0]
-                val_metrics = results[1:] if len(results) > 1 else []
-                val_metrics = dict(zip(self.metrics.keys(), val_metrics))
-                val_loss_history.append(val_loss)
-                val_time_history.append(time.time() - val_start)
-                for key in val_metrics:
-                    metric_histories[key].append(val_metrics[key])
-
-                if hasattr(self, 'monitor_tensors'):
+                validated = False
+                with self.profiler.phase('validation'):
+                    if not periodic_validation:
+                        val_start = time.time()
+                        val_feed_dict = next(val_generator)
+                        val_feed_dict.update(
+                            {self.learning_rate_var: self.learning_rate, self.beta1_decay_var: self.beta1_decay})
+
+                        results = self.session.run(
+                            fetches=[self.loss] + list(self.metrics.values()),
+                            feed_dict=val_feed_dict
+                        )
+                        val_loss = results[0]
+                        val_metrics = results[1:] if len(results) > 1 else []
+                        val_metrics = dict(zip(self.metrics.keys(), val_metrics))
+                        validated = True
+
+                    elif (
+                            last_val_step is None
+                            or (self.validation_interval and step - last_val_step >= self.validation_interval)
+                            or (self.validation_interval_secs and time.time() - last_val_time >= self.validation_interval_secs)
+                    ):
+                        val_start = time.time()
+                        val_loss, val_metrics = self.evaluate(val_feed_dicts)
+                        val_feed_dict = val_feed_dicts[0]
+                        last_val_step, last_val_time = step, time.time()
+                        validated = True
+
+                    if validated and self.allreduce is not None:
+                        values = self.allreduce.mean([val_loss] + [val_metrics[key] for key in self.metrics])
+                        val_loss, val_metrics = values[0], dict(zip(self.metrics.keys(), values[1:]))
+
+                if validated:
+                    val_loss_history.append(val_loss)
+                    val_time_history.append(time.time() - val_start)
+                    for key in val_metrics:
+                        metric_histories[key].append(val_metrics[key])
+
+                if validated and hasattr(self, 'monitor_tensors'):
                     for name, tensor in self.monitor_tensors.items():
                         [np_val] = self.session.run([tensor], feed_dict=val_feed_dict)
                         print(name)
@@ -217,29 +363,38 @@ class BaseModel(object):
 
                 # train step
                 train_start = time.time()
-                train_batch_df = next(train_generator)
-                train_feed_dict = {
-                    getattr(self, placeholder_name, None): data
-                    for placeholder_name, data in train_batch_df.items() if hasattr(self, placeholder_name)
-                }
-
-                train_feed_dict.update(
-                    {self.learning_rate_var: self.learning_rate, self.beta1_decay_var: self.beta1_decay})
-                if hasattr(self, 'keep_prob'):
-                    train_feed_dict.update({self.keep_prob: self.keep_prob_scalar})
-                if hasattr(self, 'is_training'):
-                    train_feed_dict.update({self.is_training: True})
-
-                train_loss, _ = self.session.run(
-                    fetches=[self.loss, self.step],
-                    feed_dict=train_feed_dict
-                )
+                train_losses = []
+                for _ in range(self.gradient_accumulation_steps):
+                    with self.profiler.phase('batch_wait'):
+                        train_feed_dict = next(train_generator)
+                    train_feed_dict.update(
+                        {self.learning_rate_var: self.learning_rate, self.beta1_decay_var: self.beta1_decay})
+                    batch_lengths = self.batch_lengths(train_feed_dict)
+                    if batch_lengths is not None:
+                        self.profiler.add_batch(*batch_lengths)
+                    with self.profiler.phase('train_run'):
+                        train_losses.append(self.train_step(train_feed_dict))
+
+                if self.apply_accumulated_gradients is not None:
+                    with self.profiler.phase('train_run'):
+                        self.traced_run(
+                            fetches=self.apply_accumulated_gradients,
+                            feed_dict={self.learning_rate_var: self.learning_rate, self.beta1_decay_var: self.beta1_decay}
+                        )
+                train_loss = sum(train_losses) / len(train_losses)
                 train_loss_history.append(train_loss)
                 train_time_history.append(time.time() - train_start)
 
+                avg_val_loss = sum(val_loss_history) / len(val_loss_history)
+                early_stopping_metric = avg_val_loss
+                avg_metrics = {}
+                for metric_name, metric_history in metric_histories.items():
+                    avg_metrics[metric_name] = sum(metric_history) / len(metric_history)
+                    if metric_name == self.early_stopping_metric:
+                        early_stopping_metric = avg_metrics[metric_name]
+
                 if step % self.log_interval == 0:
                     avg_train_loss = sum(train_loss_history) / len(train_loss_history)
-                    avg_val_loss = sum(val_loss_history) / len(val_loss_history)
                     avg_train_time = sum(train_time_history) / len(train_time_history)
                     avg_val_time = sum(val_time_history) / len(val_time_history)
                     metric_log = (
@@ -253,15 +408,12 @@ class BaseModel(object):
                         round(avg_val_time, 4),
                         round(avg_val_loss, 8),
                     )
-                    early_stopping_metric = avg_val_loss
-                    for metric_name, metric_history in metric_histories.items():
-                        metric_val = sum(metric_history) / len(metric_history)
+                    for metric_name, metric_val in avg_metrics.items():
                         metric_log += '{}: {:<4}     '.format(metric_name, round(metric_val, 4))
-                        if metric_name == self.early_stopping_metric:
-                            early_stopping_metric = metric_val
 
                     logging.info(metric_log)
 
+                if validated if periodic_validation else step % self.log_interval == 0:
                     # Save the best step.
                     if early_stopping_metric < best_validation_loss:
                         logging.info('Updating best validation loss {} with early stopping metric {}.'.format(round(best_validation_loss,4),round(early_stopping_metric,4)))
@@ -269,9 +421,10 @@ class BaseModel(object):
                         best_validation_tstep = step
                         # Take a snapshot if the minimum number of steps have been reached.
                         if step > self.min_steps_to_checkpoint:
-                            self.save(step)
-                            if self.enable_parameter_averaging:
-                                self.save(step, averaged=True)
+                            with self.profiler.phase('checkpoint'):
+                                self.save(step, metric=early_stopping_metric)
+                                if self.enable_parameter_averaging:
+                                    self.save(step, averaged=True, metric=early_stopping_metric)
                             checkpoint_created=True
 
                     # Stop training early and either restart with tigher training parameters or finish entirely.
@@ -280,32 +433,135 @@ class BaseModel(object):
                         if self.num_restarts is None or self.restart_idx >= self.num_restarts:
                             logging.info('Best validation loss of {} at training step {}'.format(best_validation_loss, best_validation_tstep))
                             logging.info('Early stopping - ending training.')
+                            self.close_generator(train_generator)
+                            self.close_generator(val_generator)
+                            self.wait_for_checkpoints()
+                            self.profiler.end_step(step)
+                            self.profiler.close()
+                            self.run_kwargs = {}
                             return
 
                         #Restart the training with tighter parameters if we have remaining restarts and a checkpoint has been created.
                         if self.restart_idx < self.num_restarts and checkpoint_created:
                             logging.info('Restarting for the {} time out of {} total restarts.'.format(self.restart_idx, self.num_restarts))
-                            try:
-                                self.restore(best_validation_tstep)
-                            except Exception as error:
-                                logging.warn('Failed to restore checkpoint; will continue training: {} - {}'.format(type(error).__name__, error))
-                            else:
+                            if self.restore_for_restart(best_validation_tstep):
                                 step = best_validation_tstep
+                                last_val_step, last_val_time = step, time.time()
                                 self.restart_idx += 1
                                 self.update_train_params()
-                                train_generator = self.reader.train_batch_generator(self.batch_size)
+                                self.close_generator(train_generator)
+                                train_generator = self.feed_dict_generator(
+                                    self.reader.train_batch_generator(self.batch_size), is_training=True)
 
+                self.profiler.end_step(step)
                 step += 1
 
+            self.profiler.close()
+            self.run_kwargs = {}
+            self.close_generator(train_generator)
+            self.close_generator(val_generator)
+
             #Make sure at least one model gets saved.
             if step <= self.min_steps_to_checkpoint:
                 # best_validation_tstep = step
                 self.save(step)
                 if self.enable_parameter_averaging:
                     self.save(step, averaged=True)
+            self.wait_for_checkpoints()
 
             logging.info('num_training_steps reached - ending training')
 
+    def train_step(self, feed_dict):
+        """Runs self.step on the batch in feed_dict and returns the training loss.
+
+        With gradient accumulation, self.step only adds the batch's gradients to the accumulators and
+        the update is applied by self.apply_accumulated_gradients.
+        """
+        return self.run_update(feed_dict, self.loss)
+
+    def accumulates_gradients(self):
+        """Whether self.step accumulates gradients that are applied by self.apply_accumulated_gradients."""
+        return self.gradient_accumulation_steps > 1
+
+    def traced_run(self, fetches, feed_dict):
+        """session.run with self.run_kwargs, adding the run to the profiler's trace of the current step."""
+        results = self.session.run(fetches=fetches, feed_dict=feed_dict, **self.run_kwargs)
+        if self.profiler is not None:
+            self.profiler.collect_run()
+        return results
+
+    def run_update(self, feed_dict, fetches):
+        """Runs self.step on feed_dict and returns the values of fetches.
+
+        With allreduce, the clipped gradients are fetched instead, averaged across workers, and fed back
+        to self.step.
+        """
+        if self.allreduce is None:
+            results, _ = self.traced_run(fetches=[fetches, self.step], feed_dict=feed_dict)
+            return results
+
+        results, gradients = self.traced_run(fetches=[fetches, self.gradients], feed_dict=feed_dict)
+        feed_dict = dict(feed_dict)
+        feed_dict.update(zip(self.gradient_placeholders, self.allreduce.mean(gradients)))
+        self.traced_run(fetches=self.step, feed_dict=feed_dict)
+        return results
+
+    def batch_lengths(self, feed_dict):
+        """Returns (sequence lengths, padded length) of the batch in feed_dict for profiling, or None.
+
+        Models with variable length inputs override this so the profiler can report padding overhead.
+        """
+        return None
+
+    def broadcast_parameters(self):
+        """Overwrites all global variables with their values on the worker with rank 0."""
+        variables = self.graph.get_collection(tfcompat.GraphKeys.GLOBAL_VARIABLES)
+        values = self.allreduce.broadcast(self.session.run(variables))
+        for var, value in zip(variables, values):
+            var.load(value, self.session)
+
+    def restore_for_restart(self, step):
+        """Restores the checkpoint at step (on rank 0, then synced to all workers).  Returns success."""
+        restored = True
+        if self.is_chief:
+            try:
+                self.restore(step)
+            except Exception as error:
+                logging.warn('Failed to restore checkpoint; will continue training: {} - {}'.format(type(error).__name__, error))
+                restored = False
+        if self.allreduce is not None:
+            [restored] = self.allreduce.broadcast([restored])
+            if restored:
+                self.broadcast_parameters()
+        return bool(restored)
+
+    def validation_subset(self, val_generator, num_batches):
+        """Returns up to num_batches batches of val_generator, for periodic validation.
+
+        Raises ValueError if the validation split cannot fill a single batch of validation_batch_size.
+        """
+        # Arrays are copied since they may be views into the generator's reusable batch buffers.
+        feed_dicts = [
+            {placeholder: np.array(data) for placeholder, data in feed_dict.items()}
+            for feed_dict in itertools.islice(val_generator, num_batches)
+        ]
+        if not feed_dicts:
+            raise ValueError(
+                'the validation split yields no batches of validation_batch_size={}; it has fewer rows '
+                'than that, so lower validation_batch_size'.format(self.validation_batch_size))
+        if len(feed_dicts) < num_batches:
+            logging.info('validating on {} batches instead of {}'.format(len(feed_dicts), num_batches))
+        return feed_dicts
+
+    def evaluate(self, feed_dicts):
+        """Returns the loss and metrics averaged over the batches in feed_dicts."""
+        results = [
+            self.session.run(fetches=[self.loss] + list(self.metrics.values()), feed_dict=feed_dict)
+            for feed_dict in feed_dicts
+        ]
+        means = np.mean(results, axis=0)
+        return means[0], dict(zip(self.metrics.keys(), means[1:]))
+
     def predict(self, chunk_size=256):
         if not os.path.isdir(self.prediction_dir):
             os.makedirs(self.prediction_dir)
@@ -318,14 +574,7 @@ class BaseModel(object):
                 if i % 10 == 0:
                     print(i * len(test_batch_df))
 
-                test_feed_dict = {
-                    getattr(self, placeholder_name, None): data
-                    for placeholder_name, data in test_batch_df.items() if hasattr(self, placeholder_name)
-                }
-                if hasattr(self, 'keep_prob'):
-                    test_feed_dict.update({self.keep_prob: 1.0})
-                if hasattr(self, 'is_training'):
-                    test_feed_dict.update({self.is_training: False})
+                test_feed_dict = self.batch_feed_dict(test_batch_df, is_training=False)
 
                 tensor_names, tf_tensors = zip(*self.prediction_tensors.items())
                 np_tensors = self.session.run(
@@ -349,30 +598,64 @@ class BaseModel(object):
                 logging.info('saving {} with shape {} to {}'.format(tensor_name, np_tensor.shape, save_file))
                 np.save(save_file, np_tensor)
 
-    def save(self, step, averaged=False):
-        saver = self.saver_averaged if averaged else self.saver
-        checkpoint_dir = self.checkpoint_dir_averaged if averaged else self.checkpoint_dir
-        if not os.path.isdir(checkpoint_dir):
-            logging.info('creating checkpoint directory {}'.format(checkpoint_dir))
-            os.mkdir(checkpoint_dir)
+    def save(self, step, averaged=False, metric=None):
+        if not self.is_chief:
+            return
+        checkpointer = self.checkpointer_averaged if averaged else self.checkpointer
+        if checkpointer is None:
+            checkpointer = self.build_checkpointer(averaged)
 
-        model_path = os.path.join(checkpoint_dir, 'model')
+        model_path = os.path.join(checkpointer.checkpoint_dir, 'model')
         logging.info('saving model to {}'.format(model_path))
-        saver.save(self.session, model_path, global_step=step)
+        checkpointer.save(step, metric=metric)
+        if not self.async_checkpointing:
+            checkpointer.wait()
+
+    def build_checkpointer(self, averaged=False):
+        saver = self.saver_averaged if averaged else self.saver
+        with self.graph.as_default():
+            if averaged:
+                var_list = self.ema.variables_to_restore()
+            else:
+                var_list = {var.op.name: var for var in tfcompat.global_variables()}
+            meta_graph_def = saver.export_meta_graph()
+
+        checkpointer = AsyncCheckpointer(
+            session=self.session,
+            var_list=var_list,
+            checkpoint_dir=self.checkpoint_dir_averaged if averaged else self.checkpoint_dir,
+            meta_graph_def=meta_graph_def,
+            keep_best=self.keep_best_checkpoints,
+            keep_every_n_steps=self.keep_checkpoint_every_n_steps
+        )
+        if averaged:
+            self.checkpointer_averaged = checkpointer
+        else:
+            self.checkpointer = checkpointer
+        return checkpointer
+
+    def wait_for_checkpoints(self):
+        """Blocks until all checkpoints queued by save() have been written."""
+        for checkpointer in (self.checkpointer, self.checkpointer_averaged):
+            if checkpointer is not None:
+                checkpointer.wait()
 
     def restore(self, step=None, averaged=False):
+        self.wait_for_checkpoints()
         saver = self.saver_averaged if averaged else self.saver
         checkpoint_dir = self.checkpoint_dir_averaged if averaged else self.checkpoint_dir
         if not step:
             model_path = tf.train.latest_checkpoint(checkpoint_dir)
             logging.info('restoring model parameters from {}'.format(model_path))
             saver.restore(self.session, model_path)
+            self.session.run(self.local_init)
         else:
             model_path = os.path.join(
                 checkpoint_dir, 'model{}-{}'.format('_avg' if averaged else '', step)
             )
             logging.info('restoring model from {}'.format(model_path))
             saver.restore(self.session, model_path)
+            self.session.run(self.local_init)
 
     def init_logging(self, log_dir):
         if not os.path.isdir(log_dir):
@@ -397,9 +680,38 @@ class BaseModel(object):
             loss = loss + self.regularization_constant * l2_norm
 
         optimizer = self.get_optimizer(self.learning_rate_var, self.beta1_decay_var)
-        grads = optimizer.compute_gradients(loss)
+        if self.loss_scale is None:
+            grads = optimizer.compute_gradients(loss)
+        else:
+            grads, update_loss_scale = self.scaled_gradients(optimizer, loss)
         clipped = [(tf.clip_by_value(g, -self.grad_clip, self.grad_clip), v_) for g, v_ in grads]
 
+        if self.accumulates_gradients():
+            # Accumulators are local variables so they are neither checkpointed nor required on restore.
+            accumulators = [
+                tfcompat.Variable(
+                    tf.zeros(shape(v_), dtype=v_.dtype.base_dtype),
+                    trainable=False,
+                    collections=[tfcompat.GraphKeys.LOCAL_VARIABLES],
+                    name='{}/accumulator'.format(v_.op.name)
+                )
+                for _, v_ in clipped
+            ]
+            # Counts the runs of self.step since the last update, which is gradient_accumulation_steps
+            # unless a subclass's train_step runs it several times per batch.
+            accumulated_steps = tfcompat.Variable(
+                0.0, trainable=False, collections=[tfcompat.GraphKeys.LOCAL_VARIABLES], name='accumulated_steps')
+            accumulate = tf.group(
+                accumulated_steps.assign_add(1.0),
+                *[acc.assign_add(g) for acc, (g, _) in zip(accumulators, clipped)]
+            )
+            clipped = [(acc / tf.maximum(accumulated_steps, 1.0), v_) for acc, (_, v_) in zip(accumulators, clipped)]
+
+        if self.allreduce is not None:
+            self.gradients = [g for g, _ in clipped]
+            self.gradient_placeholders = [tfcompat.placeholder(g.dtype, shape(g)) for g in self.gradients]
+            clipped = [(p, v_) for p, (_, v_) in zip(self.gradient_placeholders, clipped)]
+
         update_ops = tfcompat.get_collection(tfcompat.GraphKeys.UPDATE_OPS)
         with tf.control_dependencies(update_ops):
             step = optimizer.apply_gradients(clipped, global_step=self.global_step)
@@ -407,9 +719,21 @@ class BaseModel(object):
         if self.enable_parameter_averaging:
             maintain_averages_op = self.ema.apply(tfcompat.trainable_variables())
             with tf.control_dependencies([step]):
-                self.step = tf.group(maintain_averages_op)
+                step = tf.group(maintain_averages_op)
+
+        if self.accumulates_gradients():
+            with tf.control_dependencies([step]):
+                self.apply_accumulated_gradients = tf.group(
+                    accumulated_steps.assign(0.0),
+                    *[acc.assign(tf.zeros_like(acc)) for acc in accumulators]
+                )
+            self.step = accumulate
         else:
             self.step = step
+        if self.loss_scale == 'dynamic':
+            # The scale is adjusted after every batch whose gradients were computed with it.
+            with tf.control_dependencies([self.step]):
+                self.step = tf.group(update_loss_scale())
 
         logging.info('All parameters:')
         logging.info(pp.pformat([(var.name, shape(var)) for var in tfcompat.global_variables()]))
@@ -420,6 +744,39 @@ class BaseModel(object):
         logging.info('Trainable parameter count:')
         logging.info(str(np.sum(np.prod(shape(var)) for var in tfcompat.trainable_variables())))
 
+    def scaled_gradients(self, optimizer, loss, initial_scale=2.0 ** 15, growth_interval=2000):
+        """Returns the gradients of loss computed with loss scaling, and a function building the op that
+        updates a dynamic loss scale (None for a constant loss_scale)."""
+        if self.loss_scale != 'dynamic':
+            grads = optimizer.compute_gradients(loss * self.loss_scale)
+            return [(g / self.loss_scale, v_) for g, v_ in grads], None
+
+        # Local variables, so the scale is neither checkpointed nor required on restore.
+        self.loss_scale_var = tfcompat.Variable(
+            initial_scale, trainable=False, collections=[tfcompat.GraphKeys.LOCAL_VARIABLES], name='loss_scale')
+        finite_steps = tfcompat.Variable(
+            0, trainable=False, collections=[tfcompat.GraphKeys.LOCAL_VARIABLES], name='loss_scale_finite_steps')
+
+        grads = optimizer.compute_gradients(loss * self.loss_scale_var)
+        grads = [(g / self.loss_scale_var, v_) for g, v_ in grads]
+        is_finite = tf.reduce_all([tf.reduce_all(tf.math.is_finite(g)) for g, _ in grads])
+        grads = [(tf.where(is_finite, g, tf.zeros_like(g)), v_) for g, v_ in grads]
+
+        def update_loss_scale():
+            steps = tf.where(is_finite, finite_steps + 1, 0)
+            grow = steps >= growth_interval
+            scale = tf.where(
+                is_finite,
+                tf.where(grow, 2.0 * self.loss_scale_var, self.loss_scale_var),
+                tf.maximum(self.loss_scale_var / 2.0, 1.0)
+            )
+            return tf.group(
+                self.loss_scale_var.assign(scale),
+                finite_steps.assign(tf.where(grow, 0, steps))
+            )
+
+        return grads, update_loss_scale
+
     def get_optimizer(self, learning_rate, beta1_decay):
         if self.optimizer == 'adam':
             return tfcompat.train.AdamOptimizer(learning_rate, beta1=beta1_decay)
@@ -434,8 +791,9 @@ class BaseModel(object):
         with tf.Graph().as_default() as graph:
             self.ema = tf.train.ExponentialMovingAverage(decay=0.99)
             self.global_step = tf.Variable(0, trainable=False)
-            self.learning_rate_var = tf.Variable(0.0, trainable=False)
-            self.beta1_decay_var = tf.Variable(0.0, trainable=False)
+            # Ref variables, so that the values fed in fit() are the ones read by the optimizer.
+            self.learning_rate_var = tfcompat.Variable(0.0, trainable=False)
+            self.beta1_decay_var = tfcompat.Variable(0.0, trainable=False)
 
             self.loss = self.calculate_loss()
             self.update_parameters(self.loss)
@@ -444,5 +802,6 @@ class BaseModel(object):
             if self.enable_parameter_averaging:
                 self.saver_averaged = tfcompat.train.Saver(self.ema.variables_to_restore(), max_to_keep=1)
 
-            self.init = tfcompat.global_variables_initializer()
+            self.local_init = tfcompat.local_variables_initializer()
+            self.init = tf.group(tfcompat.global_variables_initializer(), self.local_init)
             return graph
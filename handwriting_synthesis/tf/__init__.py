@@ -1,2 +1,8 @@
 from .BaseModel import BaseModel
+from .allreduce import SharedMemoryAllReduce
+from .checkpoint import AsyncCheckpointer
+from .factorization import factorized_ranks
+from .prefetch import Prefetcher
+from .profiling import StepProfiler
+from .quantization import QuantizedWeightGetter
 from .utils import *
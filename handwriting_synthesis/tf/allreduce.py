@@ -0,0 +1,89 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedMemoryAllReduce(object):
+    """Averages lists of numpy arrays across the worker processes of one machine through shared memory.
+
+    Every worker holds an instance with its own rank, and all of them must make the same sequence of
+    calls.  The shared buffer has one row per worker plus a result row.  In mean(), each worker writes
+    its values to its row, reduces its own slice of the columns into the result row, and reads back the
+    full result, with a barrier between the phases.  broadcast() waits for every worker before the root
+    writes the result row, so it never overwrites a mean that a slower worker has yet to read.
+
+    Args:
+        name: Name of the shared memory block, common to all workers.
+        rank: Index of this worker in [0, num_workers).
+        num_workers: Number of worker processes.
+        barrier: multiprocessing.Barrier shared by all workers.
+    """
+
+    def __init__(self, name, rank, num_workers, barrier):
+        self.name = name
+        self.rank = rank
+        self.num_workers = num_workers
+        self.barrier = barrier
+        self.shm = None
+        self.buffer = None
+
+    def setup(self, size):
+        """Allocates room for size float32 values per worker.  Must be called by all workers."""
+        if self.rank == 0:
+            self.shm = shared_memory.SharedMemory(
+                name=self.name, create=True, size=4 * (self.num_workers + 1) * size)
+        self.barrier.wait()
+        if self.rank != 0:
+            self.shm = shared_memory.SharedMemory(name=self.name)
+        self.buffer = np.ndarray((self.num_workers + 1, size), dtype=np.float32, buffer=self.shm.buf)
+
+    def mean(self, arrays):
+        """Returns the elementwise mean of arrays over all workers."""
+        flat, shapes = self._flatten(arrays)
+        size = len(flat)
+        bounds = np.linspace(0, size, self.num_workers + 1).astype(int)
+        lo, hi = bounds[self.rank], bounds[self.rank + 1]
+
+        self.buffer[self.rank, :size] = flat
+        self.barrier.wait()
+        self.buffer[-1, lo:hi] = self.buffer[:-1, lo:hi].mean(axis=0)
+        self.barrier.wait()
+        return self._unflatten(self.buffer[-1, :size].copy(), shapes)
+
+    def broadcast(self, arrays, root=0):
+        """Returns the arrays passed by worker root, on every worker."""
+        flat, shapes = self._flatten(arrays)
+        size = len(flat)
+        # The result row may still be read by workers returning from a previous mean().
+        self.barrier.wait()
+        if self.rank == root:
+            self.buffer[-1, :size] = flat
+        self.barrier.wait()
+        result = self.buffer[-1, :size].copy()
+        self.barrier.wait()
+        return self._unflatten(result, shapes)
+
+    def close(self):
+        if self.shm is not None:
+            self.buffer = None
+            self.shm.close()
+            if self.rank == 0:
+                self.shm.unlink()
+            self.shm = None
+
+    @staticmethod
+    def _flatten(arrays):
+        arrays = [np.asarray(array) for array in arrays]
+        shapes = [(array.shape, array.dtype) for array in arrays]
+        if not arrays:
+            return np.zeros([0], dtype=np.float32), shapes
+        return np.concatenate([array.ravel() for array in arrays]).astype(np.float32), shapes
+
+    @staticmethod
+    def _unflatten(flat, shapes):
+        arrays, offset = [], 0
+        for array_shape, dtype in shapes:
+            size = int(np.prod(array_shape))
+            arrays.append(flat[offset:offset + size].reshape(array_shape).astype(dtype))
+            offset += size
+        return arrays
@@ -0,0 +1,144 @@
+import glob
+import logging
+import os
+import queue
+import threading
+
+import tensorflow as tf
+import tensorflow.compat.v1 as tfcompat
+
+tfcompat.disable_v2_behavior()
+
+
+class AsyncCheckpointer(object):
+    """Writes checkpoints of a live session from a background thread.
+
+    save() copies the current variable values into host memory with a single session.run and queues
+    them.  A background thread loads the copies into a private graph with one variable per saved
+    name and writes them with its own Saver, so the checkpoints can be read by a Saver of the original
+    graph.  Files follow the usual {prefix}-{step} naming, and the checkpoint index file is rewritten
+    atomically after every write.
+
+    Retention: the keep_best checkpoints with the lowest metric are kept, along with the most recent
+    one.  With keep_every_n_steps, a checkpoint is also kept permanently if it was written at least
+    keep_every_n_steps steps after the previous permanent one.
+
+    Args:
+        session: Session holding the variables.
+        var_list: Dict mapping checkpoint names to variables of session.graph.
+        checkpoint_dir: Directory to write to.
+        meta_graph_def: Optional MetaGraphDef written next to every checkpoint.
+        prefix: Checkpoint file prefix.
+        keep_best: Number of best checkpoints (by metric) to keep.
+        keep_every_n_steps: Optional spacing, in steps, of checkpoints that are never deleted.
+        max_pending: Maximum number of snapshots waiting to be written before save() blocks.
+    """
+
+    def __init__(self, session, var_list, checkpoint_dir, meta_graph_def=None, prefix='model', keep_best=1,
+                 keep_every_n_steps=None, max_pending=2):
+        self.session = session
+        self.names, self.variables = zip(*sorted(var_list.items()))
+        self.checkpoint_dir = checkpoint_dir
+        self.meta_graph = meta_graph_def.SerializeToString() if meta_graph_def is not None else None
+        self.prefix = prefix
+        self.keep_best = keep_best
+        self.keep_every_n_steps = keep_every_n_steps
+
+        self.checkpoints = []
+        self.permanent_steps = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+
+        with tf.Graph().as_default() as graph:
+            placeholders, assigns, shadow_vars = [], [], {}
+            for name, var in zip(self.names, self.variables):
+                dtype = var.dtype.base_dtype
+                shadow = tfcompat.Variable(tf.zeros(var.shape, dtype=dtype), name=name, trainable=False)
+                placeholder = tfcompat.placeholder(dtype, var.shape)
+                placeholders.append(placeholder)
+                assigns.append(tfcompat.assign(shadow, placeholder))
+                shadow_vars[name] = shadow
+            self.placeholders = placeholders
+            self.assign = tf.group(*assigns)
+            self.saver = tfcompat.train.Saver(shadow_vars, max_to_keep=None)
+        self.writer_session = tfcompat.Session(graph=graph)
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, step, metric=None):
+        """Snapshots the variables and queues them to be written as checkpoint step."""
+        self._raise_error()
+        values = self.session.run(list(self.variables))
+        self.queue.put((step, metric, values))
+
+    def wait(self):
+        """Blocks until all queued checkpoints have been written."""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+        self.writer_session.close()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as error:
+                logging.error('Failed to write checkpoint: {} - {}'.format(type(error).__name__, error))
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _write(self, step, metric, values):
+        if not os.path.isdir(self.checkpoint_dir):
+            logging.info('creating checkpoint directory {}'.format(self.checkpoint_dir))
+            os.makedirs(self.checkpoint_dir)
+
+        self.writer_session.run(self.assign, feed_dict=dict(zip(self.placeholders, values)))
+        model_path = self.saver.save(
+            self.writer_session,
+            os.path.join(self.checkpoint_dir, self.prefix),
+            global_step=step,
+            write_meta_graph=False,
+            write_state=False
+        )
+        if self.meta_graph is not None:
+            with open(model_path + '.meta', 'wb') as f:
+                f.write(self.meta_graph)
+        logging.info('saved model to {}'.format(model_path))
+
+        self.checkpoints = [c for c in self.checkpoints if c[0] != step] + [(step, metric, model_path)]
+        if self.keep_every_n_steps and (
+                not self.permanent_steps or step - self.permanent_steps[-1] >= self.keep_every_n_steps):
+            self.permanent_steps.append(step)
+        self._apply_retention(latest_step=step)
+
+        tfcompat.train.update_checkpoint_state(
+            self.checkpoint_dir,
+            model_checkpoint_path=model_path,
+            all_model_checkpoint_paths=[c[2] for c in self.checkpoints]
+        )
+
+    def _apply_retention(self, latest_step):
+        ranked = sorted(self.checkpoints, key=lambda c: float('inf') if c[1] is None else c[1])
+        keep_steps = {c[0] for c in ranked[:self.keep_best]}
+        keep_steps.add(latest_step)
+        keep_steps.update(self.permanent_steps)
+
+        for step, _, model_path in self.checkpoints:
+            if step not in keep_steps:
+                for filename in glob.glob(model_path + '.*'):
+                    os.remove(filename)
+        self.checkpoints = [c for c in self.checkpoints if c[0] in keep_steps]
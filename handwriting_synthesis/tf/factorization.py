@@ -0,0 +1,60 @@
+import logging
+
+import numpy as np
+import tensorflow.compat.v1 as tfcompat
+
+tfcompat.disable_v2_behavior()
+
+
+def truncated_svd(weights, rank):
+    """Factorizes a matrix into u [input_units, rank] and v [rank, output_units] with u.dot(v) ~= weights.
+
+    The singular values are split evenly between the two factors.
+    """
+    u, s, vt = np.linalg.svd(weights, full_matrices=False)
+    root_s = np.sqrt(s[:rank])
+    return (u[:, :rank] * root_s).astype(weights.dtype), (root_s[:, np.newaxis] * vt[:rank]).astype(weights.dtype)
+
+
+def energy_rank(weights, energy):
+    """Returns the smallest rank whose singular values hold at least the fraction energy of the squared
+    Frobenius norm of weights."""
+    s = np.linalg.svd(weights, compute_uv=False)
+    cumulative = np.cumsum(np.square(s)) / np.sum(np.square(s))
+    return int(min(np.searchsorted(cumulative, energy) + 1, len(s)))
+
+
+def restore_factorized(session, variables, model_path):
+    """Loads variables of a graph with factorized weights (tf.weight_matmul with rank) from the checkpoint
+    at model_path, which holds the unfactorized matrices.
+
+    {name}/u and {name}/v are computed from the checkpoint's {name} with truncated_svd, at the rank given by
+    the shape of {name}/u, and other variables are loaded as they are.  Variables missing from the
+    checkpoint (such as optimizer slots of the factors) keep their current values.
+    """
+    reader = tfcompat.train.load_checkpoint(model_path)
+    factors = {}
+    for var in variables:
+        name = var.op.name
+        source_name, _, part = name.rpartition('/')
+        if part in ('u', 'v') and reader.has_tensor(source_name):
+            if source_name not in factors:
+                rank = var.shape.as_list()[1 if part == 'u' else 0]
+                factors[source_name] = truncated_svd(reader.get_tensor(source_name), rank)
+            var.load(factors[source_name][0 if part == 'u' else 1], session)
+        elif reader.has_tensor(name):
+            var.load(reader.get_tensor(name), session)
+        else:
+            logging.info('{} not found in {}, keeping its initial value'.format(name, model_path))
+
+
+def factorized_ranks(model_path):
+    """Returns a dict mapping the scope of every factorized weight matrix in the checkpoint at model_path to
+    its rank, e.g. {'lstm_cell': 64, 'gmm': 32}, which is the ranks argument of RNN.  Hand uses it to load
+    factorized checkpoints without being given their ranks."""
+    shapes = tfcompat.train.load_checkpoint(model_path).get_variable_to_shape_map()
+    ranks = {}
+    for name, shape in shapes.items():
+        if name.endswith('/u') and len(shape) == 2:
+            ranks[name.split('/')[-3]] = shape[1]
+    return ranks
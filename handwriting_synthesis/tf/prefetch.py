@@ -0,0 +1,77 @@
+import queue
+import threading
+
+
+class Prefetcher(object):
+    """Iterator that pulls items from a generator on background threads into a bounded queue.
+
+    Items are drawn from the wrapped generator one at a time (under a lock) and then passed through
+    transform outside the lock, so with num_threads > 1 the transforms run concurrently and items may
+    be yielded out of order.  Exceptions raised by the generator or transform are re-raised by next().
+
+    Args:
+        generator: Iterator to prefetch from.
+        buffer_size: Maximum number of ready items held in the queue.
+        transform: Optional function applied to each item on the background thread.
+        num_threads: Number of background threads.
+    """
+
+    _done = object()
+
+    def __init__(self, generator, buffer_size=4, transform=None, num_threads=1):
+        self.generator = generator
+        self.transform = transform
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.num_running = num_threads
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        try:
+            while not self.stop_event.is_set():
+                with self.lock:
+                    item = next(self.generator, self._done)
+                if item is self._done:
+                    break
+                if self.transform is not None:
+                    item = self.transform(item)
+                self._put((item, None))
+        except Exception as error:
+            self._put((None, error))
+        finally:
+            with self.lock:
+                self.num_running -= 1
+                last = self.num_running == 0
+            if last:
+                self._put((self._done, None))
+
+    def _put(self, entry):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stop_event.is_set():
+            raise StopIteration
+        item, error = self.queue.get()
+        if error is not None:
+            self.close()
+            raise error
+        if item is self._done:
+            self.stop_event.set()
+            raise StopIteration
+        return item
+
+    def close(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,125 @@
+import contextlib
+import json
+import os
+import time
+from collections import defaultdict
+
+import tensorflow.compat.v1 as tfcompat
+from tensorflow.core.framework.step_stats_pb2 import StepStats
+from tensorflow.python.client import timeline
+
+tfcompat.disable_v2_behavior()
+
+
+class StepProfiler(object):
+    """Records a per-phase wall time breakdown of each training step as one JSON line per step.
+
+    Phases are timed with the phase() context manager and accumulate until end_step(), which writes
+    the step number, total step time, the time of each phase, samples/sec and the ratio of padded to
+    real timesteps.  For steps within trace_steps, run_kwargs() returns session.run options that
+    collect a full trace.  A training step can take several session runs (gradient accumulation,
+    truncated backpropagation, the allreduce apply run), so collect_run() is called after each of them
+    to merge its trace into the step's trace, and end_step() writes the merged trace in Chrome trace
+    format (chrome://tracing).
+
+    Args:
+        log_file: Path of the JSONL file written to.  If None, the profiler does nothing.
+        trace_steps: Optional (first, last) range of steps, inclusive, to capture traces for.
+        trace_dir: Directory for trace files.  Defaults to the directory of log_file.
+    """
+
+    def __init__(self, log_file=None, trace_steps=None, trace_dir=None):
+        self.enabled = log_file is not None
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir or (os.path.dirname(log_file) if log_file else None)
+        self.file = None
+        if self.enabled:
+            if os.path.dirname(log_file) and not os.path.isdir(os.path.dirname(log_file)):
+                os.makedirs(os.path.dirname(log_file))
+            self.file = open(log_file, 'a')
+        self.run_metadata = None
+        self.step_stats = None
+        self._reset()
+
+    def _reset(self):
+        self.phases = defaultdict(float)
+        self.num_samples = 0
+        self.real_timesteps = 0
+        self.padded_timesteps = 0
+        self.step_start = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.time() - start
+
+    def add_batch(self, lengths, padded_length):
+        """Counts a batch of sequences with the given lengths, padded to padded_length."""
+        if self.enabled:
+            self.num_samples += len(lengths)
+            self.real_timesteps += int(sum(lengths))
+            self.padded_timesteps += len(lengths) * int(padded_length)
+
+    def run_kwargs(self, step):
+        """Keyword arguments for session.run: trace options if step is in the trace window."""
+        self.run_metadata = None
+        self.step_stats = None
+        if self.trace_steps is not None and self.trace_steps[0] <= step <= self.trace_steps[1]:
+            self.run_metadata = tfcompat.RunMetadata()
+            self.step_stats = StepStats()
+            return {
+                'options': tfcompat.RunOptions(trace_level=tfcompat.RunOptions.FULL_TRACE),
+                'run_metadata': self.run_metadata
+            }
+        return {}
+
+    def collect_run(self):
+        """Merges the trace of the last session.run made with run_kwargs() into the step's trace.
+
+        session.run overwrites run_metadata, so this must be called after every traced run of the step.
+        """
+        if self.run_metadata is None:
+            return
+        devices = {device_stats.device: device_stats for device_stats in self.step_stats.dev_stats}
+        for device_stats in self.run_metadata.step_stats.dev_stats:
+            if device_stats.device in devices:
+                devices[device_stats.device].node_stats.extend(device_stats.node_stats)
+            else:
+                devices[device_stats.device] = self.step_stats.dev_stats.add()
+                devices[device_stats.device].CopyFrom(device_stats)
+        self.run_metadata.Clear()
+
+    def end_step(self, step):
+        step_time = time.time() - self.step_start
+        if self.step_stats is not None:
+            if not os.path.isdir(self.trace_dir):
+                os.makedirs(self.trace_dir)
+            trace = timeline.Timeline(self.step_stats).generate_chrome_trace_format()
+            with open(os.path.join(self.trace_dir, 'timeline-{}.json'.format(step)), 'w') as f:
+                f.write(trace)
+            self.run_metadata = None
+            self.step_stats = None
+
+        if self.enabled:
+            record = {
+                'step': step,
+                'time': round(step_time, 6),
+                'phases': {name: round(value, 6) for name, value in self.phases.items()},
+                'samples_per_sec': round(self.num_samples / step_time, 3) if step_time > 0 else None,
+                'padding_ratio': (
+                    round(self.padded_timesteps / self.real_timesteps, 4) if self.real_timesteps else None),
+            }
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+        self._reset()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,74 @@
+import logging
+
+import numpy as np
+import tensorflow as tf
+import tensorflow.compat.v1 as tfcompat
+
+tfcompat.disable_v2_behavior()
+
+
+def quantize_per_channel(weights):
+    """Symmetric int8 quantization of a [input_units, output_units] matrix with one scale per output unit.
+
+    Returns the int8 values and float32 scales, such that weights ~= values * scales.
+    """
+    scales = np.max(np.abs(weights), axis=0) / 127.0
+    scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+    values = np.clip(np.round(weights / scales), -127, 127).astype(np.int8)
+    return values, scales
+
+
+class QuantizedWeightGetter(object):
+    """Custom getter (tf.variable_scope(custom_getter=...)) that stores weight matrices as per-channel int8.
+
+    Any 2D variable whose name ends with one of suffixes is replaced by two non-trainable variables,
+    {name}/quantized (int8) and {name}/scale (float32, one per output unit), and the getter returns the
+    dequantized matrix in place of the variable.  Dequantization is hoisted out of enclosing while loops,
+    so it runs once per session.run and the matmuls accumulate in float32 (or dtype).
+
+    This emulates the accuracy of int8 weights only.  The matmuls run on the dequantized float copy, so
+    they are no faster and use no less memory than with float weights (TF's CPU int8 matmul kernels are
+    slower than its float32 matmul).
+
+    Args:
+        suffixes: Variable name suffixes of the matrices to quantize.
+        dtype: dtype of the dequantized weights.
+    """
+
+    def __init__(self, suffixes=('kernel', 'weights'), dtype=tf.float32):
+        self.suffixes = tuple(suffixes)
+        self.dtype = dtype
+
+    def __call__(self, getter, name, *args, **kwargs):
+        shape = kwargs.get('shape')
+        if not name.endswith(self.suffixes) or shape is None or len(shape) != 2:
+            return getter(name, *args, **kwargs)
+
+        kwargs.update(trainable=False, dtype=tf.int8, initializer=tfcompat.zeros_initializer())
+        values = getter(name + '/quantized', *args, **kwargs)
+        kwargs.update(shape=[shape[1]], dtype=tf.float32, initializer=tfcompat.ones_initializer())
+        scales = getter(name + '/scale', *args, **kwargs)
+        with tfcompat.init_scope():
+            return tf.cast(values, self.dtype) * tf.cast(scales, self.dtype)
+
+
+def restore_quantized(session, variables, model_path):
+    """Loads variables of a graph built with QuantizedWeightGetter from the float checkpoint at model_path.
+
+    {name}/quantized and {name}/scale are computed from the checkpoint's {name} with quantize_per_channel,
+    and other variables are loaded as they are.  Variables missing from the checkpoint (such as optimizer
+    slots of quantized matrices) keep their current values.
+    """
+    reader = tfcompat.train.load_checkpoint(model_path)
+    quantized = {}
+    for var in variables:
+        name = var.op.name
+        source_name, _, part = name.rpartition('/')
+        if part in ('quantized', 'scale') and reader.has_tensor(source_name):
+            if source_name not in quantized:
+                quantized[source_name] = quantize_per_channel(reader.get_tensor(source_name))
+            var.load(quantized[source_name][0 if part == 'quantized' else 1], session)
+        elif reader.has_tensor(name):
+            var.load(reader.get_tensor(name), session)
+        else:
+            logging.info('{} not found in {}, keeping its initial value'.format(name, model_path))
@@ -5,7 +5,7 @@ tfcompat.disable_v2_behavior()
 
 
 def dense_layer(inputs, output_units, bias=True, activation=None, batch_norm=None,
-                dropout=None, scope='dense-layer', reuse=False):
+                dropout=None, scope='dense-layer', reuse=False, compute_dtype=None, rank=None):
     """
     Applies a dense layer to a 2D tensor of shape [batch_size, input_units]
     to produce a tensor of shape [batch_size, output_units].
@@ -14,16 +14,20 @@ def dense_layer(inputs, output_units, bias=True, activation=None, batch_norm=Non
         output_units: Number of output units.
         activation: activation function.
         dropout: dropout keep prob.
+        compute_dtype: If set, the matmul runs in this dtype and its result is cast back to the dtype of inputs.
+        rank: If set, the weight matrix is factorized to this rank (see weight_matmul).
     Returns:
         Tensor of shape [batch size, output_units].
     """
     with tfcompat.variable_scope(scope, reuse=reuse):
-        W = tfcompat.get_variable(
+        z = weight_matmul(
+            inputs,
+            output_units,
             name='weights',
             initializer=tfcompat.keras.initializers.VarianceScaling(scale=2.0),
-            shape=[shape(inputs, -1), output_units]
+            rank=rank,
+            compute_dtype=compute_dtype
         )
-        z = tf.matmul(inputs, W)
         if bias:
             b = tfcompat.get_variable(
                 name='biases',
@@ -42,7 +46,7 @@ def dense_layer(inputs, output_units, bias=True, activation=None, batch_norm=Non
 
 def time_distributed_dense_layer(
         inputs, output_units, bias=True, activation=None, batch_norm=None,
-        dropout=None, scope='time-distributed-dense-layer', reuse=False):
+        dropout=None, scope='time-distributed-dense-layer', reuse=False, compute_dtype=None, rank=None):
     """
     Applies a shared dense layer to each timestep of a tensor of shape
     [batch_size, max_seq_len, input_units] to produce a tensor of shape
@@ -53,17 +57,21 @@ def time_distributed_dense_layer(
         output_units: Number of output units.
         activation: activation function.
         dropout: dropout keep prob.
+        compute_dtype: If set, the matmul runs in this dtype and its result is cast back to the dtype of inputs.
+        rank: If set, the weight matrix is factorized to this rank (see weight_matmul).
 
     Returns:
         Tensor of shape [batch size, max sequence length, output_units].
     """
     with tfcompat.variable_scope(scope, reuse=reuse):
-        W = tfcompat.get_variable(
+        z = weight_matmul(
+            inputs,
+            output_units,
             name='weights',
             initializer=tfcompat.keras.initializers.VarianceScaling(scale=2.0),
-            shape=[shape(inputs, -1), output_units]
+            rank=rank,
+            compute_dtype=compute_dtype
         )
-        z = tf.einsum('ijk,kl->ijl', inputs, W)
         if bias:
             b = tfcompat.get_variable(
                 name='biases',
@@ -80,6 +88,89 @@ def time_distributed_dense_layer(
         return z
 
 
+def weight_matmul(inputs, output_units, name, initializer=None, rank=None, compute_dtype=None):
+    """
+    Multiplies the last dimension of a 2D or 3D tensor by the weight matrix variable name, of shape
+    [input_units, output_units], created in the current variable scope.
+
+    Args:
+        inputs: Tensor of shape [batch size, input_units] or [batch size, max sequence length, input_units].
+        output_units: Number of output units.
+        name: Name of the weight variable.
+        initializer: Initializer of the weight variable(s).
+        rank: If set, the matrix is factorized as the product of {name}/u of shape [input_units, rank] and
+            {name}/v of shape [rank, output_units], and inputs are multiplied by both in turn.
+        compute_dtype: If set, the matmuls run in this dtype and the result is cast back to the dtype of inputs.
+
+    Returns:
+        Tensor of the shape of inputs, with output_units in the last dimension.
+    """
+    input_units = shape(inputs, -1)
+    if rank is None:
+        factors = [tfcompat.get_variable(name=name, initializer=initializer, shape=[input_units, output_units])]
+    else:
+        factors = [
+            tfcompat.get_variable(name=name + '/u', initializer=initializer, shape=[input_units, rank]),
+            tfcompat.get_variable(name=name + '/v', initializer=initializer, shape=[rank, output_units]),
+        ]
+
+    z = inputs if compute_dtype is None else tf.cast(inputs, compute_dtype)
+    for W in factors:
+        W = W if compute_dtype is None else hoisted_cast(W, compute_dtype)
+        z = tf.einsum('ijk,kl->ijl', z, W) if len(inputs.shape) == 3 else tf.matmul(z, W)
+    return z if compute_dtype is None else tf.cast(z, inputs.dtype)
+
+
+def hoisted_cast(tensor, dtype):
+    """
+    Casts tensor to dtype outside of any enclosing while loop, so that a weight used inside an RNN step
+    is converted once per session.run rather than at every timestep.
+    """
+    if tensor.dtype.base_dtype == dtype:
+        return tensor
+    with tfcompat.init_scope():
+        return tf.cast(tensor, dtype)
+
+
+def local_variable_getter(getter, name, *args, **kwargs):
+    """
+    Custom getter (tf.variable_scope(custom_getter=...)) that creates non-trainable local variables, which
+    are neither updated by the optimizer nor written to checkpoints.
+    """
+    kwargs.update(trainable=False, collections=[tfcompat.GraphKeys.LOCAL_VARIABLES])
+    return getter(name, *args, **kwargs)
+
+
+def hash_uint32(x):
+    """Integer hash (lowbias32) of a uint32 tensor, applied elementwise."""
+    x = tf.bitwise.bitwise_xor(x, tf.bitwise.right_shift(x, tf.constant(16, tf.uint32)))
+    x = x * tf.constant(0x7feb352d, tf.uint32)
+    x = tf.bitwise.bitwise_xor(x, tf.bitwise.right_shift(x, tf.constant(15, tf.uint32)))
+    x = x * tf.constant(0x846ca68b, tf.uint32)
+    return tf.bitwise.bitwise_xor(x, tf.bitwise.right_shift(x, tf.constant(16, tf.uint32)))
+
+
+def hashed_uniform(seeds, counters, num, offset=0):
+    """
+    Counter-based uniform random numbers: returns a [batch_size, num] float32 tensor in (0, 1) whose row i
+    is a deterministic function of seeds[i], counters[i] and the column index (plus offset) only, so it
+    does not depend on the other rows, the batch size or how often the op has run.
+    Args:
+        seeds: int32 tensor of shape [batch_size].
+        counters: int32 tensor of shape [batch_size], or a scalar used for every row.
+        num: Number of columns.
+        offset: Index of the first column, to draw disjoint numbers with the same seeds and counters.
+    """
+    counters = tf.broadcast_to(counters, tf.shape(seeds))
+    key = hash_uint32(tf.bitcast(seeds, tf.uint32))
+    key = hash_uint32(tf.bitwise.bitwise_xor(key, tf.bitcast(counters, tf.uint32)))
+    columns = tf.range(offset, offset + num)
+    x = hash_uint32(tf.bitwise.bitwise_xor(
+        tf.expand_dims(key, 1), tf.expand_dims(hash_uint32(tf.bitcast(columns, tf.uint32)), 0)))
+    # The top 24 bits, centered in their interval so that neither 0 nor 1 is produced.
+    return (tf.cast(tf.bitwise.right_shift(x, tf.constant(8, tf.uint32)), tf.float32) + 0.5) / float(1 << 24)
+
+
 def shape(tensor, dim=None):
     """Get tensor shape/dimension as list/int"""
     if dim is None:
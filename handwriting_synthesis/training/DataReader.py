@@ -12,7 +12,10 @@ tfcompat.disable_v2_behavior()
 
 
 class DataReader(object):
-    def __init__(self, data_dir):
+    def __init__(self, data_dir, num_buckets=None, num_buffers=None, augmentation=None):
+        self.num_buckets = num_buckets
+        self.num_buffers = num_buffers
+        self.augmentation = augmentation
         data_cols = ['x', 'x_len', 'c', 'c_len']
         data = [np.load(os.path.join(data_dir, '{}.npy'.format(i))) for i in data_cols]
 
@@ -29,7 +32,10 @@ class DataReader(object):
             df=self.train_df,
             shuffle=True,
             num_epochs=10000,
-            mode='train'
+            mode='train',
+            num_buckets=self.num_buckets,
+            num_buffers=self.num_buffers,
+            augmentation=self.augmentation
         )
 
     def val_batch_generator(self, batch_size):
@@ -38,7 +44,8 @@ class DataReader(object):
             df=self.val_df,
             shuffle=True,
             num_epochs=10000,
-            mode='val'
+            mode='val',
+            num_buffers=self.num_buffers
         )
 
     def test_batch_generator(self, batch_size):
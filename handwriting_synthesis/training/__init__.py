@@ -1,3 +1,8 @@
 from .DataReader import DataReader
+from .augmentation import StrokeAugmenter
 from .batch_generator import batch_generator
+from .benchmark import benchmark_precision, compare_models
+from .distill import distill
+from .factorize import evaluate_factorization, factorize_checkpoint
+from .quantize import evaluate_quantization, quantize_checkpoint
 from .train import train
@@ -0,0 +1,42 @@
+import numpy as np
+
+
+class StrokeAugmenter(object):
+    """Applies random skew, stretch and gaussian noise to a whole batch of stroke offsets at once.
+
+    Batched equivalent of drawing.skew, drawing.stretch and drawing.add_noise.  Skew and stretch are
+    linear, so they are combined into a single 2x2 matrix per sample and applied to the offsets with one
+    batched matmul.  Noise is drawn on the pen coordinates (the first point stays fixed, as in
+    drawing.add_noise) and converted to offsets, then zeroed beyond each sequence's length so padding
+    stays zero.
+
+    Args:
+        skew_degrees: Maximum absolute skew angle, sampled uniformly per sample.
+        stretch_range: (low, high) range from which the x and y stretch factors are sampled.
+        noise_scale: Standard deviation of the coordinate noise.
+    """
+
+    def __init__(self, skew_degrees=5.0, stretch_range=(0.9, 1.1), noise_scale=0.05):
+        self.skew_degrees = skew_degrees
+        self.stretch_range = stretch_range
+        self.noise_scale = noise_scale
+
+    def __call__(self, x, x_len):
+        """Augments x of shape [batch_size, max_len, 3] in place, given the number of valid steps in x_len."""
+        batch_size, max_len = x.shape[:2]
+
+        theta = np.random.uniform(-self.skew_degrees, self.skew_degrees, batch_size) * np.pi / 180
+        transform = np.zeros([batch_size, 2, 2])
+        transform[:, 0, 0] = np.cos(-theta)
+        transform[:, 1, 0] = np.sin(-theta)
+        transform[:, 1, 1] = 1.0
+        transform *= np.random.uniform(*self.stretch_range, size=[batch_size, 1, 2])
+        x[:, :, :2] = np.matmul(x[:, :, :2], transform.astype(x.dtype))
+
+        if self.noise_scale:
+            noise = np.random.normal(scale=self.noise_scale, size=[batch_size, max_len, 2]).astype(x.dtype)
+            noise[:, 0] = 0.0
+            noise[:, 1:] -= noise[:, :-1].copy()
+            noise *= (np.arange(max_len) < np.reshape(x_len, [-1, 1]))[:, :, np.newaxis]
+            x[:, :, :2] += noise
+        return x
@@ -1,17 +1,32 @@
 import numpy as np
 
 
-def batch_generator(batch_size, df, shuffle=True, num_epochs=10000, mode='train'):
-    gen = df.batch_generator(
-        batch_size=batch_size,
-        shuffle=shuffle,
-        num_epochs=num_epochs,
-        allow_smaller_final_batch=(mode == 'test')
-    )
+def batch_generator(batch_size, df, shuffle=True, num_epochs=10000, mode='train', num_buckets=None,
+                    num_buffers=None, augmentation=None):
+    if num_buckets:
+        gen = df.bucketed_batch_generator(
+            batch_size=batch_size,
+            key='x_len',
+            num_buckets=num_buckets,
+            shuffle=shuffle,
+            num_epochs=num_epochs,
+            allow_smaller_final_batch=(mode == 'test'),
+            num_buffers=num_buffers
+        )
+    else:
+        gen = df.batch_generator(
+            batch_size=batch_size,
+            shuffle=shuffle,
+            num_epochs=num_epochs,
+            allow_smaller_final_batch=(mode == 'test'),
+            num_buffers=num_buffers
+        )
     for batch in gen:
         batch['x_len'] = batch['x_len'] - 1
         max_x_len = np.max(batch['x_len'])
         max_c_len = np.max(batch['c_len'])
+        if augmentation is not None:
+            augmentation(batch['x'][:, :max_x_len + 1, :], batch['x_len'] + 1)
         batch['y'] = batch['x'][:, 1:max_x_len + 1, :]
         batch['x'] = batch['x'][:, :max_x_len, :]
         batch['c'] = batch['c'][:, :max_c_len]
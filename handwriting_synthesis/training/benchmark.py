@@ -0,0 +1,156 @@
+import logging
+import tempfile
+import time
+
+import numpy as np
+
+from handwriting_synthesis.config import processed_data_path, checkpoint_path
+from handwriting_synthesis.rnn import RNN
+from handwriting_synthesis.training.DataReader import DataReader
+
+# Architecture of the shipped checkpoint, as trained by training.train.
+MODEL_PARAMS = dict(
+    lstm_size=400,
+    output_mixture_components=20,
+    attention_mixture_components=10,
+)
+
+
+def build_model(reader=None, checkpoint_dir=checkpoint_path, **kwargs):
+    """Builds an RNN for evaluation, with the architecture of the shipped checkpoint unless overridden.
+
+    Logs and predictions go to a temporary directory so benchmarks never write next to the checkpoint.
+    """
+    log_dir = tempfile.mkdtemp()
+    params = dict(
+        reader=reader,
+        log_dir=log_dir,
+        checkpoint_dir=checkpoint_dir,
+        prediction_dir=log_dir,
+        learning_rates=[.0001],
+        batch_sizes=[32],
+        patiences=[1500],
+        beta1_decays=[.9],
+        optimizer='rms',
+        grad_clip=10,
+        logging_level=logging.WARNING,
+    )
+    params.update(MODEL_PARAMS)
+    params.update(kwargs)
+    return RNN(**params)
+
+
+def validation_batches(reader, num_batches, batch_size):
+    """Returns num_batches validation batches, copied out of the generator so they can be reused."""
+    val_generator = reader.val_batch_generator(batch_size)
+    return [{name: np.array(data) for name, data in next(val_generator).items()} for _ in range(num_batches)]
+
+
+def sampling_throughput(nn, feed_dict, sample_tsteps, num_repeats=3):
+    """Returns the number of sampled timesteps per second when sampling the characters in feed_dict."""
+    num_samples = len(feed_dict[nn.c])
+    sample_feed_dict = {
+        nn.prime: False,
+        nn.x_prime: np.zeros([num_samples, 1, 3]),
+        nn.x_prime_len: np.zeros([num_samples]),
+        nn.num_samples: num_samples,
+        nn.sample_tsteps: sample_tsteps,
+        nn.c: feed_dict[nn.c],
+        nn.c_len: feed_dict[nn.c_len],
+    }
+    nn.session.run(nn.sampled_sequence, feed_dict=sample_feed_dict)
+    start = time.time()
+    for _ in range(num_repeats):
+        nn.session.run(nn.sampled_sequence, feed_dict=sample_feed_dict)
+    return num_repeats * num_samples * sample_tsteps / (time.time() - start)
+
+
+def training_throughput(nn, feed_dicts):
+    """Returns the number of training sequences per second over feed_dicts, after one warmup step.
+
+    This updates the parameters of nn, so it should run after any evaluation.
+    """
+    hyperparameters = {nn.learning_rate_var: nn.learning_rate, nn.beta1_decay_var: nn.beta1_decay}
+    feed_dicts = [dict(feed_dict) for feed_dict in feed_dicts]
+    for feed_dict in feed_dicts:
+        feed_dict.update(hyperparameters)
+
+    nn.train_step(feed_dicts[0])
+    start = time.time()
+    for feed_dict in feed_dicts:
+        nn.train_step(feed_dict)
+    return sum(len(feed_dict[nn.x]) for feed_dict in feed_dicts) / (time.time() - start)
+
+
+def compare_models(configurations, reader=None, num_batches=10, batch_size=32, sample_tsteps=400,
+                   measure_training=True):
+    """Measures validation NLL, sampling and (optionally) training throughput of several model configurations.
+
+    Every configuration is built with build_model, restores its latest checkpoint and is evaluated on the
+    same validation batches.  Returns a dict mapping each configuration name to its measurements, and prints
+    them relative to the first configuration.
+
+    Args:
+        configurations: List of (name, kwargs) pairs, where kwargs are passed to build_model.
+        reader: DataReader providing validation batches.  Defaults to the processed training data.
+        num_batches: Number of validation batches to evaluate and train on.
+        batch_size: Batch size of evaluation, training and sampling.
+        sample_tsteps: Number of timesteps to sample.
+        measure_training: Whether to measure training throughput.
+    """
+    reader = reader or DataReader(data_dir=processed_data_path)
+    batches = validation_batches(reader, num_batches, batch_size)
+    results = {}
+    for name, kwargs in configurations:
+        nn = build_model(reader=reader, **kwargs)
+        nn.restore()
+        feed_dicts = [nn.batch_feed_dict(batch, is_training=False) for batch in batches]
+
+        nll, _ = nn.evaluate(feed_dicts)
+        results[name] = {
+            'nll': float(nll),
+            'sampled_tsteps_per_sec': sampling_throughput(nn, feed_dicts[0], sample_tsteps),
+        }
+        if measure_training:
+            results[name]['train_sequences_per_sec'] = training_throughput(nn, feed_dicts)
+        nn.session.close()
+
+    log_comparison(results, baseline=configurations[0][0])
+    return results
+
+
+def benchmark_precision(precisions=('float32', 'bfloat16', 'float16'), reader=None, num_batches=10,
+                        batch_size=32, sample_tsteps=400, **kwargs):
+    """Compares validation NLL, training and sampling throughput of the RNN across precisions.
+
+    Every precision restores the same float32 checkpoint, and the first precision is the baseline.  Other
+    arguments are as in compare_models, and kwargs override the model parameters passed to build_model.
+    Reduced precision is often slower than float32 on CPUs (float16 always is, being emulated), so run this
+    on the target machine before enabling it.
+    """
+    return compare_models(
+        [(precision, dict(kwargs, precision=precision)) for precision in precisions],
+        reader=reader,
+        num_batches=num_batches,
+        batch_size=batch_size,
+        sample_tsteps=sample_tsteps
+    )
+
+
+def log_comparison(results, baseline):
+    """Prints each configuration's measurements, with the NLL difference and speedups over baseline."""
+    base = results[baseline]
+    for name, result in results.items():
+        line = '{:<12} nll: {:<10} ({:+.4f})     sample: {:>8.1f} tsteps/s (x{:.2f})'.format(
+            name,
+            round(result['nll'], 4),
+            result['nll'] - base['nll'],
+            result['sampled_tsteps_per_sec'],
+            result['sampled_tsteps_per_sec'] / base['sampled_tsteps_per_sec'],
+        )
+        if 'train_sequences_per_sec' in result:
+            line += '     train: {:>8.1f} seq/s (x{:.2f})'.format(
+                result['train_sequences_per_sec'],
+                result['train_sequences_per_sec'] / base['train_sequences_per_sec'],
+            )
+        print(line)
@@ -0,0 +1,58 @@
+import logging
+
+import tensorflow as tf
+
+from handwriting_synthesis.config import processed_data_path, checkpoint_path, prediction_path, \
+    student_checkpoint_path
+from handwriting_synthesis.rnn import DistilledRNN
+from handwriting_synthesis.training import DataReader
+
+
+def distill(lstm_size=256, output_mixture_components=20, attention_mixture_components=10, objective='kl',
+            teacher_checkpoint_dir=checkpoint_path, checkpoint_dir=student_checkpoint_path):
+    """Trains a smaller student RNN to match the latest checkpoint in teacher_checkpoint_dir.
+
+    The teacher has the architecture trained by train().  Student checkpoints are written to checkpoint_dir
+    and can be sampled from with Hand(checkpoint_dir=checkpoint_dir, lstm_size=lstm_size, ...).  See
+    DistilledRNN for the objectives.
+    """
+    teacher_checkpoint = tf.train.latest_checkpoint(teacher_checkpoint_dir)
+    assert teacher_checkpoint is not None, 'no checkpoint found in {}'.format(teacher_checkpoint_dir)
+
+    # Batches may sit in the prefetch queue, so the buffer ring must outlive prefetch_batches + 2 batches.
+    dr = DataReader(data_dir=processed_data_path, num_buckets=20, num_buffers=8)
+
+    nn = DistilledRNN(
+        teacher_checkpoint=teacher_checkpoint,
+        teacher_lstm_size=400,
+        teacher_output_mixture_components=20,
+        teacher_attention_mixture_components=10,
+        objective=objective,
+        reader=dr,
+        log_dir='logs',
+        checkpoint_dir=checkpoint_dir,
+        prediction_dir=prediction_path,
+        learning_rates=[.0001, .00005, .00002],
+        batch_sizes=[32, 64, 64],
+        patiences=[1500, 1000, 500],
+        beta1_decays=[.9, .9, .9],
+        validation_batch_size=32,
+        num_validation_batches=20,
+        validation_interval=100,
+        prefetch_batches=4,
+        # Hand restores the RMSProp slots as well, so the student must use the same optimizer.
+        optimizer='rms',
+        num_training_steps=100000,
+        warm_start_init_step=0,
+        regularization_constant=0.0,
+        keep_prob=1.0,
+        enable_parameter_averaging=False,
+        min_steps_to_checkpoint=2000,
+        log_interval=20,
+        logging_level=logging.INFO,
+        grad_clip=10,
+        lstm_size=lstm_size,
+        output_mixture_components=output_mixture_components,
+        attention_mixture_components=attention_mixture_components
+    )
+    nn.fit()
@@ -0,0 +1,157 @@
+import logging
+import os
+
+import tensorflow as tf
+import tensorflow.compat.v1 as tfcompat
+
+from handwriting_synthesis.config import checkpoint_path, factorized_checkpoint_path, processed_data_path
+from handwriting_synthesis.tf.factorization import energy_rank, restore_factorized
+from handwriting_synthesis.training.DataReader import DataReader
+from handwriting_synthesis.training.benchmark import build_model, compare_models
+
+tfcompat.disable_v2_behavior()
+
+# Weight matrices that can be factorized, by the scope name used in the ranks argument of RNN.
+FACTORIZABLE_WEIGHTS = {
+    'lstm_cell': 'rnn/LSTMAttentionCell/lstm_cell/kernel',
+    'lstm_cell_1': 'rnn/LSTMAttentionCell/lstm_cell_1/kernel',
+    'lstm_cell_2': 'rnn/LSTMAttentionCell/lstm_cell_2/kernel',
+    'attention': 'rnn/LSTMAttentionCell/attention/weights',
+    'gmm': 'rnn/gmm/weights',
+}
+
+
+def weight_shapes(model_path):
+    """Returns the [input_units, output_units] shape of every factorizable matrix in the checkpoint."""
+    shapes = tfcompat.train.load_checkpoint(model_path).get_variable_to_shape_map()
+    return {scope: tuple(shapes[name]) for scope, name in FACTORIZABLE_WEIGHTS.items()}
+
+
+def select_ranks(model_path, rank=None, energy=None):
+    """Returns the rank of every matrix to factorize, given either a fixed rank or an energy fraction.
+
+    With energy, each matrix gets the smallest rank whose singular values hold that fraction of its squared
+    Frobenius norm.  Matrices whose factorization would not reduce the number of multiply-adds are left out,
+    and stay dense.
+    """
+    assert (rank is None) != (energy is None), 'exactly one of rank and energy must be given'
+    reader = tfcompat.train.load_checkpoint(model_path)
+    ranks = {}
+    for scope, name in FACTORIZABLE_WEIGHTS.items():
+        weights = reader.get_tensor(name)
+        input_units, output_units = weights.shape
+        layer_rank = rank if rank is not None else energy_rank(weights, energy)
+        if layer_rank * (input_units + output_units) < input_units * output_units:
+            ranks[scope] = int(layer_rank)
+    return ranks
+
+
+def matmul_flops(shapes, ranks):
+    """Floating point operations of the weight matmuls for one sequence and one timestep."""
+    flops = 0
+    for scope, (input_units, output_units) in shapes.items():
+        if scope in ranks:
+            flops += 2 * ranks[scope] * (input_units + output_units)
+        else:
+            flops += 2 * input_units * output_units
+    return flops
+
+
+def factorize_checkpoint(rank=None, energy=None, checkpoint_dir=checkpoint_path,
+                         output_dir=factorized_checkpoint_path, fine_tune_steps=0, reader=None, **kwargs):
+    """Converts the latest checkpoint in checkpoint_dir to low-rank weights, and writes it to output_dir.
+
+    The LSTM kernels and the attention and gmm weights are replaced by truncated SVD factors, at the ranks
+    chosen by select_ranks, and everything else is copied.  With fine_tune_steps, the factorized model is
+    then trained for that many steps (with BaseModel.fit, on reader or the processed training data) to
+    recover from the truncation, and checkpoints are written to output_dir whenever validation improves.
+    kwargs override the model parameters passed to build_model.
+
+    Returns the ranks, which must be passed to RNN to load the checkpoint; Hand reads them from the
+    checkpoint (tf.factorized_ranks).
+    """
+    model_path = tf.train.latest_checkpoint(checkpoint_dir)
+    assert model_path is not None, 'no checkpoint found in {}'.format(checkpoint_dir)
+    ranks = select_ranks(model_path, rank, energy)
+    logging.info('factorizing {} with ranks {}'.format(model_path, ranks))
+
+    nn = build_model(checkpoint_dir=output_dir, ranks=ranks, **kwargs)
+    nn.session.run(nn.init)
+    restore_factorized(nn.session, nn.graph.get_collection(tfcompat.GraphKeys.GLOBAL_VARIABLES), model_path)
+    step = int(nn.session.run(nn.global_step))
+    nn.save(step)
+    nn.wait_for_checkpoints()
+    nn.session.close()
+
+    if fine_tune_steps:
+        params = dict(
+            learning_rates=[.00002],
+            patiences=[fine_tune_steps],
+            validation_interval=max(fine_tune_steps // 10, 1),
+            num_validation_batches=10,
+            # The factorized checkpoint is restored even when its global_step is 0.
+            warm_start=True,
+            warm_start_init_step=step,
+            num_training_steps=step + fine_tune_steps,
+            min_steps_to_checkpoint=step,
+        )
+        params.update(kwargs)
+        nn = build_model(
+            reader=reader or DataReader(data_dir=processed_data_path),
+            checkpoint_dir=output_dir,
+            ranks=ranks,
+            **params
+        )
+        nn.fit()
+        nn.session.close()
+    return ranks
+
+
+def evaluate_factorization(ranks=(32, 64, 128, 256), energies=None, fine_tune_steps=0,
+                           checkpoint_dir=checkpoint_path, output_dir=factorized_checkpoint_path, reader=None,
+                           num_batches=10, batch_size=32, sample_tsteps=400, **kwargs):
+    """Factorizes the latest checkpoint at several ranks (or energy fractions) and reports NLL against FLOPs.
+
+    Each factorization is written to a subdirectory of output_dir, optionally fine-tuned, and compared with
+    the dense model with compare_models.  The weight matmul FLOPs per timestep of each model are printed
+    next to its validation NLL.  Other arguments are as in factorize_checkpoint and training.compare_models.
+    Returns compare_models' results, with 'flops_per_tstep' and 'ranks' added to each entry.
+    """
+    reader = reader or DataReader(data_dir=processed_data_path)
+    shapes = weight_shapes(tf.train.latest_checkpoint(checkpoint_dir))
+    targets = [('rank-{}'.format(rank), dict(rank=rank)) for rank in ranks or ()]
+    targets += [('energy-{}'.format(energy), dict(energy=energy)) for energy in energies or ()]
+
+    configurations = [('dense', dict(kwargs, checkpoint_dir=checkpoint_dir))]
+    layer_ranks = {'dense': {}}
+    for name, target in targets:
+        target_dir = os.path.join(output_dir, name)
+        layer_ranks[name] = factorize_checkpoint(
+            checkpoint_dir=checkpoint_dir,
+            output_dir=target_dir,
+            fine_tune_steps=fine_tune_steps,
+            reader=reader,
+            **dict(kwargs, **target)
+        )
+        configurations.append((name, dict(kwargs, checkpoint_dir=target_dir, ranks=layer_ranks[name])))
+
+    results = compare_models(
+        configurations,
+        reader=reader,
+        num_batches=num_batches,
+        batch_size=batch_size,
+        sample_tsteps=sample_tsteps,
+        measure_training=False
+    )
+    dense_flops = matmul_flops(shapes, {})
+    for name, result in results.items():
+        result['ranks'] = layer_ranks[name]
+        result['flops_per_tstep'] = matmul_flops(shapes, layer_ranks[name])
+        print('{:<12} nll: {:<10} flops/tstep: {:>10} ({:.1%})     ranks: {}'.format(
+            name,
+            round(result['nll'], 4),
+            result['flops_per_tstep'],
+            result['flops_per_tstep'] / dense_flops,
+            result['ranks'],
+        ))
+    return results
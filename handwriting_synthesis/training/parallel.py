@@ -0,0 +1,44 @@
+import multiprocessing
+import os
+import time
+
+from handwriting_synthesis.tf import SharedMemoryAllReduce
+
+
+def run_data_parallel(worker_fn, num_workers):
+    """Runs worker_fn(allreduce) in num_workers spawned processes on this machine.
+
+    worker_fn must be a picklable (module level) function.  Each process receives a SharedMemoryAllReduce
+    with its own rank.  If any worker fails, the remaining workers are stopped and RuntimeError is raised.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(num_workers)
+    name = 'handwriting-synthesis-{}'.format(os.getpid())
+    processes = [
+        ctx.Process(target=_run_worker, args=(worker_fn, name, rank, num_workers, barrier))
+        for rank in range(num_workers)
+    ]
+    for process in processes:
+        process.start()
+
+    while any(process.is_alive() for process in processes):
+        if any(process.exitcode not in (None, 0) for process in processes):
+            barrier.abort()
+            for process in processes:
+                process.terminate()
+            break
+        time.sleep(1)
+
+    for process in processes:
+        process.join()
+    failed = [rank for rank, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError('data parallel workers {} failed'.format(failed))
+
+
+def _run_worker(worker_fn, name, rank, num_workers, barrier):
+    allreduce = SharedMemoryAllReduce(name, rank, num_workers, barrier)
+    try:
+        worker_fn(allreduce)
+    finally:
+        allreduce.close()
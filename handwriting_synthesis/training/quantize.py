@@ -0,0 +1,47 @@
+import tensorflow as tf
+import tensorflow.compat.v1 as tfcompat
+
+from handwriting_synthesis.config import checkpoint_path, quantized_checkpoint_path
+from handwriting_synthesis.tf.quantization import restore_quantized
+from handwriting_synthesis.training.benchmark import build_model, compare_models
+
+tfcompat.disable_v2_behavior()
+
+
+def quantize_checkpoint(checkpoint_dir=checkpoint_path, output_dir=quantized_checkpoint_path, **kwargs):
+    """Converts the latest float checkpoint in checkpoint_dir to an int8 checkpoint in output_dir.
+
+    The LSTM kernels and the attention and gmm weights are quantized per output unit, and everything else
+    is copied.  The result is loaded by RNN(quantized=True), e.g. Hand(quantized=True).  kwargs override
+    the model parameters passed to build_model.  Returns the path of the written checkpoint.
+    """
+    nn = build_model(checkpoint_dir=output_dir, quantized=True, **kwargs)
+    model_path = tf.train.latest_checkpoint(checkpoint_dir)
+    assert model_path is not None, 'no checkpoint found in {}'.format(checkpoint_dir)
+
+    nn.session.run(nn.init)
+    restore_quantized(nn.session, nn.graph.get_collection(tfcompat.GraphKeys.GLOBAL_VARIABLES), model_path)
+    nn.save(int(nn.session.run(nn.global_step)))
+    nn.wait_for_checkpoints()
+    nn.session.close()
+    return tf.train.latest_checkpoint(output_dir)
+
+
+def evaluate_quantization(checkpoint_dir=checkpoint_path, output_dir=quantized_checkpoint_path, reader=None,
+                          num_batches=10, batch_size=32, sample_tsteps=400, **kwargs):
+    """Quantizes the latest checkpoint and compares validation NLL and sampling throughput with the float model.
+
+    Arguments are as in quantize_checkpoint and training.compare_models.
+    """
+    quantize_checkpoint(checkpoint_dir, output_dir, **kwargs)
+    return compare_models(
+        [
+            ('float32', dict(kwargs, checkpoint_dir=checkpoint_dir)),
+            ('int8', dict(kwargs, checkpoint_dir=output_dir, quantized=True)),
+        ],
+        reader=reader,
+        num_batches=num_batches,
+        batch_size=batch_size,
+        sample_tsteps=sample_tsteps,
+        measure_training=False
+    )
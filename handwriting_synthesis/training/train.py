@@ -1,21 +1,58 @@
+import functools
+import logging
+import os
+
 from handwriting_synthesis.config import processed_data_path, checkpoint_path, prediction_path
 from handwriting_synthesis.rnn import RNN
 from handwriting_synthesis.training import DataReader
+from handwriting_synthesis.training.parallel import run_data_parallel
+
+# Global batch sizes, split evenly across data-parallel workers.
+BATCH_SIZES = [32, 64, 64]
+VALIDATION_BATCH_SIZE = 32
+
+
+def train(num_workers=1, precision='float32', augmentation=None):
+    """Trains the model, optionally data-parallel across num_workers processes on this machine.
+
+    With num_workers > 1, each worker trains on batches of batch_size / num_workers and gradients are
+    averaged across workers, so the effective batch sizes match single-process training.  precision
+    selects float32, bfloat16 or float16 execution of the RNN (see RNN).  augmentation (e.g. a
+    StrokeAugmenter) is applied to every training batch, as in DataReader.  num_workers must divide every
+    batch size, so that each worker gets a whole, non-empty share of every batch.
+    """
+    assert all(size % num_workers == 0 for size in BATCH_SIZES + [VALIDATION_BATCH_SIZE]), \
+        'num_workers must divide the batch sizes {} and validation batch size {}'.format(
+            BATCH_SIZES, VALIDATION_BATCH_SIZE)
+    if num_workers > 1:
+        run_data_parallel(
+            functools.partial(_train, precision=precision, augmentation=augmentation), num_workers)
+    else:
+        _train(precision=precision, augmentation=augmentation)
+
 
+def _train(allreduce=None, precision='float32', augmentation=None):
+    num_workers = allreduce.num_workers if allreduce is not None else 1
+    is_chief = allreduce is None or allreduce.rank == 0
 
-def train():
-    dr = DataReader(data_dir=processed_data_path)
+    # Batches may sit in the prefetch queue, so the buffer ring must outlive prefetch_batches + 2 batches.
+    dr = DataReader(data_dir=processed_data_path, num_buckets=20, num_buffers=8, augmentation=augmentation)
 
     nn = RNN(
         reader=dr,
-        log_dir='logs',
+        log_dir='logs' if is_chief else os.path.join('logs', 'worker-{}'.format(allreduce.rank)),
         checkpoint_dir=checkpoint_path,
         prediction_dir=prediction_path,
         learning_rates=[.0001, .00005, .00002],
-        batch_sizes=[32, 64, 64],
+        batch_sizes=[size // num_workers for size in BATCH_SIZES],
         patiences=[1500, 1000, 500],
         beta1_decays=[.9, .9, .9],
-        validation_batch_size=32,
+        validation_batch_size=VALIDATION_BATCH_SIZE // num_workers,
+        num_validation_batches=20,
+        validation_interval=100,
+        prefetch_batches=4,
+        allreduce=allreduce,
+        num_threads=max(os.cpu_count() // num_workers, 1) if num_workers > 1 else None,
         optimizer='rms',
         num_training_steps=100000,
         warm_start_init_step=0,
@@ -24,9 +61,13 @@ def train():
         enable_parameter_averaging=False,
         min_steps_to_checkpoint=2000,
         log_interval=20,
+        logging_level=logging.INFO if is_chief else logging.WARNING,
         grad_clip=10,
         lstm_size=400,
         output_mixture_components=20,
-        attention_mixture_components=10
+        attention_mixture_components=10,
+        precision=precision,
+        # float16 workers need a common loss scale, which dynamic scaling cannot guarantee.
+        loss_scale=2.0 ** 12 if precision == 'float16' and num_workers > 1 else None
     )
     nn.fit()
@@ -0,0 +1,25 @@
+import logging
+
+import pytest
+
+from handwriting_synthesis.rnn import RNN
+
+
+@pytest.fixture(scope='session')
+def small_model(tmp_path_factory):
+    """Saves a small randomly initialized model, and returns the Hand arguments that load it."""
+    directory = tmp_path_factory.mktemp('small_model')
+    model_kwargs = dict(lstm_size=16, output_mixture_components=3, attention_mixture_components=2)
+    nn = RNN(
+        log_dir=str(directory / 'logs'),
+        checkpoint_dir=str(directory / 'checkpoint'),
+        prediction_dir=str(directory / 'predictions'),
+        optimizer='rms',
+        logging_level=logging.CRITICAL,
+        **model_kwargs
+    )
+    nn.session.run(nn.init)
+    nn.save(1)
+    nn.wait_for_checkpoints()
+    nn.session.close()
+    return dict(checkpoint_dir=str(directory / 'checkpoint'), **model_kwargs)
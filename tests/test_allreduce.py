@@ -0,0 +1,22 @@
+import numpy as np
+
+from handwriting_synthesis.training.parallel import run_data_parallel
+
+NUM_WORKERS = 3
+NUM_ROUNDS = 30
+SIZE = 1 << 20
+
+
+def _mean_broadcast_worker(allreduce):
+    allreduce.setup(SIZE)
+    expected_mean = np.mean(np.arange(NUM_WORKERS))
+    for i in range(NUM_ROUNDS):
+        [mean] = allreduce.mean([np.full(SIZE, allreduce.rank + i, dtype=np.float32)])
+        assert np.all(mean == expected_mean + i), 'mean of round {} was overwritten'.format(i)
+
+        [broadcast] = allreduce.broadcast([np.full(SIZE, allreduce.rank - 1000.0 - i, dtype=np.float32)])
+        assert np.all(broadcast == -1000.0 - i), 'broadcast of round {} is wrong'.format(i)
+
+
+def test_mean_broadcast_sequences():
+    run_data_parallel(_mean_broadcast_worker, NUM_WORKERS)
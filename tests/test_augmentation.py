@@ -0,0 +1,39 @@
+import numpy as np
+
+from handwriting_synthesis import drawing
+from handwriting_synthesis.training import StrokeAugmenter
+
+BATCH_SIZE = 4
+MAX_LEN = 30
+
+
+def _batch(seed=0):
+    rng = np.random.RandomState(seed)
+    x_len = np.array([30, 12, 1, 20])
+    x = np.zeros([BATCH_SIZE, MAX_LEN, 3], dtype=np.float32)
+    for i, length in enumerate(x_len):
+        x[i, :length, :2] = rng.randn(length, 2)
+        x[i, :length, 2] = rng.rand(length) < 0.1
+    return x, x_len
+
+
+def test_padding_is_left_untouched():
+    x, x_len = _batch()
+    augmented = StrokeAugmenter(noise_scale=0.5)(x.copy(), x_len)
+    for i, length in enumerate(x_len):
+        assert np.all(augmented[i, length:] == 0.0)
+    assert np.array_equal(augmented[:, :, 2], x[:, :, 2])
+
+
+def test_matches_skew_and_stretch():
+    x, x_len = _batch()
+    np.random.seed(1)
+    augmented = StrokeAugmenter(skew_degrees=10.0, stretch_range=(0.8, 1.2), noise_scale=0.0)(x.copy(), x_len)
+
+    # The same draws as StrokeAugmenter, in the same order.
+    np.random.seed(1)
+    degrees = np.random.uniform(-10.0, 10.0, BATCH_SIZE)
+    factors = np.random.uniform(0.8, 1.2, size=[BATCH_SIZE, 1, 2])
+    for i in range(BATCH_SIZE):
+        expected = drawing.stretch(drawing.skew(x[i], degrees[i]), *factors[i, 0])
+        np.testing.assert_allclose(augmented[i], expected, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from handwriting_synthesis.tf import BaseModel
+
+
+class _Model(object):
+    validation_batch_size = 64
+
+
+def test_validation_subset_copies_batches():
+    batches = ({'x': np.full([2], i)} for i in range(5))
+    subset = BaseModel.validation_subset(_Model(), batches, 3)
+    assert [feed_dict['x'][0] for feed_dict in subset] == [0, 1, 2]
+
+
+def test_validation_subset_of_short_split():
+    subset = BaseModel.validation_subset(_Model(), iter([{'x': np.zeros(2)}]), 10)
+    assert len(subset) == 1
+
+
+def test_validation_subset_of_empty_split():
+    with pytest.raises(ValueError, match='validation_batch_size=64'):
+        BaseModel.validation_subset(_Model(), iter([]), 10)
@@ -0,0 +1,18 @@
+import numpy as np
+
+from handwriting_synthesis.hand import ContinuousSampler, Hand
+
+LINES = ['hello world', 'a', 'the quick brown fox', 'xyz abc']
+SEEDS = [1, 2, 3, 4]
+
+
+def test_same_strokes_as_batched_sampling(small_model):
+    hand = Hand(**small_model)
+    for styles in (None, [1, None, 3, 5]):
+        expected = hand._sample(LINES, biases=[0.75] * len(LINES), styles=styles, seeds=SEEDS)
+        sampler = ContinuousSampler(hand, num_slots=3)
+        strokes = sampler.sample(LINES, biases=[0.75] * len(LINES), styles=styles, seeds=SEEDS)
+        for line, line_strokes, expected_strokes in zip(LINES, strokes, expected):
+            assert line_strokes.shape == expected_strokes.shape, \
+                '{!r}: {} points instead of {}'.format(line, len(line_strokes), len(expected_strokes))
+            np.testing.assert_allclose(line_strokes, expected_strokes, atol=1e-4)
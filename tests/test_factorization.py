@@ -0,0 +1,33 @@
+import logging
+
+import tensorflow as tf
+
+from handwriting_synthesis.hand import Hand
+from handwriting_synthesis.rnn import RNN
+from handwriting_synthesis.tf import factorized_ranks
+
+MODEL_KWARGS = dict(lstm_size=16, output_mixture_components=3, attention_mixture_components=2)
+RANKS = {'lstm_cell': 4, 'lstm_cell_2': 8, 'gmm': 2}
+
+
+def test_hand_reads_ranks_from_checkpoint(tmp_path):
+    checkpoint_dir = str(tmp_path / 'checkpoint')
+    nn = RNN(
+        log_dir=str(tmp_path / 'logs'),
+        checkpoint_dir=checkpoint_dir,
+        prediction_dir=str(tmp_path / 'predictions'),
+        optimizer='rms',
+        logging_level=logging.CRITICAL,
+        ranks=RANKS,
+        **MODEL_KWARGS
+    )
+    nn.session.run(nn.init)
+    nn.save(1)
+    nn.wait_for_checkpoints()
+    nn.session.close()
+
+    assert factorized_ranks(tf.train.latest_checkpoint(checkpoint_dir)) == RANKS
+    hand = Hand(checkpoint_dir=checkpoint_dir, **MODEL_KWARGS)
+    assert hand.nn.ranks == RANKS
+    [strokes] = hand._sample(['hello'], seeds=[1])
+    assert strokes.ndim == 2 and strokes.shape[1] == 3
@@ -0,0 +1,52 @@
+import numpy as np
+import tensorflow as tf
+import tensorflow.compat.v1 as tfcompat
+
+from handwriting_synthesis.rnn import RNN
+
+NUM_COMPONENTS = 3
+BATCH_SIZE = 4
+MAX_LEN = 6
+
+
+def _loss_and_gradient(z_value, y_value, lengths):
+    nn = RNN.__new__(RNN)
+    with tf.Graph().as_default():
+        z = tf.constant(z_value)
+        _, loss = nn.log_nll(tf.constant(y_value), tf.constant(lengths), z)
+        [gradient] = tf.gradients(loss, [z])
+        with tfcompat.Session() as session:
+            return session.run([loss, gradient])
+
+
+def _inputs(seed=0):
+    rng = np.random.RandomState(seed)
+    z = rng.randn(BATCH_SIZE, MAX_LEN, 6 * NUM_COMPONENTS + 1).astype(np.float32)
+    y = rng.randn(BATCH_SIZE, MAX_LEN, 3).astype(np.float32)
+    y[..., 2] = rng.rand(BATCH_SIZE, MAX_LEN) < 0.2
+    lengths = np.array([MAX_LEN, 4, 2, 1], dtype=np.int32)
+    return z, y, lengths
+
+
+def test_saturated_logits_give_finite_loss_and_gradients():
+    z, y, lengths = _inputs()
+    rho_start = 3 * NUM_COMPONENTS
+    for rho_logit in [5.0, 9.0, 10.0, 20.0, 100.0, -100.0]:
+        z_saturated = z.copy()
+        z_saturated[..., rho_start:rho_start + NUM_COMPONENTS] = rho_logit
+        z_saturated[0, :, NUM_COMPONENTS:NUM_COMPONENTS + 2] = [-100.0, 100.0]
+        loss, gradient = _loss_and_gradient(z_saturated, y, lengths)
+        assert np.isfinite(loss), 'loss is {} for a rho logit of {}'.format(loss, rho_logit)
+        assert np.all(np.isfinite(gradient)), 'non-finite gradient for a rho logit of {}'.format(rho_logit)
+
+
+def test_matches_legacy_nll():
+    z, y, lengths = _inputs(seed=1)
+    nn = RNN.__new__(RNN)
+    nn.output_mixture_components = NUM_COMPONENTS
+    with tf.Graph().as_default():
+        _, loss = nn.log_nll(tf.constant(y), tf.constant(lengths), tf.constant(z))
+        _, legacy_loss = nn.nll(tf.constant(y), tf.constant(lengths), *nn.parse_parameters(tf.constant(z)))
+        with tfcompat.Session() as session:
+            loss, legacy_loss = session.run([loss, legacy_loss])
+    np.testing.assert_allclose(loss, legacy_loss, rtol=1e-4)
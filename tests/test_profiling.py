@@ -0,0 +1,27 @@
+import json
+import os
+
+import tensorflow.compat.v1 as tfcompat
+
+from handwriting_synthesis.tf.profiling import StepProfiler
+
+
+def test_trace_covers_every_run_of_the_step(tmp_path):
+    graph = tfcompat.Graph()
+    with graph.as_default():
+        x = tfcompat.placeholder(tfcompat.float32, [4])
+        first = tfcompat.reduce_sum(x, name='first_run')
+        second = tfcompat.reduce_max(x, name='second_run')
+    profiler = StepProfiler(str(tmp_path / 'profile.jsonl'), trace_steps=(0, 0))
+    with tfcompat.Session(graph=graph) as session:
+        run_kwargs = profiler.run_kwargs(0)
+        for fetch in (first, second):
+            session.run(fetch, feed_dict={x: [1., 2., 3., 4.]}, **run_kwargs)
+            profiler.collect_run()
+        profiler.end_step(0)
+    profiler.close()
+
+    with open(os.path.join(str(tmp_path), 'timeline-0.json')) as f:
+        events = json.load(f)['traceEvents']
+    names = {event.get('args', {}).get('name') for event in events}
+    assert {'first_run', 'second_run'} <= names
@@ -0,0 +1,30 @@
+import numpy as np
+
+from handwriting_synthesis.hand import Hand, SamplingPool
+
+LINES = ['hello world', 'a', 'the quick brown fox', 'xyz abc', 'more text']
+STYLES = [1, None, 3, None, 5]
+SEEDS = [100, 101, 102, 103, 104]
+CHUNK_SIZE = 2
+
+
+def test_same_strokes_for_any_pool_size(small_model):
+    hand_kwargs = small_model
+    results = {}
+    for processes in (1, 3):
+        with SamplingPool(processes=processes, chunk_size=CHUNK_SIZE, **hand_kwargs) as pool:
+            results[processes] = pool.sample(LINES, biases=[0.6] * len(LINES), styles=STYLES, seeds=SEEDS)
+
+    hand = Hand(**hand_kwargs)
+    expected = []
+    for start in range(0, len(LINES), CHUNK_SIZE):
+        end = start + CHUNK_SIZE
+        expected.extend(hand._sample_batches(
+            LINES[start:end], [0.6] * len(LINES[start:end]), STYLES[start:end], max_batch_size=CHUNK_SIZE,
+            seeds=SEEDS[start:end]))
+
+    for processes, strokes in results.items():
+        assert len(strokes) == len(LINES)
+        for line, line_strokes, expected_strokes in zip(LINES, strokes, expected):
+            assert np.array_equal(line_strokes, expected_strokes), \
+                '{!r} differs with {} processes'.format(line, processes)
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from handwriting_synthesis.hand import Hand, HandServer
+
+
+class FakeHand(object):
+    """Stands in for a Hand, returning fixed strokes after delay seconds."""
+
+    _validate = staticmethod(Hand._validate)
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.style_bank = {1: None}
+
+    def _has_style(self, style):
+        return style in self.style_bank
+
+    def _sample_batches(self, lines, biases, styles, max_batch_size=32, seeds=None):
+        time.sleep(self.delay)
+        strokes = np.zeros([20, 3], dtype=np.float32)
+        strokes[:, 0] = 1.0
+        strokes[:, 1] = np.sin(np.arange(20))
+        strokes[-1, 2] = 1.0
+        return [strokes.copy() for _ in lines]
+
+
+async def request(port, method, path, body=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    content = json.dumps(body).encode() if body is not None else b''
+    writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n\r\n'.format(
+        method, path, len(content)).encode('latin-1') + content)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status = int(response.split(b' ', 2)[1])
+    return status, response.split(b'\r\n\r\n', 1)[1]
+
+
+def run(hand, scenario, **kwargs):
+    async def main():
+        server = HandServer(hand, port=0, **kwargs)
+        await server.start()
+        try:
+            return await scenario(server.port)
+        finally:
+            await server.close()
+    return asyncio.run(main())
+
+
+def test_generate_svg_and_strokes():
+    async def scenario(port):
+        svg = await request(port, 'POST', '/generate', {'lines': ['hello'], 'styles': [1], 'seeds': [3]})
+        strokes = await request(port, 'POST', '/generate', {'lines': ['hi', 'there'], 'format': 'strokes'})
+        health = await request(port, 'GET', '/health')
+        return svg, strokes, health
+
+    (svg_status, svg), (strokes_status, strokes), (health_status, _) = run(FakeHand(), scenario)
+    assert svg_status == 200 and svg.startswith(b'<svg')
+    assert strokes_status == 200 and len(json.loads(strokes)['strokes']) == 2
+    assert health_status == 200
+
+
+def test_invalid_requests_get_400():
+    bodies = [
+        {'lines': []},
+        {'lines': ['hello'], 'biases': ['x']},
+        {'lines': ['hello'], 'biases': [True]},
+        {'lines': ['hello'], 'styles': [12345]},
+        {'lines': ['hello'], 'styles': ['1']},
+        {'lines': ['hello'], 'seeds': [-1]},
+        {'lines': ['hello'], 'deadline': 'x'},
+        {'lines': ['hello'], 'deadline': None},
+        {'lines': ['hello'], 'deadline': 0},
+        {'lines': ['hello'], 'stroke_colors': ['red', 'blue']},
+        {'lines': ['x' * 76]},
+    ]
+
+    async def scenario(port):
+        return await asyncio.gather(*[request(port, 'POST', '/generate', body) for body in bodies])
+
+    assert [status for status, _ in run(FakeHand(), scenario)] == [400] * len(bodies)
+
+
+def test_full_queue_gets_429():
+    async def scenario(port):
+        first = asyncio.ensure_future(request(port, 'POST', '/generate', {'lines': ['one']}))
+        await asyncio.sleep(0.2)
+        second = asyncio.ensure_future(request(port, 'POST', '/generate', {'lines': ['two']}))
+        await asyncio.sleep(0.2)
+        third = await request(port, 'POST', '/generate', {'lines': ['three']})
+        return await first, await second, third
+
+    first, second, third = run(FakeHand(delay=1.0), scenario, max_queue_size=1, batch_window=0.0)
+    assert (first[0], second[0], third[0]) == (200, 200, 429)
+
+
+def test_deadline_gets_504():
+    async def scenario(port):
+        return await request(port, 'POST', '/generate', {'lines': ['slow'], 'deadline': 0.1})
+
+    status, _ = run(FakeHand(delay=0.5), scenario)
+    assert status == 504
+
+
+class BrokenStrokesHand(FakeHand):
+    """Returns strokes that cannot be drawn."""
+
+    def _sample_batches(self, lines, biases, styles, max_batch_size=32, seeds=None):
+        return [np.zeros([5], dtype=np.float32) for _ in lines]
+
+
+def test_drawing_failure_gets_500():
+    async def scenario(port):
+        return await request(port, 'POST', '/generate', {'lines': ['hello']})
+
+    status, content = run(BrokenStrokesHand(), scenario)
+    assert status == 500 and 'error' in json.loads(content)
+
+
+def test_close_does_not_block_the_event_loop():
+    async def main():
+        server = HandServer(FakeHand(delay=1.0), port=0)
+        await server.start()
+        pending = asyncio.ensure_future(request(server.port, 'POST', '/generate', {'lines': ['slow']}))
+        await asyncio.sleep(0.2)
+
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.05)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        await server.close()
+        ticker.cancel()
+        pending.cancel()
+        return ticks
+
+    # The batch being sampled takes about 0.8s more to finish, during which the loop keeps running.
+    assert asyncio.run(main()) >= 5